@@ -0,0 +1,108 @@
+"""
+Shared, lazily-created API clients, one per provider and configuration.
+
+Each SDK client owns an HTTP connection pool, so building a new one per call
+means a new TLS handshake per call. These helpers hand back the same client
+each time instead (the SDK clients are thread-safe), so back-to-back calls
+reuse warm keep-alive connections.
+
+    client = get_openai_client(api_key=OPENAI_API_KEY)
+    client is get_openai_client(api_key=OPENAI_API_KEY)  # -> True
+
+Async clients are bound to the event loop they were first used on, so they're
+cached per running loop (and dropped when the loop is garbage-collected).
+
+SDKs are imported lazily, so you only need the ones you use.
+"""
+
+import asyncio
+import threading
+from typing import Any, Callable, Hashable, Optional
+import weakref
+
+
+_lock = threading.Lock()
+_clients: dict[Hashable, Any] = {}
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Hashable, Any]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _config_key(provider: str, config: dict[str, Any]) -> Hashable:
+    return (provider, tuple(sorted(config.items())))
+
+
+def get_client(provider: str, factory: Callable[[], Any], **config: Any) -> Any:
+    """
+    Returns the shared client for (PROVIDER, CONFIG), calling FACTORY() to create
+    it the first time. CONFIG values must be hashable (e.g. api_key, base_url).
+    """
+    key = _config_key(provider, config)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_async_client(provider: str, factory: Callable[[], Any], **config: Any) -> Any:
+    """
+    Like `get_client`, but for asyncio clients, which are cached per running
+    event loop. Must be called from inside a coroutine.
+    """
+    loop = asyncio.get_running_loop()
+    key = _config_key(provider, config)
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        if key not in loop_clients:
+            loop_clients[key] = factory()
+        return loop_clients[key]
+
+
+def clear_clients():
+    """Forgets all the shared clients (e.g. after rotating an API key, or in tests)."""
+    with _lock:
+        _clients.clear()
+        _async_clients.clear()
+
+
+def get_openai_client(api_key: Optional[str] = None, **kwargs: Any):
+    from openai import OpenAI
+
+    return get_client(
+        "openai", lambda: OpenAI(api_key=api_key, **kwargs), api_key=api_key, **kwargs
+    )
+
+
+def get_async_openai_client(api_key: Optional[str] = None, **kwargs: Any):
+    from openai import AsyncOpenAI
+
+    return get_async_client(
+        "openai", lambda: AsyncOpenAI(api_key=api_key, **kwargs), api_key=api_key, **kwargs
+    )
+
+
+def get_anthropic_client(api_key: Optional[str] = None, **kwargs: Any):
+    from anthropic import Anthropic
+
+    return get_client(
+        "anthropic", lambda: Anthropic(api_key=api_key, **kwargs), api_key=api_key, **kwargs
+    )
+
+
+def get_async_anthropic_client(api_key: Optional[str] = None, **kwargs: Any):
+    from anthropic import AsyncAnthropic
+
+    return get_async_client(
+        "anthropic",
+        lambda: AsyncAnthropic(api_key=api_key, **kwargs),
+        api_key=api_key,
+        **kwargs,
+    )
+
+
+def get_google_translate_client(**kwargs: Any):
+    from google.cloud import translate_v2 as translate
+
+    return get_client(
+        "google_translate", lambda: translate.Client(**kwargs), **kwargs
+    )
@@ -1,6 +1,11 @@
 from functools import update_wrapper
 import inspect
+from pathlib import Path
 import re
+import sqlite3
+import threading
+import time
+from typing import Optional, Sequence
 
 from gjdutils.typ import isiterable
 
@@ -237,3 +242,155 @@ def cmcd(prefix=None, arg_names=(), expiry=None):
         return update_wrapper(f, func)
 
     return dec
+
+
+class SqliteCache:
+    """
+    A small persistent key -> bytes store backed by a single SQLite file.
+
+    Keys are strings (typically a hex digest), values are raw bytes, so callers
+    decide how to serialise. If MAX_BYTES is set, the least-recently-used
+    entries are evicted once the total size of stored values exceeds it. If
+    TTL_SECONDS is set, entries older than that are treated as missing (and
+    deleted when next looked up).
+
+    Safe to share across threads (one connection, guarded by a lock).
+
+    e.g.
+        cache = SqliteCache("~/.cache/gjdutils/embeddings.sqlite", max_bytes=2 * 1024**3)
+        cache.set("abc", b"...")
+        cache.get("abc")  # -> b"..."
+    """
+
+    def __init__(
+        self,
+        filen: str | Path,
+        max_bytes: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.filen = Path(filen).expanduser()
+        self.filen.parent.mkdir(parents=True, exist_ok=True)
+        assert max_bytes is None or max_bytes > 0, f"Invalid max_bytes: {max_bytes}"
+        assert ttl_seconds is None or ttl_seconds > 0, f"Invalid ttl_seconds: {ttl_seconds}"
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.filen), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " nbytes INTEGER NOT NULL,"
+                " accessed REAL NOT NULL,"
+                " created REAL NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(cache)")]
+            if "created" not in columns:
+                # caches written before TTL support was added
+                self._conn.execute(
+                    "ALTER TABLE cache ADD COLUMN created REAL NOT NULL DEFAULT 0"
+                )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_created ON cache (created)"
+            )
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Sequence[str]) -> dict[str, bytes]:
+        """
+        Returns a dict of only the KEYS that were found and haven't expired
+        (and marks them as recently used).
+        """
+        found: dict[str, bytes] = {}
+        # stay well under SQLite's limit on the number of bound variables
+        chunk_size = 500
+        with self._lock, self._conn:
+            now = time.time()
+            if self.ttl_seconds is not None:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE created < ?", (now - self.ttl_seconds,)
+                )
+            for start in range(0, len(keys), chunk_size):
+                chunk = list(keys[start : start + chunk_size])
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                found.update({k: bytes(v) for k, v in rows})
+                self._conn.execute(
+                    f"UPDATE cache SET accessed = ? WHERE key IN ({placeholders})",
+                    [now, *chunk],
+                )
+        return found
+
+    def set(self, key: str, value: bytes):
+        self.set_many({key: value})
+
+    def set_many(self, items: dict[str, bytes]):
+        with self._lock, self._conn:
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, nbytes, accessed, created) VALUES (?, ?, ?, ?, ?)",
+                [(k, sqlite3.Binary(v), len(v), now, now) for k, v in items.items()],
+            )
+            self._evict()
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+
+    def nbytes(self) -> int:
+        with self._lock:
+            (total,) = self._conn.execute(
+                "SELECT COALESCE(SUM(nbytes), 0) FROM cache"
+            ).fetchone()
+        return int(total)
+
+    def __len__(self) -> int:
+        with self._lock:
+            (n,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        return int(n)
+
+    def __contains__(self, key: str) -> bool:
+        min_created = 0 if self.ttl_seconds is None else time.time() - self.ttl_seconds
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM cache WHERE key = ? AND created >= ?", (key, min_created)
+            ).fetchone()
+        return row is not None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self):
+        # assumes the caller holds the lock and is inside a transaction
+        if self.max_bytes is None:
+            return
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM cache"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        rows = self._conn.execute(
+            "SELECT key, nbytes FROM cache ORDER BY accessed ASC"
+        )
+        to_delete = []
+        for key, nbytes in rows:
+            if excess <= 0:
+                break
+            to_delete.append((key,))
+            excess -= nbytes
+        self._conn.executemany("DELETE FROM cache WHERE key = ?", to_delete)
@@ -1,21 +1,50 @@
 from __future__ import annotations
 
-from typing import Any, Optional, Tuple
+from array import array
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import hashlib
+import heapq
+import json
+import math
+import operator
+from pathlib import Path
+import tempfile
+import time
+from typing import Any, Callable, Iterable, Literal, Optional, Tuple
 
-from openai import OpenAI, NOT_GIVEN
+from openai import AsyncOpenAI, OpenAI, NOT_GIVEN
 
+from gjdutils.api_clients import get_async_openai_client, get_openai_client
+from gjdutils.caching import SqliteCache
 from gjdutils.env import get_env_var
+from gjdutils.llms_common import (
+    ExtraLevelTyps,
+    check_extra_level,
+    estimate_num_tokens,
+    response_extra,
+)
+from gjdutils.rand import DEFAULT_RANDOM_SEED
+from gjdutils.ratelimit import AsyncTokenBucket, acall_with_backoff, call_with_backoff
 
 
 # Load once to mirror pattern in other modules
 OPENAI_API_KEY = get_env_var("OPENAI_API_KEY")
 
+# The API allows up to 2048 inputs and 300k tokens per request - leave some headroom,
+# since our token counts are only estimates
+EMBEDDINGS_MAX_ITEMS_PER_BATCH = 1024
+EMBEDDINGS_MAX_TOKENS_PER_BATCH = 200_000
+
 
 def get_openai_embeddings(
     txts: list[str],
     model: str,
     dimensions: Optional[int] = None,
     client: Optional[OpenAI] = None,
+    cache: Optional[SqliteCache] = None,
+    extra_level: ExtraLevelTyps = "minimal",
     verbose: int = 0,
 ) -> Tuple[list[list[float]], dict[str, Any]]:
     """
@@ -26,12 +55,23 @@ def get_openai_embeddings(
         model: Required embedding model name (e.g., "text-embedding-3-large" or "text-embedding-3-small").
         dimensions: Optional target dimensionality supported by the model.
         client: Optional pre-initialized OpenAI client to reuse.
+        cache: Optional on-disk cache (opt-in). Embeddings are keyed on a hash of
+            (model, dimensions, text), and only cache misses are sent to the API.
+            Cached embeddings are stored as float64, so hits match misses exactly.
+        extra_level: How much of the API response to keep in `extra` (see
+            `gjdutils.llms_common.ExtraLevelTyps`). The default "minimal" keeps only
+            usage, model and timing - "full" adds `response.model_dump()`, which
+            holds every embedding a second time as Python floats.
         verbose: Verbosity level for basic diagnostics.
 
     Returns:
         (embeddings, extra) where:
             embeddings: list[list[float]] with one embedding per input, order-preserving.
-            extra: dict with helpful metadata (model, dimensions, response payload, etc.).
+            extra: dict with helpful metadata (model, dimensions, usage, elapsed_s,
+                cache_hits/cache_misses, etc.). `response` is None for the default
+                extra_level, or if every input was served from the cache. Repeated texts are only sent to the API
+                once: `num_api_inputs` is what was sent, and `num_api_inputs_saved`
+                how many duplicates were skipped.
 
     Raises:
         ValueError: If inputs are invalid (e.g., not a list, empty list, any non-string or empty string element).
@@ -42,8 +82,305 @@ def get_openai_embeddings(
         >>> embeddings, extra = get_openai_embeddings(texts, model="text-embedding-3-small")
         >>> arr = convert_to_numpy(embeddings)
         >>> arr.shape  # (2, 1536) for text-embedding-3-small by default
+
+        >>> from gjdutils.caching import SqliteCache
+        >>> cache = SqliteCache("~/.cache/gjdutils/embeddings.sqlite", max_bytes=2 * 1024**3)
+        >>> embeddings, extra = get_openai_embeddings(texts, model="text-embedding-3-small", cache=cache)
+        >>> extra["cache_hits"], extra["cache_misses"]
+    """
+
+    _validate_embedding_inputs(txts, model)
+    check_extra_level(extra_level)
+
+    embeddings = _embeddings_from_cache(cache, txts, model=model, dimensions=dimensions)
+    n_misses = sum(emb is None for emb in embeddings)
+    # each distinct text is only sent once, and fanned out to all its positions
+    positions = _positions_of_misses(txts, embeddings)
+    miss_txts = list(positions)
+
+    resp = None
+    t0 = time.perf_counter()
+    if miss_txts:
+        # Build or reuse client
+        if client is None:
+            client = get_openai_client(api_key=OPENAI_API_KEY)
+        miss_embeddings, resp = _create_embeddings(
+            client, miss_txts, model=model, dimensions=dimensions
+        )
+        for t, emb in zip(miss_txts, miss_embeddings):
+            _fan_out(embeddings, positions[t], emb)
+        _embeddings_to_cache(cache, miss_txts, miss_embeddings, model=model, dimensions=dimensions)
+
+    # Build extra diagnostics
+    extra: dict[str, Any] = {
+        "model": model,
+        "dimensions": dimensions,
+        "num_inputs": len(txts),
+        "num_api_inputs": len(miss_txts),
+        "num_api_inputs_saved": n_misses - len(miss_txts),
+        "cache_hits": len(txts) - n_misses if cache is not None else 0,
+        "cache_misses": n_misses if cache is not None else 0,
+        "elapsed_s": time.perf_counter() - t0,
+        **response_extra(resp, extra_level),
+    }
+
+    if verbose >= 1:
+        dim = len(embeddings[0]) if embeddings and embeddings[0] is not None else None
+        print(f"OpenAI embeddings: {len(embeddings)} items, dim={dim}, model={model}")
+
+    return embeddings, extra  # type: ignore[return-value]
+
+
+def get_openai_embeddings_bulk(
+    txts: list[str],
+    model: str,
+    dimensions: Optional[int] = None,
+    client: Optional[OpenAI] = None,
+    cache: Optional[SqliteCache] = None,
+    max_items_per_batch: int = EMBEDDINGS_MAX_ITEMS_PER_BATCH,
+    max_tokens_per_batch: int = EMBEDDINGS_MAX_TOKENS_PER_BATCH,
+    max_workers: int = 4,
+    max_retries: int = 5,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    verbose: int = 0,
+) -> Tuple[list[list[float]], dict[str, Any]]:
+    """
+    Like `get_openai_embeddings`, but for large lists. Splits TXTS into batches
+    (by item count and estimated tokens, to stay under the API's per-request
+    limits), sends them concurrently on a bounded thread pool over one shared
+    client, retries with exponential backoff on 429/5xx/connection errors, and
+    reassembles the results in input order.
+
+    Args:
+        txts, model, dimensions, client, cache, verbose: as for `get_openai_embeddings`.
+        max_items_per_batch: Maximum number of inputs per API request.
+        max_tokens_per_batch: Maximum estimated tokens per API request
+            (see `estimate_num_tokens`).
+        max_workers: Number of batches in flight at once.
+        max_retries: Retries per batch for retryable errors before giving up.
+        progress_callback: Optional `f(n_done, n_total)`, called (from the calling
+            thread) after each batch completes, counting inputs. Cache hits count
+            as done from the start.
+
+    Returns:
+        (embeddings, extra) where extra includes num_batches, num_retries,
+        num_api_inputs_saved (duplicates skipped), cache_hits/cache_misses and
+        summed `usage`. Individual responses are not
+        kept, to save memory.
+
+    Example:
+        >>> embeddings, extra = get_openai_embeddings_bulk(
+        ...     texts, model="text-embedding-3-small", max_workers=8,
+        ...     progress_callback=lambda done, total: print(f"{done}/{total}"),
+        ... )
     """
+    _validate_embedding_inputs(txts, model)
+    assert max_workers >= 1, f"max_workers must be >= 1, got {max_workers}"
+
+    embeddings = _embeddings_from_cache(cache, txts, model=model, dimensions=dimensions)
+    n_misses = sum(emb is None for emb in embeddings)
+    # each distinct text is only sent once, and fanned out to all its positions
+    positions = _positions_of_misses(txts, embeddings)
+    miss_txts = list(positions)
+    batches = [
+        [miss_txts[j] for j in batch]
+        for batch in batch_by_size(
+            miss_txts, max_items=max_items_per_batch, max_tokens=max_tokens_per_batch
+        )
+    ]
+
+    n_done = len(txts) - n_misses
+    n_retries = 0
+    usage = {"prompt_tokens": 0, "total_tokens": 0}
+    if progress_callback is not None:
+        progress_callback(n_done, len(txts))
+
+    if batches:
+        # Build or reuse client (shared across threads - the SDK client is thread-safe)
+        if client is None:
+            client = get_openai_client(api_key=OPENAI_API_KEY)
+
+        def embed_batch(batch_txts: list[str]):
+            (batch_embeddings, resp), batch_retries = call_with_backoff(
+                lambda: _create_embeddings(
+                    client, batch_txts, model=model, dimensions=dimensions  # type: ignore[arg-type]
+                ),
+                max_retries=max_retries,
+                verbose=verbose,
+            )
+            _embeddings_to_cache(cache, batch_txts, batch_embeddings, model=model, dimensions=dimensions)
+            return batch_embeddings, resp, batch_retries
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            future_to_txts = {pool.submit(embed_batch, batch): batch for batch in batches}
+            for future in as_completed(future_to_txts):
+                batch_txts = future_to_txts[future]
+                batch_embeddings, resp, batch_retries = future.result()
+                for t, emb in zip(batch_txts, batch_embeddings):
+                    _fan_out(embeddings, positions[t], emb)
+                    n_done += len(positions[t])
+                n_retries += batch_retries
+                resp_usage = getattr(resp, "usage", None)
+                for k in usage:
+                    usage[k] += getattr(resp_usage, k, 0) or 0
+                if progress_callback is not None:
+                    progress_callback(n_done, len(txts))
+
+    extra: dict[str, Any] = {
+        "model": model,
+        "dimensions": dimensions,
+        "num_inputs": len(txts),
+        "num_api_inputs": len(miss_txts),
+        "num_api_inputs_saved": n_misses - len(miss_txts),
+        "num_batches": len(batches),
+        "num_retries": n_retries,
+        "cache_hits": len(txts) - n_misses if cache is not None else 0,
+        "cache_misses": n_misses if cache is not None else 0,
+        "usage": usage,
+    }
+    if verbose >= 1:
+        print(
+            f"OpenAI embeddings (bulk): {len(txts)} items in {len(batches)} batches, "
+            f"{n_retries} retries, model={model}"
+        )
+    return embeddings, extra  # type: ignore[return-value]
+
 
+async def aget_openai_embeddings(
+    txts: list[str],
+    model: str,
+    dimensions: Optional[int] = None,
+    client: Optional[AsyncOpenAI] = None,
+    cache: Optional[SqliteCache] = None,
+    max_concurrency: int = 8,
+    tokens_per_minute: float | AsyncTokenBucket | None = None,
+    max_items_per_batch: int = EMBEDDINGS_MAX_ITEMS_PER_BATCH,
+    max_tokens_per_batch: int = EMBEDDINGS_MAX_TOKENS_PER_BATCH,
+    max_retries: int = 5,
+    verbose: int = 0,
+) -> Tuple[list[list[float]], dict[str, Any]]:
+    """
+    Asyncio version of `get_openai_embeddings`, built on `AsyncOpenAI`. Same input
+    validation and return shape, but large inputs are split into batches (as for
+    `get_openai_embeddings_bulk`) that run concurrently on the event loop.
+
+    Args:
+        txts, model, dimensions, cache, verbose: as for `get_openai_embeddings`.
+        client: Optional pre-initialized AsyncOpenAI client to reuse.
+        max_concurrency: Maximum number of requests in flight at once.
+        tokens_per_minute: Optional budget of (estimated) tokens per minute. Batches
+            wait for budget before they're sent. Pass an `AsyncTokenBucket` instead
+            of a number to share one budget across concurrent calls.
+        max_items_per_batch, max_tokens_per_batch, max_retries: as for
+            `get_openai_embeddings_bulk`.
+
+    Example:
+        >>> embeddings, extra = await aget_openai_embeddings(
+        ...     texts, model="text-embedding-3-small", max_concurrency=16, tokens_per_minute=1_000_000
+        ... )
+    """
+    _validate_embedding_inputs(txts, model)
+    assert max_concurrency >= 1, f"max_concurrency must be >= 1, got {max_concurrency}"
+
+    # SQLite calls block, so keep them off the event loop
+    embeddings = await asyncio.to_thread(
+        _embeddings_from_cache, cache, txts, model=model, dimensions=dimensions
+    )
+    n_misses = sum(emb is None for emb in embeddings)
+    # each distinct text is only sent once, and fanned out to all its positions
+    positions = _positions_of_misses(txts, embeddings)
+    miss_txts = list(positions)
+    batches = [
+        [miss_txts[j] for j in batch]
+        for batch in batch_by_size(
+            miss_txts, max_items=max_items_per_batch, max_tokens=max_tokens_per_batch
+        )
+    ]
+
+    n_retries = 0
+    usage = {"prompt_tokens": 0, "total_tokens": 0}
+    if batches:
+        if client is None:
+            client = get_async_openai_client(api_key=OPENAI_API_KEY)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        if isinstance(tokens_per_minute, AsyncTokenBucket):
+            limiter = tokens_per_minute
+        else:
+            limiter = AsyncTokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+        async def embed_batch(batch_txts: list[str]):
+            nonlocal n_retries
+            n_tokens = sum(estimate_num_tokens(t) for t in batch_txts)
+
+            async def attempt():
+                # acquired per attempt, so retries after a 429 also wait for budget
+                if limiter is not None:
+                    await limiter.acquire(n_tokens)
+                return await _acreate_embeddings(
+                    client, batch_txts, model=model, dimensions=dimensions  # type: ignore[arg-type]
+                )
+
+            async with semaphore:
+                (batch_embeddings, resp), batch_retries = await acall_with_backoff(
+                    attempt, max_retries=max_retries, verbose=verbose
+                )
+            for t, emb in zip(batch_txts, batch_embeddings):
+                _fan_out(embeddings, positions[t], emb)
+            n_retries += batch_retries
+            resp_usage = getattr(resp, "usage", None)
+            for k in usage:
+                usage[k] += getattr(resp_usage, k, 0) or 0
+            await asyncio.to_thread(
+                _embeddings_to_cache, cache, batch_txts, batch_embeddings, model=model, dimensions=dimensions
+            )
+
+        await asyncio.gather(*(embed_batch(batch) for batch in batches))
+
+    extra: dict[str, Any] = {
+        "model": model,
+        "dimensions": dimensions,
+        "num_inputs": len(txts),
+        "num_api_inputs": len(miss_txts),
+        "num_api_inputs_saved": n_misses - len(miss_txts),
+        "num_batches": len(batches),
+        "num_retries": n_retries,
+        "cache_hits": len(txts) - n_misses if cache is not None else 0,
+        "cache_misses": n_misses if cache is not None else 0,
+        "usage": usage,
+    }
+    if verbose >= 1:
+        print(
+            f"OpenAI embeddings (async): {len(txts)} items in {len(batches)} batches, "
+            f"{n_retries} retries, model={model}"
+        )
+    return embeddings, extra  # type: ignore[return-value]
+
+
+def batch_by_size(
+    txts: list[str], max_items: int, max_tokens: int
+) -> list[list[int]]:
+    """
+    Greedily split TXTS (in order) into batches of indices with at most MAX_ITEMS
+    items and at most MAX_TOKENS estimated tokens each. A single text that's over
+    MAX_TOKENS on its own still gets its own batch (and the API will decide).
+    """
+    assert max_items >= 1 and max_tokens >= 1
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_tokens = 0
+    for i, t in enumerate(txts):
+        n_tokens = estimate_num_tokens(t)
+        if batch and (len(batch) >= max_items or batch_tokens + n_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _validate_embedding_inputs(txts: list[str], model: str):
     # Validate inputs early and explicitly (fail-fast)
     if not isinstance(txts, list):
         raise ValueError(f"txts must be a list[str]; got {type(txts)}")
@@ -58,34 +395,103 @@ def get_openai_embeddings(
     if not isinstance(model, str) or model.strip() == "":
         raise ValueError("model must be a non-empty str")
 
-    # Build or reuse client
-    if client is None:
-        client = OpenAI(api_key=OPENAI_API_KEY)
 
+def _create_embeddings(
+    client: OpenAI, txts: list[str], model: str, dimensions: Optional[int]
+) -> Tuple[list[list[float]], Any]:
     # Prepare kwargs to avoid sending None values
     kwargs: dict[str, Any] = {
         "model": model,
         "input": txts,
         "dimensions": dimensions if dimensions is not None else NOT_GIVEN,
     }
-
     resp = client.embeddings.create(**kwargs)  # type: ignore[arg-type]
     # Extract embeddings in order
     embeddings: list[list[float]] = [d.embedding for d in resp.data]  # type: ignore[attr-defined]
+    return embeddings, resp
 
-    # Build extra diagnostics
-    extra: dict[str, Any] = {
-        "model": model,
-        "dimensions": dimensions,
-        "num_inputs": len(txts),
-        "response": resp.model_dump() if hasattr(resp, "model_dump") else resp,  # fallback
-    }
 
-    if verbose >= 1:
-        dim = len(embeddings[0]) if embeddings and embeddings[0] is not None else None
-        print(f"OpenAI embeddings: {len(embeddings)} items, dim={dim}, model={model}")
+async def _acreate_embeddings(
+    client: AsyncOpenAI, txts: list[str], model: str, dimensions: Optional[int]
+) -> Tuple[list[list[float]], Any]:
+    resp = await client.embeddings.create(
+        model=model,
+        input=txts,
+        dimensions=dimensions if dimensions is not None else NOT_GIVEN,
+    )
+    embeddings: list[list[float]] = [d.embedding for d in resp.data]
+    return embeddings, resp
+
+
+def embedding_cache_key(txt: str, model: str, dimensions: Optional[int] = None) -> str:
+    """
+    Deterministic cache key for one embedding, e.g. for use with `SqliteCache`.
+    """
+    # "f64" is the storage format, so entries from older float32 caches are misses
+    payload = json.dumps(["f64", model, dimensions, txt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _embeddings_from_cache(
+    cache: Optional[SqliteCache], txts: list[str], model: str, dimensions: Optional[int]
+) -> list[Optional[list[float]]]:
+    # one slot per input, None for cache misses (or if there's no cache)
+    embeddings: list[Optional[list[float]]] = [None] * len(txts)
+    if cache is None:
+        return embeddings
+    keys = [embedding_cache_key(t, model=model, dimensions=dimensions) for t in txts]
+    found = cache.get_many(keys)
+    for i, key in enumerate(keys):
+        if key in found:
+            embeddings[i] = _embedding_from_bytes(found[key])
+    return embeddings
+
+
+def _embeddings_to_cache(
+    cache: Optional[SqliteCache],
+    txts: list[str],
+    embeddings: list[list[float]],
+    model: str,
+    dimensions: Optional[int],
+):
+    if cache is None:
+        return
+    cache.set_many(
+        {
+            embedding_cache_key(t, model=model, dimensions=dimensions): _embedding_to_bytes(emb)
+            for t, emb in zip(txts, embeddings)
+        }
+    )
+
+
+def _positions_of_misses(
+    txts: list[str], embeddings: list[Optional[list[float]]]
+) -> dict[str, list[int]]:
+    # maps each distinct text that still needs embedding to all of its positions
+    # in TXTS (in first-seen order, so the API sees the texts in input order)
+    positions: dict[str, list[int]] = {}
+    for i, (t, emb) in enumerate(zip(txts, embeddings)):
+        if emb is None:
+            positions.setdefault(t, []).append(i)
+    return positions
+
+
+def _fan_out(embeddings: list[Optional[list[float]]], positions: list[int], embedding: list[float]):
+    # copies for repeats, so callers can't mutate one result via another
+    embeddings[positions[0]] = embedding
+    for i in positions[1:]:
+        embeddings[i] = list(embedding)
 
-    return embeddings, extra
+
+def _embedding_to_bytes(embedding: list[float]) -> bytes:
+    # float64, so a cache hit returns exactly what the API returned
+    return array("d", embedding).tobytes()
+
+
+def _embedding_from_bytes(b: bytes) -> list[float]:
+    arr = array("d")
+    arr.frombytes(b)
+    return arr.tolist()
 
 
 def convert_to_numpy(embeddings: list[list[float]]):
@@ -94,27 +500,203 @@ def convert_to_numpy(embeddings: list[list[float]]):
 
     Note: NumPy is an optional dependency. Install with `pip install gjdutils[dsci]`.
     """
-    try:
-        import numpy as np  # type: ignore
-    except Exception as e:  # pragma: no cover - error path
-        raise ImportError(
-            "NumPy is required for convert_to_numpy(). Install with 'pip install gjdutils[dsci]'"
-        ) from e
-
+    np = _import_numpy("convert_to_numpy()")
     return np.asarray(embeddings, dtype=np.float32)
 
 
+QuantisedDtypeTyps = Literal["float16", "int8"]
+QUANTISED_STORE_VERSION = 1
+
+
+def write_quantised_embeddings(
+    dirn: str | Path,
+    embeddings: list[list[float]] | Any | Iterable[Any],
+    dtype: QuantisedDtypeTyps = "float16",
+    overwrite: bool = False,
+    verbose: int = 0,
+) -> "QuantisedEmbeddingStore":
+    """
+    Writes embeddings to an on-disk store in DIRN that can be searched via
+    `np.memmap` without loading it into RAM (see `QuantisedEmbeddingStore`).
+
+    EMBEDDINGS can be a single (N, D) array/list, or an iterable of (n, D) chunks,
+    so a corpus larger than RAM can be streamed in.
+
+    DTYPE:
+        - "float16": half precision, 2 bytes per value
+        - "int8": symmetric per-row quantisation (value ~= code * row_scale),
+          1 byte per value, with one float32 scale per row
+
+    Layout of DIRN:
+        header.json  - dim, count, dtype, version
+        vectors.bin  - raw (N, D) float16/int8 values, row-major
+        scales.npy   - (N,) float32 per-row scale factors (all 1.0 for float16)
+        norms.npy    - (N,) float32 norms of the (dequantised) rows, for cosine/euclidean
+
+    Example:
+        >>> store = write_quantised_embeddings("corpus.emb", chunks_iter, dtype="int8")
+        >>> (idxs, scores), extra = compare_embedding_queries(Q, store, top_k=10)
+    """
+    np = _import_numpy("write_quantised_embeddings()")
+    if dtype not in ("float16", "int8"):
+        raise ValueError(f"Unknown dtype: {dtype}")
+    dirn = Path(dirn)
+    if (dirn / "header.json").exists() and not overwrite:
+        raise FileExistsError(f"Store already exists (pass overwrite=True): {dirn}")
+    dirn.mkdir(parents=True, exist_ok=True)
+    # remove the old header first, so a crash while rewriting can't leave it
+    # describing new, partial data
+    (dirn / "header.json").unlink(missing_ok=True)
+
+    is_list_of_chunks = (
+        isinstance(embeddings, list)
+        and len(embeddings) > 0
+        and isinstance(embeddings[0], np.ndarray)
+        and embeddings[0].ndim == 2
+    )
+    if isinstance(embeddings, (np.ndarray, list)) and not is_list_of_chunks:
+        chunks: Iterable[Any] = [embeddings]
+    else:
+        chunks = embeddings
+
+    dim: Optional[int] = None
+    n = 0
+    scales, norms = [], []
+    with open(dirn / "vectors.bin", "wb") as f:
+        for chunk in chunks:
+            X = np.asarray(chunk, dtype=np.float32)
+            if X.ndim != 2:
+                raise ValueError("each chunk of embeddings must be 2D (n, D)")
+            if dim is None:
+                dim = int(X.shape[1])
+            if X.shape[1] != dim:
+                raise ValueError(f"Dim mismatch: expected {dim}, got chunk of dim {X.shape[1]}")
+            if dtype == "int8":
+                row_scales = np.abs(X).max(axis=1) / 127.0
+                row_scales[row_scales == 0] = 1.0
+                codes = np.clip(np.rint(X / row_scales[:, None]), -127, 127).astype(np.int8)
+                dequantised = codes.astype(np.float32) * row_scales[:, None]
+            else:
+                row_scales = np.ones(X.shape[0], dtype=np.float32)
+                codes = X.astype(np.float16)
+                dequantised = codes.astype(np.float32)
+            f.write(codes.tobytes())
+            scales.append(row_scales.astype(np.float32))
+            norms.append(np.linalg.norm(dequantised, axis=1).astype(np.float32))
+            n += X.shape[0]
+    if dim is None:
+        raise ValueError("embeddings must be non-empty")
+
+    np.save(dirn / "scales.npy", np.concatenate(scales))
+    np.save(dirn / "norms.npy", np.concatenate(norms))
+    header = {"version": QUANTISED_STORE_VERSION, "dim": dim, "count": n, "dtype": dtype}
+    # write the header last, so a crashed write doesn't look like a valid store
+    (dirn / "header.json").write_text(json.dumps(header, indent=2))
+    if verbose >= 1:
+        print(f"Wrote {n} x {dim} {dtype} embeddings to {dirn}")
+    return QuantisedEmbeddingStore(dirn)
+
+
+class QuantisedEmbeddingStore:
+    """
+    Read-only, memory-mapped view of a store written by `write_quantised_embeddings`.
+
+    Vectors stay on disk and are paged in by the OS as blocks are scored, so a
+    single process can search a corpus larger than RAM. Pass it as the dataset to
+    `compare_embedding_query` / `compare_embedding_queries`, or use `search`.
+
+    Requires NumPy (`pip install gjdutils[dsci]`).
+    """
+
+    def __init__(self, dirn: str | Path):
+        np = _import_numpy("QuantisedEmbeddingStore")
+        self.dirn = Path(dirn)
+        header = json.loads((self.dirn / "header.json").read_text())
+        if header.get("version") != QUANTISED_STORE_VERSION:
+            raise ValueError(f"Unsupported store version: {header.get('version')}")
+        self.dim: int = header["dim"]
+        self.count: int = header["count"]
+        self.dtype: QuantisedDtypeTyps = header["dtype"]
+        self.vectors = np.memmap(
+            self.dirn / "vectors.bin", dtype=self.dtype, mode="r", shape=(self.count, self.dim)
+        )
+        self.scales = np.load(self.dirn / "scales.npy", mmap_mode="r")
+        self.norms = np.load(self.dirn / "norms.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (self.count, self.dim)
+
+    def get(self, start: int, end: int):
+        """Dequantised float32 rows [start, end)."""
+        np = _import_numpy("QuantisedEmbeddingStore")
+        X = self.vectors[start:end].astype(np.float32)
+        if self.dtype == "int8":
+            X *= self.scales[start:end, None]
+        return X
+
+    def block_scores(self, Q, start: int, end: int, metric: str = "cosine"):
+        """
+        (q, D) queries against rows [start, end) -> (q, end - start) float32 scores,
+        using the stored scales and norms rather than renormalising.
+        """
+        np = _import_numpy("QuantisedEmbeddingStore")
+        codes = self.vectors[start:end].astype(np.float32)
+        dots = Q @ codes.T
+        if self.dtype == "int8":
+            dots *= self.scales[start:end]
+        norms = self.norms[start:end]
+        if metric == "dot":
+            return dots
+        q_norms = np.linalg.norm(Q, axis=1, keepdims=True)
+        if metric == "cosine":
+            return dots / ((q_norms + 1e-12) * (norms + 1e-12))
+        elif metric == "euclidean":
+            sq = norms**2 + q_norms**2 - 2 * dots
+            return -np.sqrt(np.maximum(sq, 0))
+        else:
+            raise ValueError(f"Unknown metric: {metric}")
+
+    def search(
+        self,
+        query: list[float] | Any,
+        k: int = 10,
+        metric: str = "cosine",
+        memory_budget_mb: float = 256,
+    ):
+        """
+        Returns (indices, scores) of the K best rows, best-first: arrays of shape (k,)
+        for a single query (D,), or (Q, k) for a batch of queries (Q, D).
+        """
+        np = _import_numpy("QuantisedEmbeddingStore")
+        Q = np.asarray(query, dtype=np.float32)
+        (idxs, scores), _ = compare_embedding_queries(
+            Q.reshape(-1, self.dim), self, metric=metric, top_k=k, memory_budget_mb=memory_budget_mb
+        )
+        if Q.ndim == 1:
+            return idxs[0], scores[0]
+        return idxs, scores
+
+
 def compare_embedding_query(
     query_embedding: list[float] | Any,
     dataset_embeddings: list[list[float]] | Any,
     metric: str = "cosine",
+    top_k: Optional[int] = None,
+    as_numpy: bool = False,
+    memory_budget_mb: float = 256,
     verbose: int = 0,
-) -> Tuple[list[float], dict[str, Any]]:
+) -> Tuple[Any, dict[str, Any]]:
     """
     Compare a single query embedding to a dataset of embeddings.
 
     Inputs may be Python lists or NumPy arrays. If NumPy is available, a vectorized
-    implementation is used; otherwise a pure-Python fallback is used.
+    implementation is used; otherwise a pure-Python fallback is used. For repeated
+    queries without NumPy, pass the dataset as `PurePythonEmbeddings` so it's only
+    prepared once.
 
     Args:
         query_embedding: The embedding vector for the query (list[float] or np.ndarray).
@@ -123,13 +705,41 @@ def compare_embedding_query(
             - "cosine" (default): returns cosine similarity in [-1, 1], higher is more similar
             - "dot": returns dot product
             - "euclidean": returns negative Euclidean distance (so higher is more similar)
+        top_k: If set, only return the best TOP_K matches, as (indices, scores) sorted
+            best-first. Uses `np.argpartition`, so it's O(N) rather than a full sort.
+        as_numpy: Return NumPy arrays rather than Python lists (avoids creating N
+            Python floats). Requires NumPy.
+        memory_budget_mb: Working memory per block when the dataset is a
+            `QuantisedEmbeddingStore` (see `compare_embedding_queries`).
         verbose: Verbosity for diagnostics.
 
     Returns:
         (scores, extra) where:
-            scores: list[float] of similarity scores (higher is more similar) for each dataset vector
+            scores: list[float] of similarity scores (higher is more similar) for each dataset vector,
+                or (indices, scores) for the best TOP_K if TOP_K is set
             extra: dict with metadata such as the metric used and dimensionalities
+
+    Example:
+        >>> (idxs, scores), extra = compare_embedding_query(q, X, top_k=10)
     """
+    if top_k is not None and top_k < 1:
+        raise ValueError(f"top_k must be a positive int, got {top_k}")
+    if isinstance(dataset_embeddings, PurePythonEmbeddings):
+        if as_numpy:
+            raise ValueError("as_numpy isn't supported for PurePythonEmbeddings")
+        return _compare_embedding_query_py(
+            query_embedding, dataset_embeddings, metric=metric, top_k=top_k, verbose=verbose
+        )
+    if isinstance(dataset_embeddings, QuantisedEmbeddingStore):
+        return _compare_embedding_query_store(
+            query_embedding,
+            dataset_embeddings,
+            metric=metric,
+            top_k=top_k,
+            as_numpy=as_numpy,
+            memory_budget_mb=memory_budget_mb,
+            verbose=verbose,
+        )
 
     # Try NumPy path first
     try:
@@ -147,16 +757,23 @@ def compare_embedding_query(
         if metric == "cosine":
             qn = q / (np.linalg.norm(q) + 1e-12)
             Xn = X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)
-            sims = Xn @ qn  # (N,)
-            scores = sims.astype(np.float32).tolist()
+            scores_arr = Xn @ qn  # (N,)
         elif metric == "dot":
-            scores = (X @ q).astype(np.float32).tolist()
+            scores_arr = X @ q
         elif metric == "euclidean":
             diff = X - q
             dists = np.sqrt(np.sum(diff * diff, axis=1))
-            scores = (-dists).astype(np.float32).tolist()  # higher is better (less distance)
+            scores_arr = -dists  # higher is better (less distance)
         else:
             raise ValueError(f"Unknown metric: {metric}")
+        scores_arr = scores_arr.astype(np.float32, copy=False)
+
+        scores: Any
+        if top_k is not None:
+            idxs, top_scores = _top_k_numpy(scores_arr, top_k)
+            scores = (idxs, top_scores) if as_numpy else (idxs.tolist(), top_scores.tolist())
+        else:
+            scores = scores_arr if as_numpy else scores_arr.tolist()
 
         extra = {
             "metric": metric,
@@ -169,50 +786,1128 @@ def compare_embedding_query(
         return scores, extra
 
     except ImportError:
-        # Pure-Python fallback
-        def dot(a: list[float], b: list[float]) -> float:
-            return sum(x * y for x, y in zip(a, b))
+        if as_numpy:
+            raise
+        return _compare_embedding_query_py(
+            query_embedding, dataset_embeddings, metric=metric, top_k=top_k, verbose=verbose
+        )
 
-        def norm(a: list[float]) -> float:
-            return sum(x * x for x in a) ** 0.5
 
-        if not isinstance(query_embedding, list) or not all(isinstance(x, (int, float)) for x in query_embedding):
-            raise ValueError("query_embedding must be a list[float] when NumPy is unavailable")
+if hasattr(math, "sumprod"):  # Python 3.12+, and exact like fsum
+    _dot_py = math.sumprod
+else:
+
+    def _dot_py(a, b) -> float:
+        # map(mul) runs in C, unlike a generator expression
+        return sum(map(operator.mul, a, b))
+
+
+class PurePythonEmbeddings:
+    """
+    Dataset embeddings prepared for repeated pure-Python similarity scoring, for
+    environments without NumPy. Rows are stored as compact `array('f')` and their
+    norms are computed once (lazily) and cached, so each query to
+    `compare_embedding_query` is just one dot product per row.
+
+    Example:
+        >>> dataset = PurePythonEmbeddings(embeddings)  # list[list[float]]
+        >>> (idxs, scores), extra = compare_embedding_query(query, dataset, top_k=10)
+    """
+
+    def __init__(self, embeddings: list[list[float]]):
+        if not isinstance(embeddings, list) or not all(isinstance(v, (list, array)) for v in embeddings):
+            raise ValueError("dataset_embeddings must be a list[list[float]] when NumPy is unavailable")
+        self.rows = [array("f", v) for v in embeddings]
+        self.dim = len(self.rows[0]) if self.rows else 0
+        if any(len(v) != self.dim for v in self.rows):
+            raise ValueError("All dataset embeddings must have the same dimensionality")
+        self._norms: Optional[list[float]] = None
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def norms(self) -> list[float]:
+        if self._norms is None:
+            self._norms = [math.sqrt(_dot_py(v, v)) for v in self.rows]
+        return self._norms
+
+
+def _compare_embedding_query_py(
+    query_embedding: list[float],
+    dataset_embeddings: list[list[float]] | PurePythonEmbeddings,
+    metric: str,
+    top_k: Optional[int],
+    verbose: int,
+) -> Tuple[Any, dict[str, Any]]:
+    # Pure-Python fallback
+    if not isinstance(query_embedding, list) or not all(isinstance(x, (int, float)) for x in query_embedding):
+        raise ValueError("query_embedding must be a list[float] when NumPy is unavailable")
+    if isinstance(dataset_embeddings, PurePythonEmbeddings):
+        rows, dim = dataset_embeddings.rows, dataset_embeddings.dim
+    else:
+        # a one-off query: score the lists as they are, rather than paying to
+        # copy them into a PurePythonEmbeddings (and rounding them to float32)
         if not isinstance(dataset_embeddings, list) or not all(isinstance(v, list) for v in dataset_embeddings):
             raise ValueError("dataset_embeddings must be a list[list[float]] when NumPy is unavailable")
-        if len(dataset_embeddings) == 0:
-            return [], {"metric": metric, "num_dataset": 0, "query_dim": len(query_embedding), "dataset_dim": 0}
-        d = len(query_embedding)
-        if any(len(v) != d for v in dataset_embeddings):
-            raise ValueError("All dataset embeddings must have the same dimensionality as the query")
+        rows = dataset_embeddings
+        dim = len(rows[0]) if rows else 0
+    d = len(query_embedding)
+    if len(rows) == 0:
+        return ([], []) if top_k is not None else [], {"metric": metric, "num_dataset": 0, "query_dim": d, "dataset_dim": 0}
+    if dim != d or any(len(v) != d for v in rows):
+        raise ValueError("All dataset embeddings must have the same dimensionality as the query")
 
+    # a plain list iterates faster than an array (no boxing of each element)
+    q = [float(x) for x in query_embedding]
+    if metric not in ("cosine", "dot", "euclidean"):
+        raise ValueError(f"Unknown metric: {metric}")
+    qsq = _dot_py(q, q)
+    if isinstance(dataset_embeddings, PurePythonEmbeddings):
+        dots = [_dot_py(q, v) for v in rows]
+        norms = dataset_embeddings.norms
         if metric == "cosine":
-            qn = norm(query_embedding) + 1e-12
-            scores = [dot(query_embedding, v) / (qn * (norm(v) + 1e-12)) for v in dataset_embeddings]
+            qn = math.sqrt(qsq) + 1e-12
+            scores = [dp / (qn * (n + 1e-12)) for dp, n in zip(dots, norms)]
         elif metric == "dot":
-            scores = [dot(query_embedding, v) for v in dataset_embeddings]
+            scores = dots
+        else:
+            # |x - q|^2 = |x|^2 + |q|^2 - 2 x.q, reusing the cached norms
+            scores = [-math.sqrt(max(n * n + qsq - 2 * dp, 0.0)) for dp, n in zip(dots, norms)]
+    elif metric == "cosine":
+        qn = math.sqrt(qsq) + 1e-12
+        scores = [_dot_py(q, v) / (qn * (math.sqrt(_dot_py(v, v)) + 1e-12)) for v in rows]
+    elif metric == "dot":
+        scores = [_dot_py(q, v) for v in rows]
+    else:
+        scores = [-math.dist(q, v) for v in rows]
+    result: Any = scores
+    if top_k is not None:
+        best = heapq.nlargest(top_k, range(len(scores)), key=scores.__getitem__)
+        result = (best, [scores[i] for i in best])
+
+    extra = {
+        "metric": metric,
+        "query_dim": d,
+        "num_dataset": len(rows),
+        "dataset_dim": d,
+    }
+    if verbose >= 1:
+        print(f"Compared query against {extra['num_dataset']} embeddings using {metric} (no NumPy)")
+    return result, extra
+
+
+def benchmark_pure_python_similarity(n: int = 5000, dim: int = 256, n_queries: int = 5, seed: int = DEFAULT_RANDOM_SEED):
+    """
+    Times repeated pure-Python queries: the previous generator-expression
+    implementation (renormalising every row per query) vs `PurePythonEmbeddings`
+    (prepared once). Returns a dict of seconds per query, and prints a summary.
+
+    Run with `python -m gjdutils.embeddings_openai`.
+    """
+    import random as random_
+
+    rng = random_.Random(seed)
+    dataset = [[rng.gauss(0, 1) for _ in range(dim)] for _ in range(n)]
+    queries = [[rng.gauss(0, 1) for _ in range(dim)] for _ in range(n_queries)]
+
+    def naive(q: list[float], X: list[list[float]]) -> list[float]:
+        def dot(a, b):
+            return sum(x * y for x, y in zip(a, b))
+
+        def norm(a):
+            return sum(x * x for x in a) ** 0.5
+
+        qn = norm(q) + 1e-12
+        scores = [dot(q, v) / (qn * (norm(v) + 1e-12)) for v in X]
+        return sorted(range(len(scores)), key=lambda i: -scores[i])[:10]
+
+    t0 = time.perf_counter()
+    for q in queries:
+        naive(q, dataset)
+    naive_s = (time.perf_counter() - t0) / n_queries
+
+    t0 = time.perf_counter()
+    prepared = PurePythonEmbeddings(dataset)
+    prepared.norms  # computed lazily, so force it here to time it as part of preparing
+    prepare_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for q in queries:
+        _compare_embedding_query_py(q, prepared, metric="cosine", top_k=10, verbose=0)
+    prepared_s = (time.perf_counter() - t0) / n_queries
+
+    results = {"naive_s": naive_s, "prepared_s": prepared_s, "prepare_once_s": prepare_s}
+    print(
+        f"Pure-Python cosine top-10 over {n} x {dim}: naive {naive_s * 1000:.1f} ms/query, "
+        f"prepared {prepared_s * 1000:.1f} ms/query ({naive_s / prepared_s:.1f}x faster), "
+        f"one-off preparation {prepare_s * 1000:.1f} ms"
+    )
+    return results
+
+
+def _compare_embedding_query_store(
+    query_embedding: list[float] | Any,
+    store: QuantisedEmbeddingStore,
+    metric: str,
+    top_k: Optional[int],
+    as_numpy: bool,
+    memory_budget_mb: float,
+    verbose: int,
+) -> Tuple[Any, dict[str, Any]]:
+    # a single query against a memory-mapped store, one block at a time
+    np = _import_numpy("compare_embedding_query()")
+    q = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+    if q.shape[1] != store.dim:
+        raise ValueError(f"Dim mismatch: query dim {q.shape[1]} vs dataset dim {store.dim}")
+    if metric not in ("cosine", "dot", "euclidean"):
+        raise ValueError(f"Unknown metric: {metric}")
+    _, n_block = _block_sizes(1, len(store), store.dim, memory_budget_mb=memory_budget_mb)
+    scores: Any
+    if top_k is not None:
+        (idxs, top_scores), _ = compare_embedding_queries(
+            q, store, metric=metric, top_k=top_k, memory_budget_mb=memory_budget_mb
+        )
+        idxs, top_scores = idxs[0], top_scores[0]
+        scores = (idxs, top_scores) if as_numpy else (idxs.tolist(), top_scores.tolist())
+    else:
+        scores_arr = np.empty(len(store), dtype=np.float32)
+        for start in range(0, len(store), n_block):
+            end = min(len(store), start + n_block)
+            scores_arr[start:end] = store.block_scores(q, start, end, metric=metric)[0]
+        scores = scores_arr if as_numpy else scores_arr.tolist()
+    extra = {
+        "metric": metric,
+        "query_dim": int(q.shape[1]),
+        "num_dataset": len(store),
+        "dataset_dim": store.dim,
+    }
+    if verbose >= 1:
+        print(f"Compared query against {extra['num_dataset']} stored embeddings using {metric}")
+    return scores, extra
+
+
+def compare_embedding_queries(
+    query_embeddings: list[list[float]] | Any,
+    dataset_embeddings: list[list[float]] | Any,
+    metric: str = "cosine",
+    top_k: int = 10,
+    memory_budget_mb: float = 256,
+    verbose: int = 0,
+) -> Tuple[Any, dict[str, Any]]:
+    """
+    Batched version of `compare_embedding_query`: scores many queries (Q, D) against
+    the same dataset (N, D) and returns the TOP_K matches per query. The dataset
+    can also be a memory-mapped `QuantisedEmbeddingStore`.
+
+    Scores are computed as blocked matrix-matrix products, with block sizes chosen
+    so that the working memory stays within roughly MEMORY_BUDGET_MB. The full
+    (Q, N) score matrix is never materialised - each block's top-k is merged into
+    a running top-k per query.
+
+    Requires NumPy (`pip install gjdutils[dsci]`).
+
+    Returns:
+        ((indices, scores), extra) where indices is an int64 array (Q, k) of dataset
+        rows and scores a float32 array (Q, k), both best-first per query.
+
+    Example:
+        >>> (idxs, scores), extra = compare_embedding_queries(Q, X, top_k=10, memory_budget_mb=512)
+        >>> idxs[0]  # best 10 dataset rows for the first query
+    """
+    np = _import_numpy("compare_embedding_queries()")
+    if top_k < 1:
+        raise ValueError(f"top_k must be a positive int, got {top_k}")
+    if metric not in ("cosine", "dot", "euclidean"):
+        raise ValueError(f"Unknown metric: {metric}")
+    Q = np.asarray(query_embeddings, dtype=np.float32)
+    if isinstance(dataset_embeddings, QuantisedEmbeddingStore):
+        X = dataset_embeddings
+    else:
+        X = np.asarray(dataset_embeddings, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError("dataset_embeddings must be 2D (N, D)")
+    if Q.ndim != 2:
+        raise ValueError("query_embeddings must be 2D (Q, D)")
+    if X.shape[1] != Q.shape[1]:
+        raise ValueError(f"Dim mismatch: query dim {Q.shape[1]} vs dataset dim {X.shape[1]}")
+
+    def block_scores(Qb, start: int, end: int):
+        if isinstance(X, QuantisedEmbeddingStore):
+            return X.block_scores(Qb, start, end, metric=metric)
+        return _block_scores(Qb, X[start:end], metric=metric)
+
+    q_block, n_block = _block_sizes(Q.shape[0], X.shape[0], X.shape[1], memory_budget_mb)
+    idxs, scores = _blocked_top_k(
+        Q, X.shape[0], block_scores, k=top_k, q_block=q_block, n_block=n_block
+    )
+    extra = {
+        "metric": metric,
+        "query_dim": int(Q.shape[1]),
+        "num_queries": int(Q.shape[0]),
+        "num_dataset": int(X.shape[0]),
+        "dataset_dim": int(X.shape[1]),
+        "top_k": top_k,
+        "query_block_size": q_block,
+        "dataset_block_size": n_block,
+    }
+    if verbose >= 1:
+        print(
+            f"Compared {extra['num_queries']} queries against {extra['num_dataset']} embeddings "
+            f"using {metric}, in blocks of {q_block}x{n_block}"
+        )
+    return (idxs, scores), extra
+
+
+def _block_scores(Qb, Xb, metric: str):
+    """(q, D) queries against a (n, D) block of raw rows -> (q, n) float32 scores."""
+    np = _import_numpy("_block_scores()")
+    if metric == "cosine":
+        Qn = Qb / (np.linalg.norm(Qb, axis=1, keepdims=True) + 1e-12)
+        Xn = Xb / (np.linalg.norm(Xb, axis=1, keepdims=True) + 1e-12)
+        return Qn @ Xn.T
+    elif metric == "dot":
+        return Qb @ Xb.T
+    elif metric == "euclidean":
+        sq = (
+            np.sum(Qb * Qb, axis=1)[:, None]
+            + np.sum(Xb * Xb, axis=1)[None, :]
+            - 2 * (Qb @ Xb.T)
+        )
+        return -np.sqrt(np.maximum(sq, 0))
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+
+
+def _block_sizes(n_queries: int, n_rows: int, dim: int, memory_budget_mb: float) -> Tuple[int, int]:
+    """
+    Picks (query block, dataset block) sizes so that one block's scores plus its
+    float32 temporaries (roughly 3 score-sized arrays and 2 copies of the rows)
+    fit in MEMORY_BUDGET_MB.
+    """
+    assert memory_budget_mb > 0, f"memory_budget_mb must be positive, got {memory_budget_mb}"
+    budget_bytes = memory_budget_mb * 1024**2
+    q_block = max(1, min(n_queries, 1024))
+    bytes_per_row = 4 * (3 * q_block + 2 * dim)
+    n_block = int(max(1, min(n_rows, budget_bytes // bytes_per_row)))
+    return q_block, n_block
+
+
+def _blocked_top_k(
+    Q,
+    n_rows: int,
+    block_scores: Callable[[Any, int, int], Any],
+    k: int,
+    q_block: int,
+    n_block: int,
+):
+    """
+    Running top-K per query over row blocks [start, end) of a dataset of N_ROWS,
+    where BLOCK_SCORES(Qb, start, end) returns the (len(Qb), end - start) scores.
+    Returns (indices (Q, k), scores (Q, k)), best-first.
+    """
+    np = _import_numpy("_blocked_top_k()")
+    k = min(k, n_rows)
+    n_queries = Q.shape[0]
+    all_idxs = np.empty((n_queries, k), dtype=np.int64)
+    all_scores = np.empty((n_queries, k), dtype=np.float32)
+    for q_start in range(0, n_queries, q_block):
+        Qb = Q[q_start : q_start + q_block]
+        best_idxs = np.empty((Qb.shape[0], 0), dtype=np.int64)
+        best_scores = np.empty((Qb.shape[0], 0), dtype=np.float32)
+        for start in range(0, n_rows, n_block):
+            end = min(n_rows, start + n_block)
+            S = block_scores(Qb, start, end).astype(np.float32, copy=False)
+            block_idxs, block_top = _top_k_numpy(S, k)
+            cand_idxs = np.concatenate([best_idxs, block_idxs + start], axis=1)
+            cand_scores = np.concatenate([best_scores, block_top], axis=1)
+            order, best_scores = _top_k_numpy(cand_scores, k)
+            best_idxs = np.take_along_axis(cand_idxs, order, axis=1)
+        all_idxs[q_start : q_start + Qb.shape[0]] = best_idxs
+        all_scores[q_start : q_start + Qb.shape[0]] = best_scores
+    return all_idxs, all_scores
+
+
+def _top_k_numpy(scores, k: int):
+    """
+    Returns (indices, scores) of the K largest SCORES along the last axis, sorted
+    best-first, in O(N + k log k) via `np.argpartition`. Works for 1D (N,) or
+    batched 2D (Q, N) scores.
+    """
+    import numpy as np
+
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k == 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64), scores[..., :0]
+    if k < n:
+        idxs = np.argpartition(scores, n - k, axis=-1)[..., n - k :]
+    else:
+        idxs = np.broadcast_to(np.arange(n), scores.shape).copy()
+    top_scores = np.take_along_axis(scores, idxs, axis=-1)
+    order = np.argsort(-top_scores, axis=-1, kind="stable")
+    return np.take_along_axis(idxs, order, axis=-1), np.take_along_axis(top_scores, order, axis=-1)
+
+
+def _import_numpy(what: str):
+    try:
+        import numpy as np  # type: ignore
+    except Exception as e:  # pragma: no cover - error path
+        raise ImportError(
+            f"NumPy is required for {what}. Install with 'pip install gjdutils[dsci]'"
+        ) from e
+    return np
+
+
+class EmbeddingIndex:
+    """
+    In-memory embedding index for repeated queries against the same dataset.
+
+    Stores a contiguous float32 matrix of unit-normalised rows plus each row's
+    original norm, computed once on `add`, so a query costs a single
+    matrix-vector product rather than re-normalising the dataset every time
+    (as `compare_embedding_query` must). All three metrics are derived from the
+    stored unit rows and norms.
+
+    Requires NumPy (`pip install gjdutils[dsci]`).
+
+    Example:
+        >>> index = EmbeddingIndex()
+        >>> index.add(["doc1", "doc2", "doc3"], embeddings)
+        >>> ids, scores = index.search(query_embedding, k=2)  # best-first
+        >>> ids_per_query, scores = index.search(query_matrix, k=2)  # (Q, D) -> Q results
+        >>> index.remove(["doc2"])
+    """
+
+    def __init__(self, dim: Optional[int] = None):
+        np = _import_numpy("EmbeddingIndex")
+        self.dim = dim
+        self._ids: list[Any] = []
+        self._row_from_id: dict[Any, int] = {}
+        # over-allocated buffers, so repeated `add`s are amortised O(1) per row
+        self._unit = np.empty((0, dim or 0), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, id_) -> bool:
+        return id_ in self._row_from_id
+
+    @property
+    def ids(self) -> list[Any]:
+        return list(self._ids)
+
+    @property
+    def unit_embeddings(self):
+        """(N, D) float32 view of the unit-normalised rows (don't modify in place)."""
+        return self._unit[: len(self._ids)]
+
+    @property
+    def norms(self):
+        """(N,) float32 view of the original row norms."""
+        return self._norms[: len(self._ids)]
+
+    def add(self, ids: list[Any], embeddings: list[list[float]] | Any):
+        """
+        Adds EMBEDDINGS (N, D) under IDS (any hashable, unique across the index).
+        """
+        np = _import_numpy("EmbeddingIndex")
+        X = np.asarray(embeddings, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError("embeddings must be 2D (N, D)")
+        if len(ids) != X.shape[0]:
+            raise ValueError(f"Got {len(ids)} ids for {X.shape[0]} embeddings")
+        if self.dim is None:
+            self.dim = int(X.shape[1])
+            self._unit = np.empty((0, self.dim), dtype=np.float32)
+        if X.shape[1] != self.dim:
+            raise ValueError(f"Dim mismatch: index dim {self.dim} vs embeddings dim {X.shape[1]}")
+        if len(set(ids)) != len(ids):
+            raise ValueError("ids must be unique")
+        already = [i for i in ids if i in self._row_from_id]
+        if already:
+            raise ValueError(f"{len(already)} ids already in the index, e.g. {already[0]!r}")
+
+        n_old, n_new = len(self._ids), len(self._ids) + X.shape[0]
+        if n_new > self._unit.shape[0]:
+            capacity = max(n_new, 2 * self._unit.shape[0])
+            unit = np.empty((capacity, self.dim), dtype=np.float32)
+            unit[:n_old] = self._unit[:n_old]
+            norms = np.empty(capacity, dtype=np.float32)
+            norms[:n_old] = self._norms[:n_old]
+            self._unit, self._norms = unit, norms
+        norms_new = np.linalg.norm(X, axis=1)
+        self._norms[n_old:n_new] = norms_new
+        self._unit[n_old:n_new] = X / (norms_new[:, None] + 1e-12)
+        for row, id_ in enumerate(ids, start=n_old):
+            self._row_from_id[id_] = row
+        self._ids.extend(ids)
+
+    def remove(self, ids: list[Any]):
+        """
+        Removes IDS from the index (raises KeyError if any are missing).
+        Remaining rows are compacted, so this is O(N·D).
+        """
+        np = _import_numpy("EmbeddingIndex")
+        missing = [i for i in ids if i not in self._row_from_id]
+        if missing:
+            raise KeyError(f"{len(missing)} ids not in the index, e.g. {missing[0]!r}")
+        n = len(self._ids)
+        keep = np.ones(n, dtype=bool)
+        keep[[self._row_from_id[i] for i in ids]] = False
+        n_keep = int(keep.sum())
+        self._unit[:n_keep] = self._unit[:n][keep]
+        self._norms[:n_keep] = self._norms[:n][keep]
+        self._ids = [id_ for id_, k in zip(self._ids, keep) if k]
+        self._row_from_id = {id_: row for row, id_ in enumerate(self._ids)}
+
+    def get(self, id_) -> Any:
+        """Returns the (float32) embedding stored for ID_."""
+        row = self._row_from_id[id_]
+        return self._unit[row] * self._norms[row]
+
+    def scores(self, query: list[float] | Any, metric: str = "cosine"):
+        """
+        Similarity of QUERY (D,) or queries (Q, D) to every row, as a NumPy array
+        of shape (N,) or (Q, N). Same metrics as `compare_embedding_query`
+        (higher is always more similar).
+        """
+        Q = self._as_queries(query)
+        return self._row_scores(Q, 0, len(self._ids), metric=metric)
+
+    def search(
+        self,
+        query: list[float] | Any,
+        k: int = 10,
+        metric: str = "cosine",
+        memory_budget_mb: float = 256,
+    ):
+        """
+        Returns the K best matches for QUERY, best-first:
+            - for a single query (D,): (ids, scores), a list of ids and a (k,) array
+            - for a batch of queries (Q, D): (list of Q lists of ids, (Q, k) array)
+
+        Batches of queries are scored in blocks (see `compare_embedding_queries`),
+        so the (Q, N) score matrix is never materialised.
+        """
+        if k < 1:
+            raise ValueError(f"k must be a positive int, got {k}")
+        if metric not in ("cosine", "dot", "euclidean"):
+            raise ValueError(f"Unknown metric: {metric}")
+        Q = self._as_queries(query)
+        if Q.ndim == 1:
+            idxs, top_scores = _top_k_numpy(self._row_scores(Q, 0, len(self._ids), metric=metric), k)
+            return [self._ids[i] for i in idxs], top_scores
+
+        def block_scores(Qb, start: int, end: int):
+            return self._row_scores(Qb, start, end, metric=metric)
+
+        q_block, n_block = _block_sizes(Q.shape[0], len(self._ids), self.dim, memory_budget_mb)  # type: ignore[arg-type]
+        idxs, top_scores = _blocked_top_k(
+            Q, len(self._ids), block_scores, k=k, q_block=q_block, n_block=n_block
+        )
+        return [[self._ids[i] for i in row] for row in idxs], top_scores
+
+    def _as_queries(self, query: list[float] | Any):
+        np = _import_numpy("EmbeddingIndex")
+        Q = np.asarray(query, dtype=np.float32)
+        if Q.ndim not in (1, 2):
+            raise ValueError("query must be 1D (D,) or 2D (Q, D)")
+        if Q.shape[-1] != self.dim:
+            raise ValueError(f"Dim mismatch: query dim {Q.shape[-1]} vs index dim {self.dim}")
+        return Q
+
+    def _row_scores(self, Q, start: int, end: int, metric: str):
+        # scores of (D,) or (Q, D) queries against rows [start, end)
+        np = _import_numpy("EmbeddingIndex")
+        U, norms = self._unit[start:end], self._norms[start:end]
+        q_norms = np.linalg.norm(Q, axis=-1, keepdims=True)
+        if metric == "cosine":
+            return (Q / (q_norms + 1e-12)) @ U.T
+        elif metric == "dot":
+            return (Q @ U.T) * norms
         elif metric == "euclidean":
-            def dist(a: list[float], b: list[float]) -> float:
-                return sum((x - y) ** 2 for x, y in zip(a, b)) ** 0.5
-            scores = [-dist(query_embedding, v) for v in dataset_embeddings]
+            # |x - q|^2 = |x|^2 + |q|^2 - 2 x.q, with x.q from the unit rows
+            dots = (Q @ U.T) * norms
+            sq = norms**2 + q_norms**2 - 2 * dots
+            return -np.sqrt(np.maximum(sq, 0))
         else:
             raise ValueError(f"Unknown metric: {metric}")
 
-        extra = {
-            "metric": metric,
-            "query_dim": d,
-            "num_dataset": len(dataset_embeddings),
-            "dataset_dim": d,
-        }
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour index (inverted file, "IVF"), in pure NumPy.
+
+    The dataset is partitioned into N_LISTS clusters by spherical k-means (the
+    coarse quantiser). A query is only compared exactly against the rows in the
+    NPROBE clusters whose centroids are closest to it, so each query costs
+    roughly O((n_lists + N * nprobe / n_lists) * D) rather than O(N * D).
+    Raising NPROBE trades latency for recall - see `recall_report`.
+
+    Rows are stored contiguously, grouped by cluster. Metrics are "cosine" (rows
+    stored unit-normalised) or "dot". CPU-only, no FAISS needed.
+
+    Requires NumPy (`pip install gjdutils[dsci]`).
+
+    Example:
+        >>> index = IVFIndex.build(X, n_lists=1024)
+        >>> idxs, scores = index.search(query, k=10, nprobe=16)  # indices are rows of X
+        >>> index.save("corpus.ivf.npz"); index = IVFIndex.load("corpus.ivf.npz")
+        >>> for row in index.recall_report(X[:100], k=10): print(row)
+    """
+
+    def __init__(self, centroids, vectors, list_offsets, row_ids, metric: str = "cosine"):
+        if metric not in ("cosine", "dot"):
+            raise ValueError(f"Unknown metric for IVFIndex: {metric}")
+        self.centroids = centroids  # (n_lists, D), unit-normalised
+        self.vectors = vectors  # (N, D), grouped by list
+        self.list_offsets = list_offsets  # (n_lists + 1,), list i is rows [offsets[i], offsets[i+1])
+        self.row_ids = row_ids  # (N,), original row index of each stored row
+        self.metric = metric
+
+    def __len__(self) -> int:
+        return int(self.vectors.shape[0])
+
+    @property
+    def n_lists(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @property
+    def dim(self) -> int:
+        return int(self.vectors.shape[1])
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: list[list[float]] | Any,
+        n_lists: Optional[int] = None,
+        metric: str = "cosine",
+        n_iter: int = 20,
+        sample_size: Optional[int] = None,
+        seed: int = DEFAULT_RANDOM_SEED,
+        verbose: int = 0,
+    ) -> "IVFIndex":
+        """
+        Trains the coarse quantiser on a sample of EMBEDDINGS (N, D) and assigns
+        every row to its nearest centroid.
+
+        Args:
+            n_lists: Number of clusters. Defaults to ~4 * sqrt(N).
+            n_iter: k-means iterations.
+            sample_size: Rows used to train the centroids. Defaults to 256 per list
+                (capped at N), which is plenty for the coarse quantiser.
+        """
+        np = _import_numpy("IVFIndex")
+        X = np.asarray(embeddings, dtype=np.float32)
+        if X.ndim != 2 or X.shape[0] == 0:
+            raise ValueError("embeddings must be a non-empty 2D (N, D) array")
+        n = X.shape[0]
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        Xn = X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)
+
+        rng = np.random.default_rng(seed)
+        if sample_size is None:
+            sample_size = 256 * n_lists
+        sample = Xn[rng.choice(n, size=min(n, sample_size), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)].copy()
+        for it in range(n_iter):
+            assign = _nearest_centroids(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=n_lists)
+            empty = counts == 0
+            # re-seed empty clusters from random sample rows
+            sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+            centroids = sums / (np.linalg.norm(sums, axis=1, keepdims=True) + 1e-12)
+            if verbose >= 2:
+                print(f"IVF k-means iteration {it + 1}/{n_iter}: {int(empty.sum())} empty lists")
+
+        assign = _nearest_centroids(Xn, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=n_lists)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        vectors = (Xn if metric == "cosine" else X)[order]
         if verbose >= 1:
-            print(f"Compared query against {extra['num_dataset']} embeddings using {metric} (no NumPy)")
-        return scores, extra
+            print(
+                f"Built IVF index: {n} rows, {n_lists} lists "
+                f"(sizes {int(counts.min())}-{int(counts.max())}), metric={metric}"
+            )
+        return cls(centroids, np.ascontiguousarray(vectors), list_offsets, order.astype(np.int64), metric=metric)
+
+    def search(self, query: list[float] | Any, k: int = 10, nprobe: int = 8):
+        """
+        Returns (indices, scores) of the (approximately) K best rows, best-first,
+        where indices refer to rows of the original embeddings: arrays of shape
+        (k,) for a single query (D,), or (Q, k) for a batch (Q, D). If fewer than
+        K rows live in the probed lists, the remainder are padded with -1 / -inf.
+        """
+        np = _import_numpy("IVFIndex")
+        if k < 1:
+            raise ValueError(f"k must be a positive int, got {k}")
+        Q = np.asarray(query, dtype=np.float32)
+        single = Q.ndim == 1
+        Q = Q.reshape(-1, self.dim)
+        nprobe = max(1, min(nprobe, self.n_lists))
+        Qn = Q / (np.linalg.norm(Q, axis=1, keepdims=True) + 1e-12)
+        probe_lists, _ = _top_k_numpy(Qn @ self.centroids.T, nprobe)
+
+        all_idxs = np.full((Q.shape[0], k), -1, dtype=np.int64)
+        all_scores = np.full((Q.shape[0], k), -np.inf, dtype=np.float32)
+        for qi in range(Q.shape[0]):
+            rows = np.concatenate(
+                [np.arange(self.list_offsets[li], self.list_offsets[li + 1]) for li in probe_lists[qi]]
+            )
+            if rows.size == 0:
+                continue
+            q = Qn[qi] if self.metric == "cosine" else Q[qi]
+            idxs, scores = _top_k_numpy(self.vectors[rows] @ q, k)
+            all_idxs[qi, : len(idxs)] = self.row_ids[rows[idxs]]
+            all_scores[qi, : len(idxs)] = scores
+        if single:
+            return all_idxs[0], all_scores[0]
+        return all_idxs, all_scores
+
+    def recall_report(
+        self,
+        queries: list[list[float]] | Any,
+        k: int = 10,
+        nprobes: Iterable[int] = (1, 2, 4, 8, 16, 32, 64),
+        verbose: int = 0,
+    ) -> list[dict[str, Any]]:
+        """
+        Compares approximate search against exact brute-force search over the same
+        stored vectors, for each NPROBE. Returns one dict per nprobe with
+        recall@k (fraction of the exact top-k found) and mean per-query latency,
+        plus a final "exact" row for the brute-force baseline latency.
+        """
+        np = _import_numpy("IVFIndex")
+        Q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        metric = "cosine" if self.metric == "cosine" else "dot"
+        t0 = time.perf_counter()
+        (exact_rows, _), _ = compare_embedding_queries(Q, self.vectors, metric=metric, top_k=k)
+        exact_ms = (time.perf_counter() - t0) * 1000 / Q.shape[0]
+        exact_idxs = self.row_ids[exact_rows]
+
+        report = []
+        for nprobe in nprobes:
+            t0 = time.perf_counter()
+            approx_idxs, _ = self.search(Q, k=k, nprobe=nprobe)
+            ms = (time.perf_counter() - t0) * 1000 / Q.shape[0]
+            hits = sum(
+                len(set(a.tolist()) & set(e.tolist())) for a, e in zip(approx_idxs, exact_idxs)
+            )
+            row = {
+                "nprobe": min(nprobe, self.n_lists),
+                "recall": hits / exact_idxs.size,
+                "latency_ms": ms,
+            }
+            report.append(row)
+            if verbose >= 1:
+                print(f"nprobe={row['nprobe']:>4}  recall@{k}={row['recall']:.3f}  {ms:.2f} ms/query")
+        report.append({"nprobe": "exact", "recall": 1.0, "latency_ms": exact_ms})
+        if verbose >= 1:
+            print(f"exact        recall@{k}=1.000  {exact_ms:.2f} ms/query")
+        return report
+
+    def save(self, filen: str | Path):
+        """Saves the index as a single .npz file."""
+        np = _import_numpy("IVFIndex")
+        np.savez(
+            filen,
+            centroids=self.centroids,
+            vectors=self.vectors,
+            list_offsets=self.list_offsets,
+            row_ids=self.row_ids,
+            metric=np.array(self.metric),
+        )
+
+    @classmethod
+    def load(cls, filen: str | Path) -> "IVFIndex":
+        np = _import_numpy("IVFIndex")
+        with np.load(filen) as d:
+            return cls(
+                d["centroids"], d["vectors"], d["list_offsets"], d["row_ids"], metric=str(d["metric"])
+            )
+
+
+def _nearest_centroids(Xn, centroids, memory_budget_mb: float = 256):
+    # index of the most similar (unit) centroid for each (unit) row, in blocks
+    # (a plain argmax, which is much cheaper than the general top-k path)
+    np = _import_numpy("IVFIndex")
+    n_block = max(1, int(memory_budget_mb * 1024**2 // (4 * (centroids.shape[0] + Xn.shape[1]))))
+    assign = np.empty(Xn.shape[0], dtype=np.int64)
+    for start in range(0, Xn.shape[0], n_block):
+        assign[start : start + n_block] = np.argmax(Xn[start : start + n_block] @ centroids.T, axis=1)
+    return assign
+
+
+class BinaryQuantisedIndex:
+    """
+    Two-stage search: a cheap scan over sign bits, then exact rerank.
+
+    Each embedding is reduced to one bit per dimension (its sign), packed with
+    `np.packbits` - 32x smaller than float32. A query is first ranked against
+    every row by Hamming distance (XOR + popcount lookup table), and only the
+    best N_CANDIDATES are then rescored exactly with `compare_embedding_query`
+    against the full-precision embeddings.
+
+    The full-precision embeddings are kept by reference (not copied if they're
+    already float32), so they can be an `np.memmap` that mostly stays on disk.
+
+    Requires NumPy (`pip install gjdutils[dsci]`).
+
+    Example:
+        >>> index = BinaryQuantisedIndex(X)
+        >>> idxs, scores = index.search(query, k=10, n_candidates=300)
+    """
+
+    def __init__(self, embeddings: list[list[float]] | Any, memory_budget_mb: float = 64):
+        np = _import_numpy("BinaryQuantisedIndex")
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.embeddings.ndim != 2:
+            raise ValueError("embeddings must be 2D (N, D)")
+        self.memory_budget_mb = memory_budget_mb
+        n, dim = self.embeddings.shape
+        self.bits = np.empty((n, (dim + 7) // 8), dtype=np.uint8)
+        block = self._block_rows()
+        for start in range(0, n, block):
+            self.bits[start : start + block] = np.packbits(self.embeddings[start : start + block] > 0, axis=1)
+
+    def __len__(self) -> int:
+        return int(self.bits.shape[0])
+
+    @property
+    def dim(self) -> int:
+        return int(self.embeddings.shape[1])
+
+    def _block_rows(self) -> int:
+        # rows per block, for a (rows, D) boolean or (rows, D/8) XOR temporary
+        return max(1, int(self.memory_budget_mb * 1024**2 // max(1, self.embeddings.shape[1])))
+
+    def hamming(self, query: list[float] | Any):
+        """(N,) Hamming distances between QUERY's sign bits and every row's."""
+        np = _import_numpy("BinaryQuantisedIndex")
+        q = np.asarray(query, dtype=np.float32).reshape(-1)
+        if q.shape[0] != self.dim:
+            raise ValueError(f"Dim mismatch: query dim {q.shape[0]} vs index dim {self.dim}")
+        q_bits = np.packbits(q > 0)
+        dists = np.empty(len(self), dtype=np.uint16)
+        lut = _popcount_lut()
+        block = self._block_rows()
+        for start in range(0, len(self), block):
+            xor = np.bitwise_xor(self.bits[start : start + block], q_bits)
+            dists[start : start + block] = lut[xor].sum(axis=1, dtype=np.uint16)
+        return dists
+
+    def search(
+        self,
+        query: list[float] | Any,
+        k: int = 10,
+        n_candidates: int = 200,
+        metric: str = "cosine",
+    ):
+        """
+        Returns (indices, scores) of the K best rows, best-first, with exact scores
+        for the chosen METRIC (as in `compare_embedding_query`): arrays of shape
+        (k,) for a single query (D,), or (Q, k) for a batch (Q, D).
+        """
+        np = _import_numpy("BinaryQuantisedIndex")
+        if k < 1:
+            raise ValueError(f"k must be a positive int, got {k}")
+        Q = np.asarray(query, dtype=np.float32)
+        single = Q.ndim == 1
+        Q = Q.reshape(-1, self.dim)
+        n_candidates = max(k, n_candidates)
+        k = min(k, len(self))
+        all_idxs = np.empty((Q.shape[0], k), dtype=np.int64)
+        all_scores = np.empty((Q.shape[0], k), dtype=np.float32)
+        for qi, q in enumerate(Q):
+            # smallest Hamming distance first
+            cands, _ = _top_k_numpy(-self.hamming(q).astype(np.int32), n_candidates)
+            cands = np.sort(cands)  # sequential reads, in case embeddings is a memmap
+            (idxs, scores), _ = compare_embedding_query(
+                q, self.embeddings[cands], metric=metric, top_k=k, as_numpy=True
+            )
+            all_idxs[qi], all_scores[qi] = cands[idxs], scores
+        if single:
+            return all_idxs[0], all_scores[0]
+        return all_idxs, all_scores
+
+
+@lru_cache(maxsize=1)
+def _popcount_lut():
+    # number of set bits in each possible byte
+    np = _import_numpy("BinaryQuantisedIndex")
+    return np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def mmr_rerank(
+    query_embedding: list[float] | Any,
+    dataset_embeddings: list[list[float]] | Any,
+    k: int = 10,
+    lambda_mult: float = 0.5,
+    candidates: Optional[list[Any]] = None,
+    verbose: int = 0,
+) -> Tuple[Tuple[list[Any], list[float]], dict[str, Any]]:
+    """
+    Maximal-marginal-relevance reranking, for top-K results that are relevant but
+    not redundant. Greedily picks the candidate maximising
+
+        lambda_mult * cos(query, d) - (1 - lambda_mult) * max_{s in selected} cos(d, s)
+
+    Keeps a running max-similarity-to-selected vector over the candidates, updated
+    with one matrix-vector product per selected item, so it's O(k * N * D) in NumPy
+    rather than an interpreted loop.
+
+    Args:
+        query_embedding: (D,) query.
+        dataset_embeddings: (N, D) embeddings, or an `EmbeddingIndex` (which reuses
+            its precomputed unit rows).
+        k: Number of results to select.
+        lambda_mult: 1.0 is pure relevance (plain top-k), 0.0 is pure diversity.
+        candidates: Optional subset to rerank (e.g. the top 100 from a first-pass
+            search) - row indices, or ids for an `EmbeddingIndex`. Defaults to all.
+
+    Returns:
+        ((selected, mmr_scores), extra), selected in pick order - row indices, or
+        ids for an `EmbeddingIndex`. extra["relevance"] holds each selected item's
+        cosine similarity to the query.
+
+    Example:
+        >>> ids, _ = index.search(q, k=100)
+        >>> (diverse_ids, _), extra = mmr_rerank(q, index, k=10, candidates=ids)
+    """
+    np = _import_numpy("mmr_rerank()")
+    if k < 1:
+        raise ValueError(f"k must be a positive int, got {k}")
+    if not 0.0 <= lambda_mult <= 1.0:
+        raise ValueError(f"lambda_mult must be in [0, 1], got {lambda_mult}")
+
+    if isinstance(dataset_embeddings, EmbeddingIndex):
+        index = dataset_embeddings
+        if candidates is None:
+            rows = np.arange(len(index))
+        else:
+            rows = np.array([index._row_from_id[c] for c in candidates], dtype=np.int64)
+        U = index.unit_embeddings[rows]
+        labels = [index._ids[r] for r in rows]
+    else:
+        X = np.asarray(dataset_embeddings, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError("dataset_embeddings must be 2D (N, D)")
+        rows = np.arange(X.shape[0]) if candidates is None else np.asarray(candidates, dtype=np.int64)
+        Xc = X[rows]
+        U = Xc / (np.linalg.norm(Xc, axis=1, keepdims=True) + 1e-12)
+        labels = rows.tolist()
+
+    q = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    if q.shape[0] != U.shape[1]:
+        raise ValueError(f"Dim mismatch: query dim {q.shape[0]} vs dataset dim {U.shape[1]}")
+    relevance = U @ (q / (np.linalg.norm(q) + 1e-12))
+    max_sim = np.full(U.shape[0], -np.inf, dtype=np.float32)
+    available = np.ones(U.shape[0], dtype=bool)
+    selected, mmr_scores = [], []
+    for _ in range(min(k, U.shape[0])):
+        # nothing selected yet -> no redundancy penalty
+        penalty = np.where(np.isfinite(max_sim), max_sim, 0.0)
+        mmr = lambda_mult * relevance - (1 - lambda_mult) * penalty
+        mmr[~available] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        mmr_scores.append(float(mmr[best]))
+        available[best] = False
+        np.maximum(max_sim, U @ U[best], out=max_sim)
+
+    extra = {
+        "lambda_mult": lambda_mult,
+        "num_candidates": int(U.shape[0]),
+        "relevance": relevance[selected].tolist(),
+    }
+    if verbose >= 1:
+        print(f"MMR selected {len(selected)} of {extra['num_candidates']} candidates (lambda={lambda_mult})")
+    return ([labels[i] for i in selected], mmr_scores), extra
+
+
+def find_similar_pairs(
+    embeddings: list[list[float]] | Any,
+    threshold: float = 0.95,
+    block_size: int = 2048,
+    n_jobs: int = 1,
+    verbose: int = 0,
+) -> Tuple[Tuple[Any, Any, Any], dict[str, Any]]:
+    """
+    Similarity self-join: every pair of rows (i < j) with cosine similarity >= THRESHOLD.
+
+    Computed as blocked matrix products over the upper triangle of the (N, N)
+    similarity matrix, so memory stays at roughly BLOCK_SIZE^2 floats per worker
+    and the full matrix is never materialised. It's still O(N^2 * D) work, so use
+    N_JOBS > 1 to spread the row blocks over a process pool. The workers share
+    the normalised embeddings via a temporary memory-mapped .npy file, rather
+    than each getting its own copy.
+
+    Requires NumPy (`pip install gjdutils[dsci]`).
+
+    Returns:
+        ((i, j, scores), extra) as NumPy arrays, with i < j.
+
+    Example:
+        >>> (i, j, scores), extra = find_similar_pairs(X, threshold=0.95, n_jobs=8)
+    """
+    np = _import_numpy("find_similar_pairs()")
+    X = np.asarray(embeddings, dtype=np.float32)
+    if X.ndim != 2:
+        raise ValueError("embeddings must be 2D (N, D)")
+    assert block_size >= 1 and n_jobs >= 1
+    U = X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)
+    starts = list(range(0, U.shape[0], block_size))
+
+    if n_jobs == 1 or len(starts) == 1:
+        results = [_similar_pairs_for_block(U, start, block_size, threshold) for start in starts]
+    else:
+        # one copy on disk, paged in via the OS cache shared by all the workers,
+        # rather than pickling the whole matrix into each of them
+        with tempfile.TemporaryDirectory() as tmp_dirn:
+            U_filen = Path(tmp_dirn) / "U.npy"
+            np.save(U_filen, U)
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_self_join_worker, initargs=(str(U_filen),)
+            ) as pool:
+                results = list(
+                    pool.map(
+                        _similar_pairs_for_block_in_worker,
+                        starts,
+                        [block_size] * len(starts),
+                        [threshold] * len(starts),
+                    )
+                )
+
+    i = np.concatenate([r[0] for r in results]) if results else np.empty(0, dtype=np.int64)
+    j = np.concatenate([r[1] for r in results]) if results else np.empty(0, dtype=np.int64)
+    scores = np.concatenate([r[2] for r in results]) if results else np.empty(0, dtype=np.float32)
+    extra = {
+        "threshold": threshold,
+        "num_dataset": int(U.shape[0]),
+        "num_pairs": int(i.shape[0]),
+        "block_size": block_size,
+        "n_jobs": n_jobs,
+    }
+    if verbose >= 1:
+        print(f"Found {extra['num_pairs']} pairs with cosine >= {threshold} among {extra['num_dataset']} embeddings")
+    return (i, j, scores), extra
+
+
+def cluster_near_duplicates(
+    embeddings: list[list[float]] | Any,
+    threshold: float = 0.95,
+    block_size: int = 2048,
+    n_jobs: int = 1,
+    verbose: int = 0,
+) -> Tuple[list[list[int]], dict[str, Any]]:
+    """
+    Groups rows into clusters of near-duplicates: the connected components (via
+    union-find) of the graph of pairs from `find_similar_pairs`. Note that this is
+    transitive, so a chain of near-duplicates ends up in one cluster even if its
+    ends are less similar than THRESHOLD.
+
+    Returns:
+        (clusters, extra) where clusters is a list of lists of row indices, one per
+        cluster with at least 2 members, each sorted, largest clusters first.
+        Rows without any near-duplicate are left out.
+
+    Example:
+        >>> clusters, extra = cluster_near_duplicates(X, threshold=0.95, n_jobs=8)
+        >>> keep = sorted(set(range(len(X))) - {i for c in clusters for i in c[1:]})
+    """
+    (i, j, _), extra = find_similar_pairs(
+        embeddings, threshold=threshold, block_size=block_size, n_jobs=n_jobs, verbose=verbose
+    )
+    parent: dict[int, int] = {}
+
+    def find(x: int) -> int:
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]  # path halving
+            x = parent[x]
+        return x
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            # attach the larger root to the smaller, so the root is the lowest index
+            parent[max(ra, rb)] = min(ra, rb)
+
+    members: dict[int, list[int]] = {}
+    for x in parent:
+        members.setdefault(find(x), []).append(x)
+    clusters = sorted((sorted(c) for c in members.values()), key=lambda c: (-len(c), c[0]))
+    extra["num_clusters"] = len(clusters)
+    if verbose >= 1:
+        print(f"Grouped {len(parent)} rows into {len(clusters)} near-duplicate clusters")
+    return clusters, extra
+
+
+def _similar_pairs_for_block(U, start: int, block_size: int, threshold: float):
+    # pairs (i, j), i in this row block and j > i anywhere after it
+    np = _import_numpy("find_similar_pairs()")
+    Ub = U[start : start + block_size]
+    i_parts, j_parts, s_parts = [], [], []
+    for col_start in range(start, U.shape[0], block_size):
+        S = Ub @ U[col_start : col_start + block_size].T
+        if col_start == start:
+            # only j > i within the diagonal block
+            S[np.tril_indices(S.shape[0], m=S.shape[1])] = -np.inf
+        bi, bj = np.nonzero(S >= threshold)
+        i_parts.append(bi + start)
+        j_parts.append(bj + col_start)
+        s_parts.append(S[bi, bj])
+    return (
+        np.concatenate(i_parts).astype(np.int64),
+        np.concatenate(j_parts).astype(np.int64),
+        np.concatenate(s_parts).astype(np.float32),
+    )
+
+
+# set in each worker process by `_init_self_join_worker`
+_SELF_JOIN_U = None
+
+
+def _init_self_join_worker(U_filen: str):
+    global _SELF_JOIN_U
+    np = _import_numpy("find_similar_pairs()")
+    _SELF_JOIN_U = np.load(U_filen, mmap_mode="r")
+
+
+def _similar_pairs_for_block_in_worker(start: int, block_size: int, threshold: float):
+    return _similar_pairs_for_block(_SELF_JOIN_U, start, block_size, threshold)
 
 
 __all__ = [
     "get_openai_embeddings",
+    "get_openai_embeddings_bulk",
+    "aget_openai_embeddings",
+    "embedding_cache_key",
+    "estimate_num_tokens",
+    "batch_by_size",
+    "call_with_backoff",
+    "acall_with_backoff",
     "convert_to_numpy",
+    "write_quantised_embeddings",
+    "QuantisedEmbeddingStore",
     "compare_embedding_query",
+    "PurePythonEmbeddings",
+    "benchmark_pure_python_similarity",
+    "compare_embedding_queries",
+    "EmbeddingIndex",
+    "IVFIndex",
+    "BinaryQuantisedIndex",
+    "mmr_rerank",
+    "find_similar_pairs",
+    "cluster_near_duplicates",
 ]
 
 
+if __name__ == "__main__":
+    benchmark_pure_python_similarity()
@@ -1,12 +1,17 @@
-from google.cloud import translate_v2 as translate
 import html
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
+
+from gjdutils.api_clients import get_google_translate_client
+
+if TYPE_CHECKING:
+    from google.cloud import translate_v2 as translate
 
 
 def translate_text(
     text: str,
     lang_src_code: Optional[str],
     lang_tgt_code: str,
+    client: Optional["translate.Client"] = None,
     verbose: int = 0,
 ):
     """Translates text into the target language.
@@ -22,7 +27,7 @@ def translate_text(
             verbose=0,
         )
     """
-    translate_client = translate.Client()
+    translate_client = client if client is not None else get_google_translate_client()
 
     lang_src_code = (
         lang_src_code[:2].lower() if isinstance(lang_src_code, str) else None
@@ -63,11 +68,13 @@ def translate_text(
     return translated_text, result
 
 
-def detect_language(text: str, verbose: int = 0) -> tuple[str, dict]:
+def detect_language(
+    text: str, client: Optional["translate.Client"] = None, verbose: int = 0
+) -> tuple[str, dict]:
     """
     Detects the text's language.
     """
-    translate_client = translate.Client()
+    translate_client = client if client is not None else get_google_translate_client()
 
     # Text can also be a sequence of strings, in which case this method
     # will return a sequence of results for each text.
@@ -1,57 +1,268 @@
 import base64
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import io
-from typing import Optional
+import json
+import os
+import threading
+from typing import Callable, Optional, Sequence
 
+from gjdutils.caching import SqliteCache
 
-def image_to_base64_resized(image_full_filen: str, resize_target_size_kb: int = 100):
+
+class ImagePayloadCache:
+    """
+    Cache of prepared (resized and base64-encoded) image payloads, so sending the
+    same image with many prompts only does the image work once.
+
+    Keyed on (absolute path, file size, mtime, target size, encoding), so an
+    edited file is a miss. Lookups go to an in-memory LRU tier (bounded by
+    MAX_MEMORY_BYTES) and then to the optional DISK tier, which also persists
+    across processes.
+
+        configure_image_cache(disk=SqliteCache("~/.cache/gjdutils/images.sqlite"))
+    """
+
+    def __init__(
+        self,
+        disk: Optional[SqliteCache] = None,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.disk = disk
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = 0
+
+    @staticmethod
+    def key(image_filen: str, resize_target_size_kb: Optional[int], encoding: str) -> str:
+        path = os.path.abspath(image_filen)
+        st = os.stat(path)
+        payload = [path, st.st_size, st.st_mtime_ns, resize_target_size_kb, encoding]
+        return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, value: str):
+        # called with the lock held
+        if key in self._memory:
+            return
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def get(
+        self, image_filen: str, resize_target_size_kb: Optional[int], encoding: str
+    ) -> Optional[str]:
+        """The cached payload, or None (and counts a miss)."""
+        key = self.key(image_filen, resize_target_size_kb, encoding)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+        if self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None:
+                value = stored.decode("ascii")
+                self.disk_hits += 1
+                with self._lock:
+                    self._remember(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(
+        self,
+        image_filen: str,
+        resize_target_size_kb: Optional[int],
+        encoding: str,
+        value: str,
+    ):
+        key = self.key(image_filen, resize_target_size_kb, encoding)
+        if self.disk is not None:
+            self.disk.set(key, value.encode("ascii"))
+        with self._lock:
+            self._remember(key, value)
+
+    def get_or_compute(
+        self,
+        image_filen: str,
+        resize_target_size_kb: Optional[int],
+        encoding: str,
+        compute: Callable[[], str],
+    ) -> str:
+        value = self.get(image_filen, resize_target_size_kb, encoding)
+        if value is None:
+            value = compute()
+            self.set(image_filen, resize_target_size_kb, encoding, value)
+        return value
+
+    def clear(self):
+        """Empties the in-memory tier (the disk tier is left alone)."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+_image_cache = ImagePayloadCache()
+
+
+def configure_image_cache(
+    disk: Optional[SqliteCache] = None, max_memory_bytes: int = 64 * 1024 * 1024
+) -> ImagePayloadCache:
+    """Replaces the cache used by `image_to_base64` etc. (by default, memory-only)."""
+    global _image_cache
+    _image_cache = ImagePayloadCache(disk=disk, max_memory_bytes=max_memory_bytes)
+    return _image_cache
+
+
+def get_image_cache() -> ImagePayloadCache:
+    return _image_cache
+
+
+def _encode_image(img, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def image_to_base64_resized(
+    image_full_filen: str,
+    resize_target_size_kb: int = 100,
+    tolerance: float = 0.15,
+    max_encodes: int = 8,
+) -> bytes:
+    """
+    Returns the image's bytes (in its original format), downscaled if necessary
+    so they're at most RESIZE_TARGET_SIZE_KB, aiming for within TOLERANCE (as a
+    fraction) below it, so it isn't shrunk more than it needs to be.
+
+    Encoded size scales roughly with pixel count, i.e. with scale squared, so
+    each guess is estimated from the bytes-per-pixel of the previous encode, and
+    kept inside the bracket of scales known to be too big / small enough. That
+    usually lands in 2-4 encodes (counting the first, full-size one). After
+    MAX_ENCODES it settles for the best fitting attempt so far.
+
+    If it gets all the way down to 1x1 pixels without fitting (e.g. a format
+    whose headers or metadata alone are bigger than the target), it returns that
+    1x1 encoding, which is still over RESIZE_TARGET_SIZE_KB.
+
+    (Despite the name, this returns raw bytes - see `image_to_base64`.)
+    """
     from PIL import Image
 
-    # based on https://claude.ai/chat/d0eb1f39-3f42-4cb5-a2ec-5aa102c60ea0
     assert resize_target_size_kb > 0
+    assert 0 < tolerance < 1
+    target_bytes = resize_target_size_kb * 1024
+    if os.path.getsize(image_full_filen) <= target_bytes:
+        with open(image_full_filen, "rb") as f:
+            return f.read()
+
     with Image.open(image_full_filen) as img_orig:
+        img_orig.load()
+        fmt = img_orig.format
         width_orig, height_orig = img_orig.size
-        # Calculate initial file size
-        temp_buffer = io.BytesIO()
-        img_orig.save(temp_buffer, format=img_orig.format)
-        img_resized = img_orig.copy()
-        current_size_kb = len(temp_buffer.getvalue()) / 1024
-
-        # Iteratively resize until file size is below target
-        resize_factor = 0.9
-        while current_size_kb > resize_target_size_kb:
-            resize_factor *= resize_factor
-            width = int(width_orig * resize_factor)
-            height = int(height_orig * resize_factor)
-            img_resized = img_orig.resize(
-                (width, height), Image.LANCZOS  # type: ignore
-            )  #  type: ignore
-            # Check new file size
-            temp_buffer = io.BytesIO()
-            img_resized.save(temp_buffer, format=img_orig.format)
-            current_size_kb = len(temp_buffer.getvalue()) / 1024
-
-        # Convert final resized image to base64
-        img_bytes = io.BytesIO()
-        img_resized.save(img_bytes, format=img_orig.format)
-        img_buffer = img_bytes.getvalue()
-
-    return img_buffer
-
-
-def image_to_base64(img_full_filen: str, resize_target_size_kb: Optional[int] = None):
-    # from https://chat.openai.com/c/35f15af9-b947-4fa6-acbe-2a5ed26e7547
-    if resize_target_size_kb is None:
-        with open(img_full_filen, "rb") as image_file:
-            img_bytes = image_file.read()
+        current = _encode_image(img_orig, fmt)  # type: ignore[arg-type]
+        if len(current) <= target_bytes:
+            return current
+
+        lo, hi = 0.0, 1.0  # largest scale known to fit, smallest known not to
+        best: Optional[bytes] = None
+        scale, size = 1.0, len(current)
+        n_encodes = 1
+        while True:
+            # aim for the middle of the tolerance band
+            guess = scale * ((target_bytes * (1 - tolerance / 2)) / size) ** 0.5
+            if not lo < guess < hi:
+                guess = (lo + hi) / 2
+            scale = guess
+            width = max(1, round(width_orig * scale))
+            height = max(1, round(height_orig * scale))
+            img_resized = img_orig.resize((width, height), Image.LANCZOS)  # type: ignore
+            encoded = _encode_image(img_resized, fmt)  # type: ignore[arg-type]
+            n_encodes += 1
+            size = len(encoded)
+            if size <= target_bytes:
+                lo, best = scale, encoded
+                if size >= target_bytes * (1 - tolerance):
+                    return encoded
+            else:
+                hi = scale
+            if best is not None and n_encodes >= max_encodes:
+                return best
+            if width == 1 and height == 1:
+                # can't get any smaller, so return it even though it's over the target
+                return encoded
+
+
+def image_to_base64(
+    img_full_filen: str,
+    resize_target_size_kb: Optional[int] = None,
+    use_cache: bool = True,
+):
+    """
+    Base64 of the image, resized to under RESIZE_TARGET_SIZE_KB if given. Repeat
+    calls for an unchanged file come from the image cache (see `ImagePayloadCache`).
+    """
+
+    def compute():
+        # from https://chat.openai.com/c/35f15af9-b947-4fa6-acbe-2a5ed26e7547
+        if resize_target_size_kb is None:
+            with open(img_full_filen, "rb") as image_file:
+                img_bytes = image_file.read()
+        else:
+            img_bytes = image_to_base64_resized(img_full_filen, resize_target_size_kb)
+        return base64.b64encode(img_bytes).decode("utf-8")
+
+    if not use_cache:
+        return compute()
+    return _image_cache.get_or_compute(img_full_filen, resize_target_size_kb, "base64", compute)
+
+
+def prepare_images(
+    image_filens: Sequence[str],
+    resize_target_size_kb: Optional[int] = 100,
+    max_workers: Optional[int] = None,
+    use_cache: bool = True,
+) -> list[str]:
+    """
+    `image_to_base64` for many images at once, in the same order, resizing the
+    cache misses in parallel on a process pool (image work is CPU-bound, so
+    threads wouldn't help much). Worth it for big multimodal batches - for a
+    handful of images, the pool's start-up cost outweighs the gain.
+    """
+    b64s: list[Optional[str]] = [None] * len(image_filens)
+    if use_cache:
+        for i, image_filen in enumerate(image_filens):
+            b64s[i] = _image_cache.get(image_filen, resize_target_size_kb, "base64")
+    misses = [i for i, b64 in enumerate(b64s) if b64 is None]
+    if len(misses) <= 1 or max_workers == 1:
+        computed = [
+            image_to_base64(image_filens[i], resize_target_size_kb, use_cache=False)
+            for i in misses
+        ]
     else:
-        img_bytes = image_to_base64_resized(img_full_filen, resize_target_size_kb)
-    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
-    return img_b64
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            computed = list(
+                pool.map(
+                    image_to_base64,
+                    [image_filens[i] for i in misses],
+                    [resize_target_size_kb] * len(misses),
+                    [False] * len(misses),
+                )
+            )
+    for i, b64 in zip(misses, computed):
+        b64s[i] = b64
+        if use_cache:
+            _image_cache.set(image_filens[i], resize_target_size_kb, "base64", b64)
+    return b64s  # type: ignore[return-value]
 
 
-def image_to_base64_basic(image_filen: str) -> str:
-    with open(image_filen, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("ascii")
+def image_to_base64_basic(image_filen: str, use_cache: bool = True) -> str:
+    return image_to_base64(image_filen, resize_target_size_kb=None, use_cache=use_cache)
 
 
 def contents_for_images(image_filens: list[str], resize_target_size_kb: int):
@@ -0,0 +1,367 @@
+"""
+Offline bulk LLM jobs via the OpenAI Batch API and the Anthropic Message
+Batches API. These are half the price of normal calls, don't count against
+the normal rate limits, and finish within 24 hours.
+
+Job state is saved to a small JSON file after every step, so if the process
+dies you can re-run the same code (or `LLMBatchJob.load`) and it picks up the
+existing batch rather than paying for it twice.
+
+The one gap is a crash between the provider creating the batch and the state
+file recording it. For OpenAI, batches are tagged with a hash of their
+requests (as metadata), and a resumed submission looks for a recent batch
+with that tag before creating another. Anthropic's batches have no metadata,
+so for Claude a crash in that window can still mean a second batch - check
+the console before re-running if that happens.
+
+    job = LLMBatchJob.submit(prompts, "job.json", provider="openai", model="gpt-4o-mini")
+    outs, extra = job.wait()  # polls until done, then returns msgs in input order
+
+    # later, or in another process
+    outs, extra = LLMBatchJob.load("job.json").wait()
+"""
+
+import hashlib
+import json
+from pathlib import Path
+import time
+from typing import Any, Optional, Sequence
+
+from gjdutils.llm_utils import MODEL_TYPE, extract_json_from_markdown
+from gjdutils.llms_common import split_prompt_for_caching
+
+
+DEFAULT_BATCH_MODELS = {"openai": "gpt-4o-mini", "claude": "claude-3-5-haiku-latest"}
+OPENAI_BATCH_DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+# OpenAI batch metadata key holding the requests hash, for finding a batch again
+REQUESTS_HASH_METADATA_KEY = "gjdutils_requests_hash"
+
+
+def _default_client(provider: MODEL_TYPE):
+    if provider == "openai":
+        from gjdutils.api_clients import get_openai_client
+        from gjdutils.llms_openai import OPENAI_API_KEY
+
+        return get_openai_client(api_key=OPENAI_API_KEY)
+    else:
+        from gjdutils.api_clients import get_anthropic_client
+        from gjdutils.llms_claude import CLAUDE_API_KEY
+
+        return get_anthropic_client(api_key=CLAUDE_API_KEY)
+
+
+def batch_requests(
+    prompts: Sequence[str],
+    provider: MODEL_TYPE,
+    model: str,
+    max_tokens: Optional[int] = None,
+    temperature: Optional[float] = 0.001,
+    response_json: bool = False,
+) -> list[dict[str, Any]]:
+    """
+    One batch request per prompt, in the provider's format. The custom_id is the
+    prompt's index, which is how results are mapped back to inputs.
+
+    A PROMPT_CACHE_BREAKPOINT in a prompt is handled as for `call_claude_gpt`
+    (cached prefix block) and `call_openai_gpt` (removed).
+    """
+    requests = []
+    for i, prompt in enumerate(prompts):
+        prefix, suffix = split_prompt_for_caching(prompt)
+        if provider == "claude" and prefix:
+            content: Any = [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            ]
+            if suffix:  # the API rejects empty text blocks
+                content.append({"type": "text", "text": suffix})
+        else:
+            content = prefix + suffix
+        params: dict[str, Any] = {
+            "model": model,
+            "messages": [{"role": "user", "content": content}],
+        }
+        if temperature is not None:
+            params["temperature"] = temperature
+        if provider == "openai":
+            if max_tokens is not None:
+                params["max_tokens"] = max_tokens
+            if response_json:
+                params["response_format"] = {"type": "json_object"}
+            requests.append(
+                {"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": params}
+            )
+        else:
+            params["max_tokens"] = max_tokens if max_tokens is not None else 4096
+            requests.append({"custom_id": str(i), "params": params})
+    return requests
+
+
+class LLMBatchJob:
+    """
+    A batch of prompts submitted to a provider's batch API, with its state
+    persisted to STATE_FILEN (JSON). Create one with `submit` or `load`.
+
+    The results are also saved (next to the state file, as .results.jsonl) once
+    fetched, since providers only keep them for a limited time.
+    """
+
+    def __init__(self, state: dict[str, Any], state_filen: str | Path, client=None):
+        self.state = state
+        self.state_filen = Path(state_filen)
+        self.client = client if client is not None else _default_client(state["provider"])
+
+    @property
+    def results_filen(self) -> Path:
+        return self.state_filen.with_suffix(".results.jsonl")
+
+    @property
+    def batch_id(self) -> Optional[str]:
+        return self.state.get("batch_id")
+
+    @property
+    def status(self) -> str:
+        return self.state["status"]
+
+    @property
+    def done(self) -> bool:
+        return self.state["status"] in OPENAI_BATCH_DONE_STATUSES + ("ended",)
+
+    def save(self):
+        tmp = self.state_filen.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.state, indent=2))
+        tmp.replace(self.state_filen)  # atomic, so a crash can't leave half a file
+
+    @classmethod
+    def load(cls, state_filen: str | Path, client=None) -> "LLMBatchJob":
+        state = json.loads(Path(state_filen).read_text())
+        return cls(state, state_filen, client=client)
+
+    @classmethod
+    def submit(
+        cls,
+        prompts: Sequence[str],
+        state_filen: str | Path,
+        provider: MODEL_TYPE = "openai",
+        model: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = 0.001,
+        response_json: bool = False,
+        client=None,
+        verbose: int = 0,
+    ) -> "LLMBatchJob":
+        """
+        Submits PROMPTS as one batch, unless STATE_FILEN already records a job for
+        the same requests - in which case that job is resumed (finishing the
+        submission if it was interrupted part-way). Raises ValueError if
+        STATE_FILEN is for a different set of requests.
+        """
+        assert prompts, "prompts must be non-empty"
+        if model is None:
+            model = DEFAULT_BATCH_MODELS[provider]
+        requests = batch_requests(
+            prompts, provider, model, max_tokens=max_tokens,
+            temperature=temperature, response_json=response_json,
+        )
+        requests_jsonl = "".join(json.dumps(r, sort_keys=True) + "\n" for r in requests)
+        requests_hash = hashlib.sha256(requests_jsonl.encode("utf-8")).hexdigest()
+
+        state_filen = Path(state_filen)
+        resuming = state_filen.exists()
+        if resuming:
+            job = cls.load(state_filen, client=client)
+            if job.state["requests_hash"] != requests_hash:
+                raise ValueError(
+                    f"{state_filen} is for a different batch of requests - use a new state_filen"
+                )
+            if verbose >= 1:
+                print(f"Resuming batch {job.batch_id} ({job.status}) from {state_filen}")
+        else:
+            state = {
+                "provider": provider,
+                "model": model,
+                "response_json": response_json,
+                "n_requests": len(requests),
+                "requests_hash": requests_hash,
+                "status": "preparing",
+                "created": time.time(),
+            }
+            job = cls(state, state_filen, client=client)
+            job.save()
+
+        if job.batch_id is None:
+            if provider == "openai":
+                job._submit_openai(requests_jsonl, resuming=resuming)
+            else:
+                job._submit_claude(requests)
+            if verbose >= 1:
+                print(f"Submitted batch {job.batch_id} of {len(requests)} requests ({provider})")
+        return job
+
+    def _submit_openai(self, requests_jsonl: str, resuming: bool = False):
+        # a previous attempt may have created the batch, then died before saving it
+        batch = self._find_openai_batch() if resuming else None
+        if batch is None:
+            if self.state.get("input_file_id") is None:
+                input_file = self.client.files.create(
+                    file=("batch.jsonl", requests_jsonl.encode("utf-8")), purpose="batch"
+                )
+                self.state["input_file_id"] = input_file.id
+                self.save()
+            batch = self.client.batches.create(
+                input_file_id=self.state["input_file_id"],
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+                metadata={REQUESTS_HASH_METADATA_KEY: self.state["requests_hash"]},
+            )
+        self.state.update({"batch_id": batch.id, "status": batch.status})
+        self.save()
+
+    def _find_openai_batch(self):
+        """The batch tagged with this job's requests hash, if one was created since the job started."""
+        for batch in self.client.batches.list(limit=100):  # newest first, across pages
+            if batch.created_at < self.state["created"] - 60:
+                return None
+            if (batch.metadata or {}).get(REQUESTS_HASH_METADATA_KEY) == self.state["requests_hash"]:
+                return batch
+        return None
+
+    def _submit_claude(self, requests: list[dict[str, Any]]):
+        # no batch metadata to search by, so unlike OpenAI a crash between
+        # creating the batch and saving its id can't be recovered from here
+        batch = self.client.messages.batches.create(requests=requests)
+        self.state.update({"batch_id": batch.id, "status": batch.processing_status})
+        self.save()
+
+    def refresh(self) -> str:
+        """Checks on the batch once, saves and returns its status."""
+        assert self.batch_id is not None, "Batch hasn't been submitted"
+        if self.state["provider"] == "openai":
+            batch = self.client.batches.retrieve(self.batch_id)
+            self.state.update(
+                {
+                    "status": batch.status,
+                    "output_file_id": batch.output_file_id,
+                    "error_file_id": batch.error_file_id,
+                }
+            )
+        else:
+            batch = self.client.messages.batches.retrieve(self.batch_id)
+            self.state["status"] = batch.processing_status
+        self.save()
+        return self.status
+
+    def wait(
+        self,
+        poll_interval_s: float = 60,
+        timeout_s: Optional[float] = None,
+        verbose: int = 0,
+    ) -> tuple[list[Any], dict[str, Any]]:
+        """
+        Polls every POLL_INTERVAL_S until the batch is done, then returns
+        `results()`. Raises TimeoutError after TIMEOUT_S (the job carries on, and
+        you can `load` it again later).
+        """
+        t0 = time.monotonic()
+        while not self.done:
+            self.refresh()
+            if self.done:
+                break
+            if timeout_s is not None and time.monotonic() - t0 > timeout_s:
+                raise TimeoutError(f"Batch {self.batch_id} still {self.status} after {timeout_s}s")
+            if verbose >= 1:
+                print(f"Batch {self.batch_id}: {self.status}")
+            time.sleep(poll_interval_s)
+        return self.results()
+
+    def results(self) -> tuple[list[Any], dict[str, Any]]:
+        """
+        Returns (outs, extra) once the batch is done. OUTS is in the same order as
+        the prompts, with None for requests that failed; extra["errors"] has the
+        error for each of those (None for successes), plus summed usage.
+        """
+        assert self.done, f"Batch {self.batch_id} isn't done yet ({self.status})"
+        if self.results_filen.exists():
+            items = [json.loads(line) for line in self.results_filen.read_text().splitlines()]
+        else:
+            if self.state["provider"] == "openai":
+                items = self._fetch_openai_results()
+            else:
+                items = self._fetch_claude_results()
+            self.results_filen.write_text("".join(json.dumps(d) + "\n" for d in items))
+
+        n = self.state["n_requests"]
+        outs: list[Any] = [None] * n
+        errors: list[Optional[str]] = [f"No result (batch {self.status})"] * n
+        usage: dict[str, int] = {}
+        for item in items:
+            i = int(item["custom_id"])
+            errors[i] = item.get("error")
+            if errors[i] is None:
+                outs[i] = self._parse_msg(item["msg"], i, errors)
+            for k, v in (item.get("usage") or {}).items():
+                if isinstance(v, int):
+                    usage[k] = usage.get(k, 0) + v
+        extra = {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "errors": errors,
+            "num_errors": sum(e is not None for e in errors),
+            "usage": usage,
+        }
+        return outs, extra
+
+    def _parse_msg(self, msg: Optional[str], i: int, errors: list[Optional[str]]):
+        if not self.state["response_json"]:
+            return msg
+        try:
+            return json.loads(extract_json_from_markdown(msg or ""))
+        except json.JSONDecodeError as e:
+            errors[i] = f"Failed to parse JSON: {e}"
+            return None
+
+    def _fetch_openai_results(self) -> list[dict[str, Any]]:
+        items = []
+        for key in ("output_file_id", "error_file_id"):
+            file_id = self.state.get(key)
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                d = json.loads(line)
+                response = d.get("response") or {}
+                body = response.get("body") or {}
+                if d.get("error") or response.get("status_code") != 200:
+                    error = d.get("error") or body.get("error") or response
+                    items.append({"custom_id": d["custom_id"], "error": json.dumps(error)})
+                else:
+                    items.append(
+                        {
+                            "custom_id": d["custom_id"],
+                            "msg": body["choices"][0]["message"]["content"],
+                            "usage": body.get("usage"),
+                        }
+                    )
+        return items
+
+    def _fetch_claude_results(self) -> list[dict[str, Any]]:
+        items = []
+        for d in self.client.messages.batches.results(self.batch_id):
+            if d.result.type == "succeeded":
+                message = d.result.message
+                items.append(
+                    {
+                        "custom_id": d.custom_id,
+                        "msg": message.content[0].text,
+                        "usage": message.usage.model_dump(),
+                    }
+                )
+            else:
+                error = getattr(d.result, "error", None)
+                items.append(
+                    {
+                        "custom_id": d.custom_id,
+                        "error": json.dumps(error.model_dump() if error is not None else d.result.type),
+                    }
+                )
+        return items
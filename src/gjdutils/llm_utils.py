@@ -1,8 +1,17 @@
-from typing import Any, Literal, Optional, Union, TYPE_CHECKING
+import asyncio
+from collections import deque
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Literal, Optional, Sequence, Union, TYPE_CHECKING
 from pathlib import Path
 import json
+import threading
+import time
 
+from gjdutils.caching import SqliteCache
 from gjdutils.llms_claude import call_claude_gpt
+from gjdutils.llms_common import ExtraLevelTyps, estimate_num_tokens
+from gjdutils.ratelimit import TokenBucket, call_with_backoff
 from gjdutils.strings import jinja_render
 
 if TYPE_CHECKING:  # for type hints only; avoids runtime imports
@@ -12,6 +21,10 @@ if TYPE_CHECKING:  # for type hints only; avoids runtime imports
 
 MODEL_TYPE = Literal["openai", "claude"]
 
+# Default number of requests in flight at once within one `batch_generate` call,
+# by provider. Anthropic's lower tiers are much stricter about concurrent connections.
+DEFAULT_MAX_CONCURRENCY: dict[str, int] = {"openai": 16, "claude": 4}
+
 
 def extract_json_from_markdown(text: str, verbose: int = 0) -> str:
     """
@@ -71,10 +84,16 @@ def generate_gpt_from_template(
     image_filens: list[str] | str | None = None,
     model_type: MODEL_TYPE = "claude",
     max_tokens: Optional[int] = None,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
     verbose: int = 0,
 ) -> tuple[str | dict[str, Any], dict[str, Any]]:
     """Generate a response from GPT using a template.
 
+    If the template has a long static opening (instructions, few-shot examples)
+    followed by a small varying part, put `PROMPT_CACHE_BREAKPOINT` between them
+    so the provider can cache the prefix across calls (see `call_claude_gpt`).
+
     Args:
         client: The Anthropic or OpenAI client
         prompt_template: Either a template string or Path to a template file
@@ -83,6 +102,8 @@ def generate_gpt_from_template(
         image_filens: Optional paths to image files to include
         model_type: Which model type to use ("openai" or "claude")
         max_tokens: Maximum tokens in the response
+        extra_level: How much diagnostic detail to keep in `extra` (see `ExtraLevelTyps`)
+        cache: Optional on-disk response cache (see `call_openai_gpt`)
         verbose: Verbosity level
     """
     # Load template content from Path or use string directly
@@ -105,6 +126,8 @@ def generate_gpt_from_template(
             image_filens=image_filens,
             response_json=response_json,
             max_tokens=max_tokens,
+            extra_level=extra_level,
+            cache=cache,
         )
     else:
         out, extra = call_claude_gpt(
@@ -113,9 +136,12 @@ def generate_gpt_from_template(
             image_filens=image_filens,
             response_json=response_json,
             max_tokens=max_tokens if max_tokens is not None else 4096,
+            extra_level=extra_level,
+            cache=cache,
         )
-        print(f"{out=}")
-        print(f"{max_tokens=}")
+        if verbose >= 2:
+            print(f"{out=}")
+            print(f"{max_tokens=}")
     if response_json:
         assert isinstance(out, dict), f"Expected dict, got {type(out)}"
     else:
@@ -130,3 +156,366 @@ def generate_gpt_from_template(
         }
     )
     return out, extra  # type: ignore
+
+
+def batch_generate(
+    jobs: Sequence[tuple[Union[str, Path], dict]],
+    client: "Anthropic | OpenAI | None" = None,  # type: ignore[name-defined]
+    response_json: bool = False,
+    model_type: MODEL_TYPE = "claude",
+    max_tokens: Optional[int] = None,
+    max_concurrency: Optional[int] = None,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    max_retries: int = 3,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    verbose: int = 0,
+) -> tuple[list[str | dict[str, Any] | None], dict[str, Any]]:
+    """Run `generate_gpt_from_template` over many (prompt_template, context_d) JOBS
+    concurrently, on a thread pool sharing one client.
+
+    Args:
+        jobs: (prompt_template, context_d) pairs, as for `generate_gpt_from_template`
+        client: Anthropic or OpenAI client (defaults to the shared one, see
+            `gjdutils.api_clients`)
+        response_json, model_type, max_tokens, extra_level, cache: as for
+            `generate_gpt_from_template`, applied to every job
+        max_concurrency: Requests in flight at once within this call (defaults to
+            `DEFAULT_MAX_CONCURRENCY` for the provider). It isn't shared across
+            calls, so concurrent `batch_generate` calls can each have this many.
+        requests_per_minute: Optional cap on request rate (again per call).
+            Retries count against it too.
+        tokens_per_minute: Optional cap on estimated tokens (prompt plus
+            MAX_TOKENS) per minute, per call, including retries
+        max_retries: Retries per job for rate-limit/server/connection errors
+        progress_callback: Optional `f(n_done, n_total)`, called from the
+            calling thread as each job finishes (successfully or not)
+        verbose: Verbosity level
+
+    Returns:
+        (outs, extra). OUTS is in the same order as JOBS, with None for jobs that
+        failed. A failing job doesn't stop the batch - its exception is in
+        extra["errors"] (None for successes), alongside each job's own
+        extra["extras"], num_errors, num_retries, rate_limit_wait_s and elapsed_s.
+
+    Example:
+        >>> outs, extra = batch_generate(
+        ...     [(template, {"txt": t}) for t in texts],
+        ...     model_type="openai", requests_per_minute=500,
+        ... )
+    """
+    if max_concurrency is None:
+        max_concurrency = DEFAULT_MAX_CONCURRENCY[model_type]
+    assert max_concurrency >= 1, f"max_concurrency must be >= 1, got {max_concurrency}"
+    t0 = time.perf_counter()
+    n_jobs = len(jobs)
+    outs: list[str | dict[str, Any] | None] = [None] * n_jobs
+    errors: list[Optional[Exception]] = [None] * n_jobs
+    extras: list[Optional[dict[str, Any]]] = [None] * n_jobs
+    request_limiter = TokenBucket(requests_per_minute) if requests_per_minute else None
+    token_limiter = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    # read each template file once, rather than once per job
+    templates: dict[Path, str] = {}
+    for prompt_template, _ in jobs:
+        if isinstance(prompt_template, Path) and prompt_template not in templates:
+            templates[prompt_template] = prompt_template.read_text()
+
+    def run_job(prompt_template: Union[str, Path], context_d: dict):
+        template_content = templates.get(prompt_template, prompt_template)  # type: ignore[arg-type]
+        n_tokens = None
+        waited = 0.0
+
+        def attempt():
+            # acquired per attempt, so retries after a 429 also wait their turn
+            nonlocal n_tokens, waited
+            if request_limiter is not None:
+                waited += request_limiter.acquire()
+            if token_limiter is not None:
+                if n_tokens is None:
+                    n_tokens = estimate_num_tokens(jinja_render(template_content, context_d))
+                waited += token_limiter.acquire(n_tokens + (max_tokens or 0))
+            return generate_gpt_from_template(
+                client,  # type: ignore[arg-type]
+                template_content,
+                context_d,
+                response_json=response_json,
+                model_type=model_type,
+                max_tokens=max_tokens,
+                extra_level=extra_level,
+                cache=cache,
+            )
+
+        (out, extra), n_retries = call_with_backoff(
+            attempt, max_retries=max_retries, verbose=verbose
+        )
+        if isinstance(prompt_template, Path):
+            extra["prompt_template"] = prompt_template.stem
+        return out, extra, n_retries, waited
+
+    n_done = n_retries = 0
+    rate_limit_wait_s = 0.0
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        future_to_i = {
+            pool.submit(run_job, prompt_template, context_d): i
+            for i, (prompt_template, context_d) in enumerate(jobs)
+        }
+        for future in as_completed(future_to_i):
+            i = future_to_i[future]
+            try:
+                outs[i], extras[i], job_retries, waited = future.result()
+                n_retries += job_retries
+                rate_limit_wait_s += waited
+            except Exception as e:
+                errors[i] = e
+                if verbose >= 1:
+                    print(f"Job {i} failed: {type(e).__name__}: {e}")
+            n_done += 1
+            if progress_callback is not None:
+                progress_callback(n_done, n_jobs)
+
+    n_errors = sum(e is not None for e in errors)
+    extra = {
+        "errors": errors,
+        "extras": extras,
+        "num_errors": n_errors,
+        "num_retries": n_retries,
+        "rate_limit_wait_s": rate_limit_wait_s,
+        "elapsed_s": time.perf_counter() - t0,
+    }
+    if verbose >= 1:
+        print(
+            f"batch_generate: {n_jobs} jobs ({n_errors} failed, {n_retries} retries) "
+            f"in {extra['elapsed_s']:.1f}s, model_type={model_type}"
+        )
+    return outs, extra
+
+
+class LatencyTracker:
+    """
+    Rolling window of the most recent WINDOW latencies per route (e.g.
+    "openai:gpt-4o"), for deciding when a request is slow enough to hedge.
+    Requests cancelled after losing a hedge are recorded too, with the time
+    they'd taken so far as a lower bound. Thread-safe.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: dict[str, deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, seconds: float):
+        with self._lock:
+            self._latencies.setdefault(route, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, route: str, q: float = 0.95) -> Optional[float]:
+        """The Q-th quantile latency for ROUTE, or None until there are MIN_SAMPLES."""
+        with self._lock:
+            latencies = sorted(self._latencies.get(route, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        # nearest rank, so e.g. the p95 of 1..100 is 95
+        return latencies[max(0, math.ceil(q * len(latencies)) - 1)]
+
+
+_latency_tracker = LatencyTracker()
+DEFAULT_HEDGE_AFTER_S = 10.0
+
+
+def _route_name(route: tuple[MODEL_TYPE, Optional[str]]) -> str:
+    model_type, model = route
+    return f"{model_type}:{model or 'default'}"
+
+
+async def _acall_route(
+    route: tuple[MODEL_TYPE, Optional[str]],
+    prompt: str,
+    client: Any,
+    response_json: bool,
+    image_filens: list[str] | str | None,
+    max_tokens: Optional[int],
+    extra_level: ExtraLevelTyps,
+    cache: Optional[SqliteCache],
+):
+    model_type, model = route
+    if model_type == "openai":
+        from gjdutils.llms_openai import acall_openai_gpt
+
+        out, _, extra = await acall_openai_gpt(
+            prompt,
+            client=client,
+            model=model,
+            image_filens=image_filens,
+            response_json=response_json,
+            max_tokens=max_tokens,
+            extra_level=extra_level,
+            cache=cache,
+        )
+    else:
+        from gjdutils.llms_claude import MODEL_NAME_CLAUDE_SONNET_GOOD_LATEST, acall_claude_gpt
+
+        out, extra = await acall_claude_gpt(
+            prompt,
+            client=client,
+            model=model or MODEL_NAME_CLAUDE_SONNET_GOOD_LATEST,
+            image_filens=image_filens,
+            response_json=response_json,
+            max_tokens=max_tokens if max_tokens is not None else 4096,
+            extra_level=extra_level,
+            cache=cache,
+        )
+    # a real exception rather than an assert (which `python -O` strips), since
+    # this decides whether to fall back
+    if response_json:
+        if not isinstance(out, dict) or extra.get("json_parse_failed"):
+            raise ValueError(f"Expected JSON object, got {out!r}")
+    elif not isinstance(out, str):
+        raise ValueError(f"Expected str, got {type(out)}")
+    return out, extra
+
+
+async def agenerate_with_fallback(
+    prompt_template: Union[str, Path],
+    context_d: dict,
+    response_json: bool,
+    routes: Sequence[tuple[MODEL_TYPE, Optional[str]]],
+    image_filens: list[str] | str | None = None,
+    max_tokens: Optional[int] = None,
+    hedge: bool = True,
+    hedge_after_s: Optional[float] = None,
+    clients: Optional[dict[str, Any]] = None,
+    latency_tracker: Optional[LatencyTracker] = None,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    verbose: int = 0,
+) -> tuple[str | dict[str, Any], dict[str, Any]]:
+    """Like `generate_gpt_from_template`, but tries ROUTES - (model_type, model)
+    pairs in order of preference, e.g. [("openai", "gpt-4o"), ("claude", None)] -
+    to cut tail latency and ride out errors:
+
+    - Fallback: if a request fails (or returns the wrong type), the next route
+      is tried.
+    - Hedging: if the only request in flight hasn't finished after HEDGE_AFTER_S
+      (by default, the p95 latency recorded for its route, or
+      DEFAULT_HEDGE_AFTER_S until there's enough data), the next route is fired
+      as well. Whichever succeeds first wins and the other is cancelled. At most
+      one hedge is fired per call.
+
+    Args:
+        routes: (model_type, model) pairs; model None means the provider's default
+        hedge: Set False for fallback only
+        clients: Optional async clients by model_type (defaults to the shared ones)
+        latency_tracker: Where route latencies are recorded (defaults to a
+            process-wide one)
+        others: as for `generate_gpt_from_template`
+
+    Returns:
+        (out, extra) from the winning request, with extra["route"] (e.g.
+        "claude:default"), route_index, hedged, hedge_after_s and errors (a list
+        of (route, error) for requests that failed along the way). Raises the
+        last error if every route fails.
+    """
+    assert routes, "routes must be non-empty"
+    clients = clients or {}
+    latency_tracker = latency_tracker or _latency_tracker
+    if isinstance(prompt_template, Path):
+        template_content = prompt_template.read_text()
+        template_name = prompt_template.stem
+    else:
+        template_content = prompt_template
+        template_name = "template from input string"
+    prompt = jinja_render(template_content, context_d)
+
+    async def run(i: int):
+        t0 = time.perf_counter()
+        out, extra = await _acall_route(
+            routes[i], prompt, clients.get(routes[i][0]), response_json,
+            image_filens, max_tokens, extra_level, cache,
+        )
+        if not extra.get("cache_hit"):
+            # cache hits would drag the p95 towards zero, and trigger needless hedges
+            latency_tracker.record(_route_name(routes[i]), time.perf_counter() - t0)
+        return out, extra
+
+    pending: dict[asyncio.Task, int] = {}
+    started_at: dict[int, float] = {}
+    errors: list[tuple[str, Exception]] = []
+    last_error: Optional[Exception] = None
+    hedged = False
+    used_hedge_after_s = None
+    next_i = 0
+
+    def start_next():
+        nonlocal next_i
+        pending[asyncio.create_task(run(next_i))] = next_i
+        started_at[next_i] = time.monotonic()
+        next_i += 1
+
+    start_next()
+    try:
+        while pending:
+            timeout = None
+            if hedge and not hedged and len(pending) == 1 and next_i < len(routes):
+                (only_i,) = pending.values()
+                used_hedge_after_s = hedge_after_s
+                if used_hedge_after_s is None:
+                    p95 = latency_tracker.percentile(_route_name(routes[only_i]), 0.95)
+                    used_hedge_after_s = p95 if p95 is not None else DEFAULT_HEDGE_AFTER_S
+                timeout = max(0.0, started_at[only_i] + used_hedge_after_s - time.monotonic())
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                if verbose >= 1:
+                    print(f"No response after {used_hedge_after_s:.1f}s, hedging with {_route_name(routes[next_i])}")
+                hedged = True
+                start_next()
+                continue
+            for task in done:
+                i = pending.pop(task)
+                error = task.exception()
+                if error is None:
+                    out, extra = task.result()
+                    extra.update(
+                        {
+                            "route": _route_name(routes[i]),
+                            "route_index": i,
+                            "hedged": hedged,
+                            "hedge_after_s": used_hedge_after_s,
+                            "errors": errors,
+                            "prompt_template": template_name,
+                            "prompt_context_d": context_d,
+                        }
+                    )
+                    if verbose >= 1:
+                        print(f"Called GPT on '{template_name}' via {extra['route']} (hedged={hedged})")
+                    return out, extra
+                if not isinstance(error, Exception):
+                    raise error
+                if verbose >= 1:
+                    print(f"{_route_name(routes[i])} failed: {type(error).__name__}: {error}")
+                errors.append((_route_name(routes[i]), error))
+                last_error = error
+            if not pending and next_i < len(routes):
+                start_next()
+    finally:
+        for task, i in pending.items():
+            # a lower bound, but leaving slow losers out would bias the p95 low
+            latency_tracker.record(_route_name(routes[i]), time.monotonic() - started_at[i])
+            task.cancel()
+        # wait for the losers to finish cancelling, so they aren't left pending
+        # (and any errors are retrieved, rather than warned about)
+        await asyncio.gather(*pending, return_exceptions=True)
+    assert last_error is not None
+    raise last_error
+
+
+def generate_with_fallback(*args, **kwargs) -> tuple[str | dict[str, Any], dict[str, Any]]:
+    """
+    Synchronous wrapper for `agenerate_with_fallback` (same arguments). Runs its
+    own event loop, so call `agenerate_with_fallback` directly from async code.
+    """
+    return asyncio.run(agenerate_with_fallback(*args, **kwargs))
@@ -1,10 +1,27 @@
+import asyncio
 import json
 from pathlib import Path
-from anthropic import Anthropic, NOT_GIVEN
-from typing import Optional
+import time
+from anthropic import Anthropic, AsyncAnthropic, NOT_GIVEN
+from anthropic.types import Message, TextBlock
+from typing import Any, Optional
 
+from gjdutils.api_clients import get_anthropic_client, get_async_anthropic_client
 from gjdutils.image_utils import image_to_base64_basic
 from gjdutils.env import get_env_var
+from gjdutils.caching import SqliteCache
+from gjdutils.llms_common import (
+    ChatStream,
+    ExtraLevelTyps,
+    acoalesce_call,
+    check_extra_level,
+    coalesce_call,
+    get_cached_llm_result,
+    llm_cache_key,
+    response_extra,
+    set_cached_llm_result,
+    split_prompt_for_caching,
+)
 
 
 CLAUDE_API_KEY = get_env_var("CLAUDE_API_KEY")
@@ -55,27 +72,254 @@ def call_claude_gpt(
     response_json: bool = False,
     # seed: Optional[int] = DEFAULT_RANDOM_SEED,
     max_tokens: int = 4096,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    cache_bypass: bool = False,
+    coalesce: bool = False,
     verbose: int = 0,
 ):
-    """Call Claude API with support for text, images, and function calling"""
-    from gjdutils.llm_utils import extract_json_from_markdown
+    """Call Claude API with support for text, images, and function calling
+
+    EXTRA_LEVEL controls how much diagnostic detail ends up in `extra` (see
+    `gjdutils.llms_common.ExtraLevelTyps`). "full" adds the response dump and
+    the message contents (including encoded images).
+
+    CACHE, CACHE_BYPASS and COALESCE work as for `call_openai_gpt`. Responses
+    that fail to parse as JSON (for RESPONSE_JSON) aren't cached, so they're
+    retried next time.
+
+    To use Anthropic's prompt caching, put `PROMPT_CACHE_BREAKPOINT` in PROMPT
+    after a long static prefix (instructions, few-shot examples). The prefix is
+    then cached server-side for a few minutes, and later calls sharing it are
+    faster and cheaper. extra["prompt_cache_read_tokens"] and
+    extra["prompt_cache_write_tokens"] show whether it worked (prefixes shorter
+    than the model's minimum, ~1024 tokens, aren't cached).
+    """
+    extra = locals()
+    extra.pop("client")
+    extra.pop("cache")
+    check_extra_level(extra_level)
+    image_filens = _normalise_claude_args(tools, image_filens)
+    cache_key, cached = _claude_cache_lookup(
+        extra, image_filens, cache, cache_bypass, need_key=coalesce
+    )
+    if cached is not None:
+        return _from_cache(cached, verbose)
+
+    if client is None:
+        client = get_anthropic_client(api_key=CLAUDE_API_KEY)
+
+    def call():
+        create_kwargs, contents = _claude_request(
+            prompt, image_filens, image_resize_target_size_kb, model, temperature, max_tokens
+        )
+        # Make API call
+        t0 = time.perf_counter()
+        response = client.messages.create(**create_kwargs)  # type: ignore[union-attr]
+        return _claude_result(response, t0, extra, contents, cache, cache_key, verbose)
+
+    if coalesce:
+        return coalesce_call(cache_key, client, call)  # type: ignore[arg-type]
+    return call()
+
+
+async def acall_claude_gpt(
+    prompt: str,
+    tools: Optional[list[dict]] = None,
+    image_filens: str | list[str] | None = None,
+    image_resize_target_size_kb: Optional[int] = 100,
+    client: Optional[AsyncAnthropic] = None,
+    model: str = MODEL_NAME_CLAUDE_SONNET_GOOD_LATEST,
+    temperature: Optional[float] = 0.001,
+    response_json: bool = False,
+    max_tokens: int = 4096,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    cache_bypass: bool = False,
+    coalesce: bool = False,
+    verbose: int = 0,
+):
+    """
+    Asyncio version of `call_claude_gpt` (same arguments and return value), built
+    on `AsyncAnthropic`.
+    """
+    extra = locals()
+    extra.pop("client")
+    extra.pop("cache")
+    check_extra_level(extra_level)
+    image_filens = _normalise_claude_args(tools, image_filens)
+    # the lookup hashes image files and reads SQLite, so keep it off the event loop
+    cache_key, cached = await asyncio.to_thread(
+        _claude_cache_lookup, extra, image_filens, cache, cache_bypass, need_key=coalesce
+    )
+    if cached is not None:
+        return _from_cache(cached, verbose)
+
+    if client is None:
+        client = get_async_anthropic_client(api_key=CLAUDE_API_KEY)
 
+    async def call():
+        # image encoding is blocking file IO, so keep it off the event loop
+        create_kwargs, contents = await asyncio.to_thread(
+            _claude_request,
+            prompt, image_filens, image_resize_target_size_kb, model, temperature, max_tokens,
+        )
+        t0 = time.perf_counter()
+        response = await client.messages.create(**create_kwargs)  # type: ignore[union-attr]
+        # as does writing the response to the cache
+        return await asyncio.to_thread(
+            _claude_result, response, t0, extra, contents, cache, cache_key, verbose
+        )
+
+    if coalesce:
+        return await acoalesce_call(cache_key, client, call)  # type: ignore[arg-type]
+    return await call()
+
+
+def stream_claude_gpt(
+    prompt: str,
+    tools: Optional[list[dict]] = None,
+    image_filens: str | list[str] | None = None,
+    image_resize_target_size_kb: Optional[int] = 100,
+    client: Optional[Anthropic] = None,
+    model: str = MODEL_NAME_CLAUDE_SONNET_GOOD_LATEST,
+    temperature: Optional[float] = 0.001,
+    response_json: bool = False,
+    max_tokens: int = 4096,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    cache_bypass: bool = False,
+    verbose: int = 0,
+) -> ChatStream:
+    """
+    Streaming version of `call_claude_gpt` (same arguments). Returns a
+    `ChatStream` of text deltas; once it's exhausted, `stream.result` is the
+    usual (msg, extra), with extra["time_to_first_token_s"].
+    """
     extra = locals()
     extra.pop("client")
+    extra.pop("cache")
+    check_extra_level(extra_level)
+    image_filens = _normalise_claude_args(tools, image_filens)
+    cache_key, cached = _claude_cache_lookup(extra, image_filens, cache, cache_bypass)
+    if cached is not None:
+        result = _from_cache(cached, verbose)
+        deltas = [result[0]] if isinstance(result[0], str) else []
+        return ChatStream(iter(deltas), lambda: result, result[-1], time.perf_counter())
+
+    if client is None:
+        client = get_anthropic_client(api_key=CLAUDE_API_KEY)
+
+    create_kwargs, contents = _claude_request(
+        prompt, image_filens, image_resize_target_size_kb, model, temperature, max_tokens
+    )
+    t0 = time.perf_counter()
+    events = client.messages.create(**create_kwargs, stream=True)
+    acc: dict[str, Any] = {}
+
+    def finish():
+        response = _message_from_events(acc)
+        return _claude_result(response, t0, extra, contents, cache, cache_key, verbose)
+
+    return ChatStream(_iter_claude_events(events, acc), finish, extra, t0, sdk_stream=events)
+
+
+def _iter_claude_events(events, acc: dict[str, Any]):
+    """
+    Yields the text deltas from a stream of message events, accumulating
+    everything needed to rebuild the whole Message into ACC.
+    """
+    acc.update({"message": None, "text": [], "stop_reason": None, "output_tokens": None})
+    for event in events:
+        if event.type == "message_start":
+            acc["message"] = event.message
+        elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+            acc["text"].append(event.delta.text)
+            yield event.delta.text
+        elif event.type == "message_delta":
+            acc["stop_reason"] = event.delta.stop_reason
+            acc["output_tokens"] = event.usage.output_tokens
+
+
+def _message_from_events(acc: dict[str, Any]) -> Message:
+    """Reassembles the accumulated stream into the Message it's equivalent to."""
+    message = acc["message"]
+    usage = message.usage
+    if acc["output_tokens"] is not None:
+        usage = usage.model_copy(update={"output_tokens": acc["output_tokens"]})
+    return message.model_copy(
+        update={
+            "content": [TextBlock(type="text", text="".join(acc["text"]))],
+            "stop_reason": acc["stop_reason"],
+            "usage": usage,
+        }
+    )
+
 
+def _normalise_claude_args(tools, image_filens):
     if tools is not None:
         raise NotImplementedError(
             "I think tools are supported, but not implemented in this function"
         )
+    if isinstance(image_filens, str):
+        image_filens = [image_filens]
+    return image_filens
 
-    if client is None:
-        client = Anthropic(api_key=CLAUDE_API_KEY)
 
-    # Prepare image contents if provided
+def _claude_cache_lookup(
+    extra: dict, image_filens, cache, cache_bypass: bool, need_key: bool = False
+):
+    """
+    Returns (cache_key, cached_result), both None if there's no CACHE (unless
+    NEED_KEY, e.g. for coalescing). Without a CACHE, the key only needs to last
+    while the call is in flight, so images aren't hashed.
+    """
+    if cache is None and not need_key:
+        return None, None
+    cache_key = llm_cache_key(
+        "claude",
+        extra["model"],
+        extra["prompt"],
+        image_filens=image_filens,
+        hash_image_contents=cache is not None,
+        temperature=extra["temperature"],
+        max_tokens=extra["max_tokens"],
+        response_json=extra["response_json"],
+    )
+    return cache_key, get_cached_llm_result(cache, cache_key, bypass=cache_bypass)
+
+
+def _from_cache(cached: tuple, verbose: int):
+    msg, extra = cached
+    extra["cache_hit"] = True
+    if verbose >= 1:
+        print(f"LLM MESSAGE (cached):\n{msg}")
+    return msg, extra
+
+
+def _claude_request(
+    prompt: str,
+    image_filens: Optional[list[str]],
+    image_resize_target_size_kb: Optional[int],
+    model: str,
+    temperature: Optional[float],
+    max_tokens: int,
+):
+    """
+    Builds the keyword arguments for `messages.create` (encoding any images).
+    Returns (create_kwargs, contents).
+
+    If PROMPT contains PROMPT_CACHE_BREAKPOINT, the part before it goes first, as
+    its own block marked for prompt caching, and the rest goes after any images.
+    """
+    prefix, prompt = split_prompt_for_caching(prompt)
     contents = []
+    if prefix:
+        contents.append(
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}
+        )
+    # Prepare image contents if provided
     if image_filens:
-        if isinstance(image_filens, str):
-            image_filens = [image_filens]
         assert image_resize_target_size_kb is not None
         for i, img_filen in enumerate(image_filens):
             contents.extend(
@@ -97,13 +341,14 @@ def call_claude_gpt(
     #     # Add instruction to respond in JSON format - be very explicit
     #     prompt = f"Please provide your response in valid JSON format without any markdown formatting or backticks. Provide ONLY the JSON object, not any explanatory text before or after the JSON. {prompt}"
 
-    contents.append({"type": "text", "text": prompt})
+    if prompt:
+        # empty if PROMPT ends with the breakpoint, and the API rejects empty text blocks
+        contents.append({"type": "text", "text": prompt})
 
     # not supported
     # response_format = {"type": "json_object"} if response_json else None
 
-    # Make API call
-    response = client.messages.create(
+    create_kwargs = dict(
         model=model,
         max_tokens=max_tokens,
         messages=[{"role": "user", "content": contents}],
@@ -111,9 +356,24 @@ def call_claude_gpt(
         # seed=seed,
         # response_format=response_format,
     )
+    return create_kwargs, contents
+
+
+def _claude_result(
+    response,
+    t0: float,
+    extra: dict,
+    contents: list,
+    cache: Optional[SqliteCache],
+    cache_key: Optional[str],
+    verbose: int,
+):
+    """Parses RESPONSE into (msg, extra), and caches it."""
+    from gjdutils.llm_utils import extract_json_from_markdown
 
     msg = response.content[0].text  # type: ignore
-    if response_json:
+    parse_failed = False
+    if extra["response_json"]:
         try:
             # Use our utility function to handle markdown-wrapped JSON
             clean_json_text = extract_json_from_markdown(msg, verbose=verbose)
@@ -124,22 +384,34 @@ def call_claude_gpt(
                 print(f"Raw message causing error: {msg}")
                 print(f"Cleaned: {clean_json_text}")
             # Return a structured error response instead of failing
+            parse_failed = True
             msg = {
                 "error": "Failed to parse API response",
                 "raw_response": msg[:500] if msg else "Empty response",
             }
+    extra_level = extra["extra_level"]
     extra.update(
         {
-            "response": response.model_dump(),
+            "elapsed_s": time.perf_counter() - t0,
             "msg": msg,
+            "json_parse_failed": parse_failed,
             # "tool_calls": tool_calls,
-            "model": model,
-            "contents": contents,
+            "model": extra["model"],
+            **response_extra(response, extra_level),
         }
     )
+    usage = extra["usage"] or {}
+    extra["prompt_cache_read_tokens"] = usage.get("cache_read_input_tokens") or 0
+    extra["prompt_cache_write_tokens"] = usage.get("cache_creation_input_tokens") or 0
+    if extra_level == "full":
+        extra["contents"] = contents
+    if cache is not None:
+        extra["cache_hit"] = False
+        if not parse_failed:
+            set_cached_llm_result(cache, cache_key, (msg, extra))  # type: ignore[arg-type]
 
     if verbose >= 2:
-        print(f"PROMPT:\n{prompt}")
+        print(f"PROMPT:\n{extra['prompt']}")
     if verbose >= 1:
         print(f"LLM MESSAGE:\n{msg}")
     if verbose >= 2:
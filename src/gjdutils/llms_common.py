@@ -0,0 +1,349 @@
+"""
+Shared helpers for the LLM/embedding wrappers (llms_openai, llms_claude,
+embeddings_openai). Deliberately free of provider SDK imports, so each of
+those modules can use it without pulling in the others' dependencies.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+import pickle
+import threading
+import time
+from typing import Any, Awaitable, Callable, Iterator, Literal, Optional
+import weakref
+
+from gjdutils.caching import SqliteCache
+
+
+# How much diagnostic detail to keep in `extra`:
+#   "minimal" (default): usage, model and timing only
+#   "raw": also the SDK response object itself, without copying it - call
+#       `extra["response"].model_dump()` later if you need the full payload
+#   "full": also `response.model_dump()`, plus any other bulky diagnostics
+#       (e.g. the base64-encoded images that were sent)
+ExtraLevelTyps = Literal["minimal", "raw", "full"]
+EXTRA_LEVELS = ("minimal", "raw", "full")
+
+
+def check_extra_level(extra_level: str):
+    if extra_level not in EXTRA_LEVELS:
+        raise ValueError(f"Unknown extra_level: {extra_level}, expected one of {EXTRA_LEVELS}")
+
+
+def response_extra(response: Any, extra_level: ExtraLevelTyps) -> dict[str, Any]:
+    """
+    The response-derived part of `extra` for EXTRA_LEVEL: always "usage" and
+    "response_model", plus "response" (None for "minimal").
+    """
+    check_extra_level(extra_level)
+    usage = getattr(response, "usage", None)
+    d: dict[str, Any] = {
+        "usage": usage.model_dump() if hasattr(usage, "model_dump") else usage,
+        "response_model": getattr(response, "model", None),
+        "response": None,
+    }
+    if extra_level == "raw":
+        d["response"] = response
+    elif extra_level == "full":
+        d["response"] = response.model_dump() if hasattr(response, "model_dump") else response
+    return d
+
+
+# Put this in a prompt (or prompt template) to mark the end of a static prefix
+# (e.g. instructions plus few-shot examples) that the provider can cache between
+# calls. Claude calls send the prefix as a separate content block with
+# `cache_control`; OpenAI caches long prefixes automatically, so there it's just
+# removed. Deliberately not Jinja syntax, so it survives template rendering.
+PROMPT_CACHE_BREAKPOINT = "<<<CACHE_BREAKPOINT>>>"
+
+
+def split_prompt_for_caching(prompt: str) -> tuple[str, str]:
+    """
+    Returns (prefix, suffix) either side of PROMPT_CACHE_BREAKPOINT, or ("", PROMPT)
+    if there isn't one.
+    """
+    prefix, marker, suffix = prompt.partition(PROMPT_CACHE_BREAKPOINT)
+    if not marker:
+        return "", prompt
+    assert PROMPT_CACHE_BREAKPOINT not in suffix, "Only one cache breakpoint is supported"
+    return prefix, suffix
+
+
+def strip_cache_breakpoint(prompt: str) -> str:
+    return "".join(split_prompt_for_caching(prompt))
+
+
+def estimate_num_tokens(txt: str) -> int:
+    """
+    Cheap, dependency-free token estimate. Assumes ~3 characters per token (English
+    averages ~4), so it errs on the high side. Use tiktoken if you need it exact.
+    """
+    return len(txt) // 3 + 1
+
+
+def file_content_hash(filen: str | Path) -> str:
+    """sha256 hex digest of a file's bytes (e.g. so cache keys change if an image is edited)."""
+    h = hashlib.sha256()
+    with open(filen, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stat_key(filen: str | Path) -> str:
+    """Cheap stand-in for `file_content_hash`: the file's path, size and mtime."""
+    st = os.stat(filen)
+    return f"{os.path.abspath(filen)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def llm_cache_key(
+    provider: str,
+    model: str,
+    messages: Any,
+    image_filens: Optional[list[str]] = None,
+    hash_image_contents: bool = True,
+    **params: Any,
+) -> str:
+    """
+    Canonical hash of everything that determines an LLM response: provider, model,
+    messages (e.g. the prompt), the *contents* of any images (so renaming a file
+    doesn't matter, but editing it does), and any other PARAMS (tools,
+    temperature, seed, response_json, max_tokens etc.).
+
+    HASH_IMAGE_CONTENTS=False identifies images by path, size and mtime instead
+    (see `file_stat_key`), which avoids reading them - good enough for a key
+    that only has to last while a call is in flight, e.g. for coalescing.
+    """
+    image_key = file_content_hash if hash_image_contents else file_stat_key
+    payload = {
+        "provider": provider,
+        "model": model,
+        "messages": messages,
+        "image_hashes": [image_key(f) for f in image_filens or []],
+        "params": params,
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_cached_llm_result(cache: Optional[SqliteCache], key: str, bypass: bool = False) -> Any:
+    """
+    The cached result for KEY, or None on a miss (or if there's no cache, or BYPASS).
+    Results are pickled, since they can include SDK objects (e.g. tool calls).
+    """
+    if cache is None or bypass:
+        return None
+    value = cache.get(key)
+    return None if value is None else pickle.loads(value)
+
+
+def set_cached_llm_result(cache: Optional[SqliteCache], key: str, result: Any):
+    if cache is None:
+        return
+    cache.set(key, pickle.dumps(result))
+
+
+class ChatStream:
+    """
+    Returned by the `stream_*` chat functions. Iterate over it to get text deltas
+    as they arrive. Once it's exhausted, `result` holds exactly what the
+    non-streaming function would have returned (e.g. `(msg, tool_calls, extra)`),
+    with extra["time_to_first_token_s"] added.
+
+        stream = stream_openai_gpt("Tell me a story")
+        for delta in stream:
+            print(delta, end="", flush=True)
+        msg, tool_calls, extra = stream.result
+
+    Call `get_result()` to skip straight to the end (e.g. for response_json,
+    where the partial text isn't much use).
+
+    If you stop iterating early (e.g. `break`), the underlying SDK stream and its
+    HTTP response are closed, and `result` stays None - iterating again or
+    calling `get_result()` then raises RuntimeError, rather than passing off
+    the partial reply as the whole thing (or caching it). Use it as a context
+    manager (or call `close()`) to be sure of closing it even if it's never
+    iterated.
+
+        with stream_openai_gpt("Tell me a story") as stream:
+            first = next(iter(stream))
+    """
+
+    def __init__(
+        self,
+        deltas: Iterator[str],
+        finish: Callable[[], tuple],
+        extra: dict[str, Any],
+        t0: float,
+        sdk_stream: Any = None,
+    ):
+        self._deltas = deltas
+        self._finish = finish
+        self._t0 = t0
+        self._sdk_stream = sdk_stream
+        self._closed_early = False
+        self.extra = extra
+        self.time_to_first_token_s: Optional[float] = None
+        self.result: Optional[tuple] = None
+
+    def __iter__(self) -> Iterator[str]:
+        if self._closed_early:
+            raise RuntimeError("The stream was closed before it finished, so there's no result")
+        exhausted = False
+        try:
+            for delta in self._deltas:
+                if self.time_to_first_token_s is None and delta:
+                    self.time_to_first_token_s = time.perf_counter() - self._t0
+                yield delta
+            exhausted = True
+        finally:
+            # runs on exhaustion, and when an abandoned iteration is closed
+            if not exhausted and self.result is None:
+                self._closed_early = True
+            self._close_streams()
+        if self.result is None:
+            self.extra["time_to_first_token_s"] = self.time_to_first_token_s
+            self.result = self._finish()
+
+    def close(self):
+        """Closes the SDK stream (and its HTTP response). Safe to call more than once."""
+        if self.result is None:
+            self._closed_early = True
+        self._close_streams()
+
+    def _close_streams(self):
+        close_deltas = getattr(self._deltas, "close", None)
+        if close_deltas is not None:
+            close_deltas()
+        close_sdk_stream = getattr(self._sdk_stream, "close", None)
+        if close_sdk_stream is not None:
+            close_sdk_stream()
+
+    def __enter__(self) -> "ChatStream":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_result(self) -> tuple:
+        """Consumes whatever is left of the stream, and returns `result`."""
+        for _ in self:
+            pass
+        return self.result  # type: ignore[return-value]
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls (across threads): while a call for KEY
+    is in flight, other callers with the same KEY wait for it and share its
+    result (or exception), rather than making their own. Nothing is kept once
+    the call finishes - that's what a cache is for.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> tuple[Any, bool]:
+        """Returns (FN's result, whether it was shared from another caller's call)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+        assert flight is not None
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio version of `SingleFlight`, for coroutines on the same event loop
+    (each loop has its own set of in-flight calls). If the leading call is
+    cancelled, the callers waiting on it aren't - one of them makes the call
+    instead, and the rest wait for that.
+    """
+
+    def __init__(self):
+        self._flights: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Future]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        loop = asyncio.get_running_loop()
+        flights = self._flights.setdefault(loop, {})
+        while key in flights:
+            shared = flights[key]
+            # wait() rather than awaiting it directly, so a waiter being cancelled
+            # doesn't cancel the shared call
+            await asyncio.wait([shared])
+            if not shared.cancelled():
+                return shared.result(), True
+            # the leader was cancelled (not us), so go round again as a new leader
+        future = flights[key] = loop.create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, in case nobody else was waiting
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del flights[key]
+        return result, False
+
+
+_single_flight = SingleFlight()
+_async_single_flight = AsyncSingleFlight()
+
+
+def _mark_coalesced(result: tuple, shared: bool) -> tuple:
+    # callers sharing a result each get their own copy of `extra` (the last item)
+    *rest, extra = result
+    return (*rest, {**extra, "coalesced": shared})
+
+
+def _coalesce_key(key: str, client: Any) -> str:
+    # calls through different clients (accounts, base URLs, fakes) aren't identical
+    return f"{key}:{id(client)}"
+
+
+def coalesce_call(key: str, client: Any, fn: Callable[[], tuple]) -> tuple:
+    """
+    Runs FN (returning a `(..., extra)` tuple) through the process-wide
+    `SingleFlight`, keyed on KEY and CLIENT, setting extra["coalesced"] for
+    callers that shared the result.
+    """
+    return _mark_coalesced(*_single_flight.do(_coalesce_key(key, client), fn))
+
+
+async def acoalesce_call(key: str, client: Any, fn: Callable[[], Awaitable[tuple]]) -> tuple:
+    """Asyncio version of `coalesce_call`."""
+    return _mark_coalesced(*await _async_single_flight.do(_coalesce_key(key, client), fn))
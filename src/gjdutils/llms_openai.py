@@ -1,12 +1,30 @@
+import asyncio
 import json
-from openai import OpenAI, NOT_GIVEN
-from typing import Literal, Optional
+import time
+from openai import AsyncOpenAI, OpenAI, NOT_GIVEN
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from typing import Any, Literal, Optional
 
 from .prompt_templates import summarise_list_of_texts_as_one, summarise_text
 from .rand import DEFAULT_RANDOM_SEED
 from .strings import jinja_render
+from gjdutils.api_clients import get_async_openai_client, get_openai_client
 from gjdutils.image_utils import contents_for_images
 from gjdutils.env import get_env_var
+from gjdutils.caching import SqliteCache
+from gjdutils.llms_common import (
+    ChatStream,
+    ExtraLevelTyps,
+    acoalesce_call,
+    check_extra_level,
+    coalesce_call,
+    get_cached_llm_result,
+    llm_cache_key,
+    response_extra,
+    set_cached_llm_result,
+    strip_cache_breakpoint,
+)
 
 
 OPENAI_API_KEY = get_env_var("OPENAI_API_KEY")
@@ -50,21 +68,39 @@ def call_openai_gpt(
     # stop: Optional[list[str]] = None,
     response_json: bool = False,
     seed: Optional[int] = DEFAULT_RANDOM_SEED,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    cache_bypass: bool = False,
+    coalesce: bool = False,
     verbose: int = 0,
 ):
     """
+    EXTRA_LEVEL controls how much diagnostic detail ends up in `extra` (see
+    `gjdutils.llms_common.ExtraLevelTyps`). By default that's just the inputs,
+    msg, tool_calls, usage, model and elapsed_s. "full" adds the response dump,
+    the encoded images and the message contents.
+
+    CACHE (optional) stores responses on disk, keyed on a canonical hash of the
+    model, prompt, tools, temperature, seed, response_json, max_tokens and the
+    contents of any images (see `llm_cache_key`). A hit skips the API call and the
+    image encoding, and sets extra["cache_hit"]. EXTRA_LEVEL isn't part of the
+    key, so a hit has whatever detail the cached call kept. CACHE_BYPASS ignores
+    any cached response and makes a fresh call (which then replaces the cached one).
+
+    COALESCE makes concurrent identical calls (same key as for CACHE, and the same
+    CLIENT) in this process share one API call - e.g. parallel page renders asking
+    for the same summary. The callers that didn't make the call get
+    extra["coalesced"] = True.
+
     Usage:
 
         client = OpenAI(
             api_key=OPENAI_API_KEY,
         )
-        msg, tools, extra = call_gpt_uncached(client, "What is the capital of France?")
+        msg, tools, extra = call_openai_gpt("What is the capital of France?", client=client)
 
-        @cachier()
-        def call_gpt_cached(
-            inp: str, tools: Optional[list[dict]] = None, tool_choice: ToolChoiceTyps = "auto"
-        ):
-            return call_gpt(client=client, inp=inp, tools=tools, tool_choice=tool_choice)
+        cache = SqliteCache("~/.cache/gjdutils/llm.sqlite", max_bytes=1024**3, ttl_seconds=30 * 86400)
+        msg, tools, extra = call_openai_gpt("What is the capital of France?", cache=cache)
 
     https://platform.openai.com/docs/api-reference/chat/create?lang=python
     SAMPLE_TOOLS = [
@@ -123,19 +159,293 @@ def call_openai_gpt(
 
     extra = locals()
     extra.pop("client")  # to avoid caching issues, and because it includes the API key
+    extra.pop("cache")
+    check_extra_level(extra_level)
+    tools, tool_choice, model, image_filens = _normalise_openai_args(
+        tools, tool_choice, model, image_filens
+    )
+    cache_key, cached = _openai_cache_lookup(
+        extra, model, image_filens, tool_choice, cache, cache_bypass, need_key=coalesce
+    )
+    if cached is not None:
+        return _from_cache(cached, verbose)
+    if client is None:
+        client = get_openai_client(api_key=OPENAI_API_KEY)
+
+    def call():
+        create_kwargs, base64_images, contents = _openai_request(
+            prompt, tools, tool_choice, image_filens, image_resize_target_size_kb,
+            model, temperature, max_tokens, response_json, seed,
+        )
+        t0 = time.perf_counter()
+        response = client.chat.completions.create(**create_kwargs)  # type: ignore[union-attr]
+        return _openai_result(
+            response, t0, extra, model, base64_images, contents, cache, cache_key, verbose
+        )
+
+    if coalesce:
+        return coalesce_call(cache_key, client, call)  # type: ignore[arg-type]
+    return call()
+
+
+async def acall_openai_gpt(
+    prompt: str,
+    tools: Optional[list[dict]] = None,
+    tool_choice: Optional[ToolChoiceTyps] = None,
+    image_filens: str | list[str] | None = None,
+    image_resize_target_size_kb: Optional[int] = 100,
+    client: Optional[AsyncOpenAI] = None,
+    model: Optional[str] = None,
+    temperature: Optional[float] = 0.001,
+    max_tokens: int | None = None,
+    response_json: bool = False,
+    seed: Optional[int] = DEFAULT_RANDOM_SEED,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    cache_bypass: bool = False,
+    coalesce: bool = False,
+    verbose: int = 0,
+):
+    """
+    Asyncio version of `call_openai_gpt` (same arguments and return value), built
+    on `AsyncOpenAI`, so that many requests can be in flight on one event loop.
+    If CLIENT is None, all calls on the loop share one (see `gjdutils.api_clients`).
+
+    Usage:
+
+        results = await asyncio.gather(
+            *[acall_openai_gpt(p) for p in prompts]
+        )
+    """
+    extra = locals()
+    extra.pop("client")
+    extra.pop("cache")
+    check_extra_level(extra_level)
+    tools, tool_choice, model, image_filens = _normalise_openai_args(
+        tools, tool_choice, model, image_filens
+    )
+    # the lookup hashes image files and reads SQLite, so keep it off the event loop
+    cache_key, cached = await asyncio.to_thread(
+        _openai_cache_lookup,
+        extra, model, image_filens, tool_choice, cache, cache_bypass, need_key=coalesce,
+    )
+    if cached is not None:
+        return _from_cache(cached, verbose)
     if client is None:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = get_async_openai_client(api_key=OPENAI_API_KEY)
+
+    async def call():
+        # image encoding is CPU-bound, so keep it off the event loop
+        create_kwargs, base64_images, contents = await asyncio.to_thread(
+            _openai_request,
+            prompt, tools, tool_choice, image_filens, image_resize_target_size_kb,
+            model, temperature, max_tokens, response_json, seed,
+        )
+        t0 = time.perf_counter()
+        response = await client.chat.completions.create(**create_kwargs)  # type: ignore[union-attr]
+        # as does writing the response to the cache
+        return await asyncio.to_thread(
+            _openai_result,
+            response, t0, extra, model, base64_images, contents, cache, cache_key, verbose,
+        )
+
+    if coalesce:
+        return await acoalesce_call(cache_key, client, call)  # type: ignore[arg-type]
+    return await call()
+
+
+def stream_openai_gpt(
+    prompt: str,
+    tools: Optional[list[dict]] = None,
+    tool_choice: Optional[ToolChoiceTyps] = None,
+    image_filens: str | list[str] | None = None,
+    image_resize_target_size_kb: Optional[int] = 100,
+    client: Optional[OpenAI] = None,
+    model: Optional[str] = None,
+    temperature: Optional[float] = 0.001,
+    max_tokens: int | None = None,
+    response_json: bool = False,
+    seed: Optional[int] = DEFAULT_RANDOM_SEED,
+    extra_level: ExtraLevelTyps = "minimal",
+    cache: Optional[SqliteCache] = None,
+    cache_bypass: bool = False,
+    verbose: int = 0,
+) -> ChatStream:
+    """
+    Streaming version of `call_openai_gpt` (same arguments). Returns a
+    `ChatStream` that yields text deltas as they arrive; once it's exhausted,
+    `stream.result` is the usual (msg, tool_calls, extra), with usage, tool calls
+    and (for RESPONSE_JSON) the parsed JSON assembled from the whole stream, plus
+    extra["time_to_first_token_s"].
+
+    A cache hit yields the whole cached message as a single delta.
+
+    Usage:
+
+        stream = stream_openai_gpt("Tell me a story")
+        for delta in stream:
+            print(delta, end="", flush=True)
+        msg, tool_calls, extra = stream.result
+    """
+    extra = locals()
+    extra.pop("client")
+    extra.pop("cache")
+    check_extra_level(extra_level)
+    tools, tool_choice, model, image_filens = _normalise_openai_args(
+        tools, tool_choice, model, image_filens
+    )
+    cache_key, cached = _openai_cache_lookup(extra, model, image_filens, tool_choice, cache, cache_bypass)
+    if cached is not None:
+        result = _from_cache(cached, verbose)
+        deltas = [result[0]] if isinstance(result[0], str) else []
+        return ChatStream(iter(deltas), lambda: result, result[-1], time.perf_counter())
+    if client is None:
+        client = get_openai_client(api_key=OPENAI_API_KEY)
+    create_kwargs, base64_images, contents = _openai_request(
+        prompt, tools, tool_choice, image_filens, image_resize_target_size_kb,
+        model, temperature, max_tokens, response_json, seed,
+    )
+    t0 = time.perf_counter()
+    chunks = client.chat.completions.create(
+        **create_kwargs, stream=True, stream_options={"include_usage": True}
+    )
+    acc: dict[str, Any] = {}
+
+    def finish():
+        response = _chat_completion_from_chunks(acc, model)
+        return _openai_result(
+            response, t0, extra, model, base64_images, contents, cache, cache_key, verbose
+        )
+
+    return ChatStream(_iter_openai_chunks(chunks, acc), finish, extra, t0, sdk_stream=chunks)
+
+
+def _iter_openai_chunks(chunks, acc: dict[str, Any]):
+    """
+    Yields the text deltas from a streamed chat completion, accumulating
+    everything needed to rebuild the whole response into ACC.
+    """
+    acc.update({"content": [], "tool_calls": {}, "usage": None, "finish_reason": None})
+    for chunk in chunks:
+        acc.setdefault("id", chunk.id)
+        acc.setdefault("created", chunk.created)
+        acc["model"] = chunk.model
+        if chunk.usage is not None:
+            # the final chunk (with include_usage) has usage and no choices
+            acc["usage"] = chunk.usage
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason is not None:
+            acc["finish_reason"] = choice.finish_reason
+        delta = choice.delta
+        # tool calls arrive in fragments, keyed by index
+        for tc in delta.tool_calls or []:
+            d = acc["tool_calls"].setdefault(
+                tc.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+            )
+            if tc.id:
+                d["id"] = tc.id
+            if tc.function is not None:
+                d["function"]["name"] += tc.function.name or ""
+                d["function"]["arguments"] += tc.function.arguments or ""
+        if delta.content:
+            acc["content"].append(delta.content)
+            yield delta.content
+
+
+def _chat_completion_from_chunks(acc: dict[str, Any], model: str) -> ChatCompletion:
+    """Reassembles the accumulated stream into the ChatCompletion it's equivalent to."""
+    tool_calls = [acc["tool_calls"][i] for i in sorted(acc["tool_calls"])]
+    message = ChatCompletionMessage(
+        role="assistant",
+        content="".join(acc["content"]) if acc["content"] or not tool_calls else None,
+        tool_calls=tool_calls or None,  # type: ignore[arg-type]
+    )
+    return ChatCompletion(
+        id=acc.get("id", ""),
+        choices=[
+            Choice(index=0, finish_reason=acc["finish_reason"] or "stop", message=message)
+        ],
+        created=acc.get("created", 0),
+        model=acc.get("model", model),
+        object="chat.completion",
+        usage=acc["usage"],
+    )
+
+
+def _normalise_openai_args(tools, tool_choice, model, image_filens):
     if not tools:
         # otherwise you get a 400
         tool_choice = None
     if model is None:
         model = DEFAULT_MODEL_NAME
+    if isinstance(image_filens, str):
+        image_filens = [image_filens]
+    return tools, tool_choice, model, image_filens
+
+
+def _openai_cache_lookup(
+    extra: dict,
+    model: str,
+    image_filens,
+    tool_choice,
+    cache,
+    cache_bypass: bool,
+    need_key: bool = False,
+):
+    """
+    Returns (cache_key, cached_result), both None if there's no CACHE (unless
+    NEED_KEY, e.g. for coalescing). Without a CACHE, the key only needs to last
+    while the call is in flight, so images aren't hashed.
+    """
+    if cache is None and not need_key:
+        return None, None
+    cache_key = llm_cache_key(
+        "openai",
+        model,
+        extra["prompt"],
+        image_filens=image_filens,
+        hash_image_contents=cache is not None,
+        image_resize_target_size_kb=extra["image_resize_target_size_kb"],
+        tools=extra["tools"],
+        tool_choice=tool_choice,
+        temperature=extra["temperature"],
+        max_tokens=extra["max_tokens"],
+        response_json=extra["response_json"],
+        seed=extra["seed"],
+    )
+    return cache_key, get_cached_llm_result(cache, cache_key, bypass=cache_bypass)
+
+
+def _from_cache(cached: tuple, verbose: int):
+    msg, tool_calls, extra = cached
+    extra["cache_hit"] = True
+    if verbose >= 1:
+        print(f"LLM MESSAGE (cached):\n{msg}")
+    return msg, tool_calls, extra
+
+
+def _openai_request(
+    prompt: str,
+    tools,
+    tool_choice,
+    image_filens: Optional[list[str]],
+    image_resize_target_size_kb: Optional[int],
+    model: str,
+    temperature,
+    max_tokens: Optional[int],
+    response_json: bool,
+    seed: Optional[int],
+):
+    """
+    Builds the keyword arguments for `chat.completions.create` (encoding any
+    images). Returns (create_kwargs, base64_images, contents).
+    """
     if image_filens is None:
         base64_images = None
         image_contents = []
     else:
-        if isinstance(image_filens, str):
-            image_filens = [image_filens]
         assert (
             image_resize_target_size_kb is not None
         ), "You must provide a resize_target_size_kb"
@@ -143,7 +453,8 @@ def call_openai_gpt(
             image_filens, resize_target_size_kb=image_resize_target_size_kb
         )
 
-    prompt_content = {"type": "text", "text": prompt}
+    # OpenAI caches long prompt prefixes automatically, so just drop any breakpoint
+    prompt_content = {"type": "text", "text": strip_cache_breakpoint(prompt)}
     contents = image_contents + [prompt_content]
     messages = [{"role": "user", "content": contents}]
     response_format = {"type": "json_object"} if response_json else None
@@ -157,34 +468,56 @@ def call_openai_gpt(
         tools, tool_choice = NOT_GIVEN, NOT_GIVEN  # type: ignore
         # assert temperature is None, f"Temperature can't be set for {model}"
         temperature = NOT_GIVEN  # type: ignore
-    response = client.chat.completions.create(
+    create_kwargs = dict(
         model=model,
-        messages=messages,  # type: ignore
-        tools=tools,  # type: ignore
-        tool_choice=tool_choice,  # type: ignore
+        messages=messages,
+        tools=tools,
+        tool_choice=tool_choice,
         temperature=temperature,
         max_tokens=max_tokens if max_tokens is not None else NOT_GIVEN,
         # stop=stop,  # for some reason, setting this to None causes an error
         seed=seed,
-        response_format=response_format,  # type: ignore
+        response_format=response_format,
     )
+    return create_kwargs, base64_images, contents
+
+
+def _openai_result(
+    response,
+    t0: float,
+    extra: dict,
+    model: str,
+    base64_images,
+    contents: list,
+    cache: Optional[SqliteCache],
+    cache_key: Optional[str],
+    verbose: int,
+):
+    """Parses RESPONSE into (msg, tool_calls, extra), and caches it."""
     msg = response.choices[0].message.content  # could be empty
-    if response_json:
+    if extra["response_json"]:
         msg = json.loads(msg)  # type: ignore
     tool_calls = response.choices[0].message.tool_calls  # could be None or a list
+    extra_level = extra["extra_level"]
     extra.update(
         {
-            "response": response.model_dump(),
+            "elapsed_s": time.perf_counter() - t0,
             "msg": msg,
             "tool_calls": tool_calls,
             "model": model,
-            "base64_images": base64_images,
-            "contents": contents,
             # "client": client,
+            **response_extra(response, extra_level),
         }
     )
+    prompt_tokens_details = (extra["usage"] or {}).get("prompt_tokens_details") or {}
+    extra["prompt_cache_read_tokens"] = prompt_tokens_details.get("cached_tokens") or 0
+    if extra_level == "full":
+        extra.update({"base64_images": base64_images, "contents": contents})
+    if cache is not None:
+        extra["cache_hit"] = False
+        set_cached_llm_result(cache, cache_key, (msg, tool_calls, extra))  # type: ignore[arg-type]
     if verbose >= 2:
-        print(f"PROMPT:\n{prompt}")
+        print(f"PROMPT:\n{extra['prompt']}")
     if verbose >= 1:
         print(f"LLM MESSAGE:\n{msg}")
     if verbose >= 2:
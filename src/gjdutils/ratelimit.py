@@ -0,0 +1,167 @@
+"""
+Token-bucket rate limiting, e.g. for staying under an API's
+requests-per-minute or tokens-per-minute quota, plus retrying with backoff.
+
+    limiter = AsyncTokenBucket(per_minute=1_000_000)
+    await limiter.acquire(n_tokens)  # waits until there's budget
+
+    limiter = TokenBucket(per_minute=500)  # the same, for threads
+    limiter.acquire()
+
+    result, n_retries = call_with_backoff(lambda: client.embeddings.create(...))
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional, Tuple, TypeVar
+
+
+T = TypeVar("T")
+
+
+class _TokenBucketBase:
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        assert per_minute > 0, f"per_minute must be positive, got {per_minute}"
+        self.per_minute = per_minute
+        self.capacity = burst if burst is not None else per_minute
+        self._rate_per_s = per_minute / 60.0
+        self._available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(
+            self.capacity, self._available + (now - self._updated) * self._rate_per_s
+        )
+        self._updated = now
+
+    def _delay_for(self, n: float) -> float:
+        return (n - self._available) / self._rate_per_s
+
+
+class AsyncTokenBucket(_TokenBucketBase):
+    """
+    Allows up to PER_MINUTE units per minute, refilled continuously, with bursts
+    of up to BURST units (defaults to a full minute's worth).
+
+    Waiters are served in order, so one large request can't be starved by
+    a stream of small ones.
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        super().__init__(per_minute=per_minute, burst=burst)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, n: float = 1) -> float:
+        """
+        Waits until N units are available and takes them. Returns the number of
+        seconds spent waiting. Requests bigger than the bucket are clamped to its
+        capacity (otherwise they'd wait forever).
+        """
+        n = min(n, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            while self._available < n:
+                delay = self._delay_for(n)
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self._available -= n
+        return waited
+
+
+class TokenBucket(_TokenBucketBase):
+    """
+    Blocking, thread-safe version of `AsyncTokenBucket`, e.g. to share one
+    requests-per-minute budget across the workers of a thread pool.
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        super().__init__(per_minute=per_minute, burst=burst)
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1) -> float:
+        """As for `AsyncTokenBucket.acquire`, but blocks the calling thread."""
+        n = min(n, self.capacity)
+        waited = 0.0
+        with self._lock:
+            self._refill()
+            while self._available < n:
+                delay = self._delay_for(n)
+                time.sleep(delay)
+                waited += delay
+                self._refill()
+            self._available -= n
+        return waited
+
+
+def is_retryable_api_error(e: Exception) -> bool:
+    """
+    True for errors worth retrying from the OpenAI/Anthropic SDKs: rate limits
+    (429), timeouts, overloaded/server errors (5xx) and connection problems.
+    Checked by duck-typing so this module doesn't need either SDK installed.
+    """
+    status_code = getattr(e, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in (408, 409, 429) or status_code >= 500
+    # APITimeoutError is a subclass of APIConnectionError in both SDKs
+    return any(cls.__name__ == "APIConnectionError" for cls in type(e).__mro__)
+
+
+def _backoff_delay(attempt: int, initial_delay_s: float, max_delay_s: float) -> float:
+    return min(max_delay_s, initial_delay_s * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+def call_with_backoff(
+    fn: Callable[[], T],
+    max_retries: int = 5,
+    initial_delay_s: float = 1.0,
+    max_delay_s: float = 60.0,
+    is_retryable: Callable[[Exception], bool] = is_retryable_api_error,
+    verbose: int = 0,
+) -> Tuple[T, int]:
+    """
+    Calls FN(), retrying with jittered exponential backoff on retryable errors
+    (by default, 429/5xx and connection errors - see `is_retryable_api_error`).
+
+    Returns (result, n_retries). Re-raises the last error once MAX_RETRIES is used up,
+    or immediately for non-retryable errors.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(), attempt
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, initial_delay_s, max_delay_s)
+            if verbose >= 1:
+                print(f"Retryable error ({type(e).__name__}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+async def acall_with_backoff(
+    fn: Callable[[], Awaitable[T]],
+    max_retries: int = 5,
+    initial_delay_s: float = 1.0,
+    max_delay_s: float = 60.0,
+    is_retryable: Callable[[Exception], bool] = is_retryable_api_error,
+    verbose: int = 0,
+) -> Tuple[T, int]:
+    """
+    Asyncio version of `call_with_backoff`, where FN returns an awaitable.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn(), attempt
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, initial_delay_s, max_delay_s)
+            if verbose >= 1:
+                print(f"Retryable error ({type(e).__name__}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    raise AssertionError("unreachable")
@@ -0,0 +1,35 @@
+import asyncio
+
+from gjdutils.api_clients import (
+    clear_clients,
+    get_async_openai_client,
+    get_client,
+    get_openai_client,
+)
+
+
+def test_clients_are_shared_per_config():
+    clear_clients()
+    client = get_openai_client(api_key="sk-a")
+    assert get_openai_client(api_key="sk-a") is client
+    assert get_openai_client(api_key="sk-b") is not client
+
+    n_created = []
+    for _ in range(3):
+        get_client("fake", lambda: n_created.append(1) or object(), region="eu")
+    assert len(n_created) == 1
+
+    clear_clients()
+    assert get_openai_client(api_key="sk-a") is not client
+
+
+def test_async_clients_are_shared_per_event_loop():
+    clear_clients()
+
+    async def two_clients():
+        return get_async_openai_client(api_key="sk-a"), get_async_openai_client(api_key="sk-a")
+
+    a1, a2 = asyncio.run(two_clients())
+    (b1, _) = asyncio.run(two_clients())
+    assert a1 is a2
+    assert b1 is not a1  # a fresh loop gets a fresh client
@@ -0,0 +1,39 @@
+from gjdutils.caching import SqliteCache
+
+
+def test_sqlite_cache_roundtrip(tmp_path):
+    cache = SqliteCache(tmp_path / "cache.sqlite")
+    assert cache.get("missing") is None
+    cache.set_many({"a": b"1", "b": b"22"})
+    assert cache.get_many(["a", "b", "c"]) == {"a": b"1", "b": b"22"}
+    assert len(cache) == 2 and cache.nbytes() == 3
+    cache.delete("a")
+    assert "a" not in cache and "b" in cache
+
+    # persists across instances
+    cache.close()
+    assert SqliteCache(tmp_path / "cache.sqlite").get("b") == b"22"
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path):
+    cache = SqliteCache(tmp_path / "cache.sqlite", max_bytes=20)
+    cache.set("old", b"x" * 10)
+    cache.set("newer", b"x" * 10)
+    cache.get("old")  # touch, so "newer" is now the least recently used
+    cache.set("newest", b"x" * 10)
+    assert cache.nbytes() <= 20
+    assert "old" in cache and "newest" in cache
+    assert "newer" not in cache
+
+
+def test_sqlite_cache_expires_entries_after_ttl(tmp_path, monkeypatch):
+    import gjdutils.caching as caching
+
+    now = [1000.0]
+    monkeypatch.setattr(caching.time, "time", lambda: now[0])
+    cache = SqliteCache(tmp_path / "cache.sqlite", ttl_seconds=60)
+    cache.set("a", b"1")
+    now[0] += 30
+    assert cache.get("a") == b"1"
+    now[0] += 31
+    assert cache.get("a") is None and len(cache) == 0
@@ -25,3 +25,418 @@ def test_cosine_similarity_three_sentences():
     )
 
 
+class FakeEmbeddingsClient:
+    """Stands in for `OpenAI()`, returning a deterministic embedding per text."""
+
+    def __init__(self, dim: int = 4):
+        self.dim = dim
+        self.calls: list[list[str]] = []
+        self.embeddings = self
+
+    def create(self, model, input, dimensions=None):
+        from types import SimpleNamespace
+
+        self.calls.append(list(input))
+        data = [
+            SimpleNamespace(embedding=[float(len(t)), float(i), 1 / 3, 0.1][: self.dim])
+            for i, t in enumerate(input)
+        ]
+        return SimpleNamespace(data=data, model=model, usage=None)
+
+
+def test_embeddings_cache_only_sends_misses(tmp_path):
+    from gjdutils.caching import SqliteCache
+
+    cache = SqliteCache(tmp_path / "emb.sqlite")
+    client = FakeEmbeddingsClient()
+
+    embs1, extra1 = get_openai_embeddings(["a", "bb"], model="m", client=client, cache=cache)  # type: ignore[arg-type]
+    assert extra1["cache_hits"] == 0 and extra1["cache_misses"] == 2
+
+    embs2, extra2 = get_openai_embeddings(["ccc", "bb", "a"], model="m", client=client, cache=cache)  # type: ignore[arg-type]
+    assert client.calls == [["a", "bb"], ["ccc"]]
+    assert extra2["cache_hits"] == 2 and extra2["cache_misses"] == 1
+    # merged back in the original order
+    assert embs2[0][0] == 3.0
+    assert embs2[1] == embs1[1]
+    assert embs2[2] == embs1[0]
+    # hits come back at the same (full) precision as misses
+    assert embs2[1][2:] == [1 / 3, 0.1]
+
+    # a different model is a different key
+    get_openai_embeddings(["a"], model="other", client=client, cache=cache)  # type: ignore[arg-type]
+    assert client.calls[-1] == ["a"]
+
+
+def test_batch_by_size():
+    from gjdutils.embeddings_openai import batch_by_size
+
+    assert batch_by_size(["a"] * 5, max_items=2, max_tokens=1000) == [[0, 1], [2, 3], [4]]
+    # each 30-char text is estimated at 11 tokens
+    assert batch_by_size(["x" * 30] * 3, max_items=100, max_tokens=25) == [[0, 1], [2]]
+    # an oversized text still gets a batch of its own
+    assert batch_by_size(["x" * 300, "a"], max_items=100, max_tokens=25) == [[0], [1]]
+
+
+def test_embeddings_bulk_batches_retries_and_preserves_order(monkeypatch):
+    from types import SimpleNamespace
+    import openai
+    from gjdutils import embeddings_openai
+    from gjdutils.embeddings_openai import get_openai_embeddings_bulk
+
+    monkeypatch.setattr(embeddings_openai.time, "sleep", lambda s: None)
+
+    class FlakyClient(FakeEmbeddingsClient):
+        def create(self, model, input, dimensions=None):
+            if len(self.calls) == 0:
+                self.calls.append([])
+                response = SimpleNamespace(request=None, status_code=429, headers={})
+                raise openai.RateLimitError("slow down", response=response, body=None)  # type: ignore[arg-type]
+            return super().create(model, input, dimensions)
+
+    txts = ["x" * n for n in range(1, 11)]
+    progress = []
+    embs, extra = get_openai_embeddings_bulk(
+        txts,
+        model="m",
+        client=FlakyClient(),  # type: ignore[arg-type]
+        max_items_per_batch=3,
+        max_workers=1,
+        progress_callback=lambda done, total: progress.append((done, total)),
+    )
+    assert [e[0] for e in embs] == [float(n) for n in range(1, 11)]
+    assert extra["num_batches"] == 4
+    assert extra["num_retries"] == 1
+    assert progress[0] == (0, 10) and progress[-1] == (10, 10)
+
+
+def test_aget_openai_embeddings_matches_sync_shape():
+    import asyncio
+    from gjdutils.embeddings_openai import aget_openai_embeddings
+
+    class FakeAsyncClient(FakeEmbeddingsClient):
+        async def create(self, model, input, dimensions=None):  # type: ignore[override]
+            await asyncio.sleep(0)
+            return FakeEmbeddingsClient.create(self, model, input, dimensions)
+
+    txts = ["x" * n for n in range(1, 8)]
+    client = FakeAsyncClient()
+    embs, extra = asyncio.run(
+        aget_openai_embeddings(
+            txts,
+            model="m",
+            client=client,  # type: ignore[arg-type]
+            max_items_per_batch=2,
+            max_concurrency=2,
+            tokens_per_minute=1_000_000,
+        )
+    )
+    assert [e[0] for e in embs] == [float(n) for n in range(1, 8)]
+    assert extra["num_batches"] == 4 and len(client.calls) == 4
+
+    with pytest.raises(ValueError):
+        asyncio.run(aget_openai_embeddings(["ok", ""], model="m", client=client))  # type: ignore[arg-type]
+
+
+def test_aget_openai_embeddings_retries_wait_for_token_budget(monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+    import openai
+    from gjdutils import ratelimit
+    from gjdutils.embeddings_openai import aget_openai_embeddings
+    from gjdutils.ratelimit import AsyncTokenBucket
+
+    monkeypatch.setattr(ratelimit, "_backoff_delay", lambda *args: 0)
+
+    class FlakyAsyncClient(FakeEmbeddingsClient):
+        async def create(self, model, input, dimensions=None):  # type: ignore[override]
+            if not self.calls:
+                self.calls.append([])
+                response = SimpleNamespace(request=None, status_code=429, headers={})
+                raise openai.RateLimitError("slow down", response=response, body=None)  # type: ignore[arg-type]
+            return FakeEmbeddingsClient.create(self, model, input, dimensions)
+
+    bucket = AsyncTokenBucket(1_000_000)
+    acquired = []
+    acquire = bucket.acquire
+    monkeypatch.setattr(bucket, "acquire", lambda n=1: acquired.append(n) or acquire(n))
+    _, extra = asyncio.run(
+        aget_openai_embeddings(["abc"], model="m", client=FlakyAsyncClient(), tokens_per_minute=bucket)  # type: ignore[arg-type]
+    )
+    assert extra["num_retries"] == 1 and len(acquired) == 2
+
+
+def test_compare_embedding_query_top_k():
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((200, 16)).astype(np.float32)
+    q = X[17] + 0.01
+
+    for metric in ["cosine", "dot", "euclidean"]:
+        scores, _ = compare_embedding_query(q, X, metric=metric)
+        (idxs, top_scores), _ = compare_embedding_query(q, X, metric=metric, top_k=5)
+        expected = sorted(range(200), key=lambda i: -scores[i])[:5]
+        assert idxs == expected
+        assert np.allclose(top_scores, [scores[i] for i in expected])
+
+    arr, _ = compare_embedding_query(q, X, as_numpy=True)
+    assert isinstance(arr, np.ndarray) and arr.shape == (200,)
+    (idxs, _), _ = compare_embedding_query(q, X, top_k=500, as_numpy=True)
+    assert idxs[0] == 17 and len(idxs) == 200
+
+
+def test_embedding_index_matches_compare_embedding_query():
+    import numpy as np
+    from gjdutils.embeddings_openai import EmbeddingIndex
+
+    rng = np.random.default_rng(1)
+    X = rng.standard_normal((50, 8)).astype(np.float32)
+    Q = rng.standard_normal((3, 8)).astype(np.float32)
+    ids = [f"doc{i}" for i in range(50)]
+
+    index = EmbeddingIndex()
+    index.add(ids[:20], X[:20])
+    index.add(ids[20:], X[20:])
+    assert len(index) == 50
+
+    for metric in ["cosine", "dot", "euclidean"]:
+        (exp_idxs, exp_scores), _ = compare_embedding_query(Q[0], X, metric=metric, top_k=5)
+        got_ids, got_scores = index.search(Q[0], k=5, metric=metric)
+        assert got_ids == [ids[i] for i in exp_idxs]
+        assert np.allclose(got_scores, exp_scores, atol=1e-4)
+
+    batch_ids, batch_scores = index.search(Q, k=4)
+    assert batch_scores.shape == (3, 4)
+    for qi in range(3):
+        single_ids, _ = index.search(Q[qi], k=4)
+        assert batch_ids[qi] == single_ids
+
+    index.remove(["doc0", "doc7"])
+    assert len(index) == 48 and "doc7" not in index
+    assert np.allclose(index.get("doc8"), X[8], atol=1e-5)
+    got_ids, _ = index.search(X[0], k=1)
+    assert got_ids != ["doc0"]
+    with pytest.raises(ValueError):
+        index.add(["doc1"], X[:1])
+
+
+def test_compare_embedding_queries_blocked_matches_single():
+    import numpy as np
+    from gjdutils.embeddings_openai import compare_embedding_queries
+
+    rng = np.random.default_rng(2)
+    X = rng.standard_normal((300, 12)).astype(np.float32)
+    Q = rng.standard_normal((7, 12)).astype(np.float32)
+
+    for metric in ["cosine", "dot", "euclidean"]:
+        # a tiny budget forces many dataset blocks
+        (idxs, scores), extra = compare_embedding_queries(
+            Q, X, metric=metric, top_k=5, memory_budget_mb=0.002
+        )
+        assert extra["dataset_block_size"] < 300
+        assert idxs.shape == scores.shape == (7, 5)
+        for qi in range(7):
+            (exp_idxs, exp_scores), _ = compare_embedding_query(Q[qi], X, metric=metric, top_k=5)
+            assert idxs[qi].tolist() == exp_idxs
+            assert np.allclose(scores[qi], exp_scores, atol=1e-4)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantised_store_search(tmp_path, dtype):
+    import numpy as np
+    from gjdutils.embeddings_openai import (
+        QuantisedEmbeddingStore,
+        compare_embedding_queries,
+        write_quantised_embeddings,
+    )
+
+    rng = np.random.default_rng(3)
+    X = rng.standard_normal((120, 16)).astype(np.float32)
+    # stream it in as chunks, as you would for a corpus larger than RAM
+    write_quantised_embeddings(tmp_path / "store", (X[i : i + 50] for i in range(0, 120, 50)), dtype=dtype)
+    store = QuantisedEmbeddingStore(tmp_path / "store")
+    assert store.shape == (120, 16)
+    assert np.allclose(store.get(0, 120), X, atol=0.05)
+
+    for metric in ["cosine", "dot", "euclidean"]:
+        exact, _ = compare_embedding_query(X[5], X, metric=metric, as_numpy=True)
+        approx, _ = compare_embedding_query(X[5], store, metric=metric, as_numpy=True)
+        assert np.allclose(approx, exact, atol=0.1)
+        # a tiny budget just means more, smaller blocks
+        blocked, _ = compare_embedding_query(X[5], store, metric=metric, as_numpy=True, memory_budget_mb=0.001)
+        assert np.allclose(blocked, approx)
+
+    idxs, scores = store.search(X[5], k=3)
+    assert idxs[0] == 5 and scores[0] > 0.99
+    (batch_idxs, _), _ = compare_embedding_queries(X[:4], store, top_k=1, memory_budget_mb=0.001)
+    assert batch_idxs[:, 0].tolist() == [0, 1, 2, 3]
+
+    # while overwriting, there's no header, so a crash can't leave a valid-looking store
+    def chunks():
+        assert not (tmp_path / "store" / "header.json").exists()
+        yield X[:10]
+
+    store = write_quantised_embeddings(tmp_path / "store", chunks(), dtype=dtype, overwrite=True)
+    assert store.shape == (10, 16)
+
+
+def test_ivf_index_recall_and_roundtrip(tmp_path):
+    import numpy as np
+    from gjdutils.embeddings_openai import IVFIndex
+
+    rng = np.random.default_rng(4)
+    # clustered data, so the coarse quantiser has some structure to find
+    centers = rng.standard_normal((20, 16))
+    X = (centers[rng.integers(0, 20, 2000)] + 0.3 * rng.standard_normal((2000, 16))).astype(np.float32)
+
+    index = IVFIndex.build(X, n_lists=20)
+    assert len(index) == 2000 and index.n_lists == 20
+
+    # probing every list is exact search
+    (exact_idxs, _), _ = compare_embedding_query(X[3], X, top_k=5)
+    idxs, scores = index.search(X[3], k=5, nprobe=20)
+    assert idxs.tolist() == exact_idxs
+
+    report = index.recall_report(X[:50], k=10, nprobes=[1, 4, 20])
+    recalls = [row["recall"] for row in report[:-1]]
+    assert recalls == sorted(recalls) and recalls[-1] >= 0.99
+    assert report[-1]["nprobe"] == "exact"
+
+    index.save(tmp_path / "index.npz")
+    loaded = IVFIndex.load(tmp_path / "index.npz")
+    assert np.array_equal(loaded.search(X[:3], k=5, nprobe=2)[0], index.search(X[:3], k=5, nprobe=2)[0])
+
+
+def test_binary_quantised_index_reranks_exactly():
+    import numpy as np
+    from gjdutils.embeddings_openai import BinaryQuantisedIndex
+
+    rng = np.random.default_rng(5)
+    X = rng.standard_normal((500, 64)).astype(np.float32)
+    index = BinaryQuantisedIndex(X)
+    assert index.bits.shape == (500, 8)
+
+    dists = index.hamming(X[10])
+    assert dists[10] == 0
+    assert dists[11] == np.count_nonzero((X[10] > 0) != (X[11] > 0))
+
+    q = X[10] + 0.1 * rng.standard_normal(64).astype(np.float32)
+    for metric in ["cosine", "dot", "euclidean"]:
+        (exp_idxs, exp_scores), _ = compare_embedding_query(q, X, metric=metric, top_k=3)
+        # with every row as a candidate, the rerank is exact search
+        idxs, scores = index.search(q, k=3, n_candidates=500, metric=metric)
+        assert idxs.tolist() == exp_idxs
+        assert np.allclose(scores, exp_scores, atol=1e-4)
+
+    idxs, _ = index.search(X[:3] + 0.01, k=1, n_candidates=20)
+    assert idxs[:, 0].tolist() == [0, 1, 2]
+
+
+def test_embeddings_deduplicate_repeated_inputs():
+    from gjdutils.embeddings_openai import get_openai_embeddings_bulk
+
+    txts = ["a", "bb", "a", "ccc", "bb", "a"]
+    client = FakeEmbeddingsClient()
+    embs, extra = get_openai_embeddings(txts, model="m", client=client)  # type: ignore[arg-type]
+    assert client.calls == [["a", "bb", "ccc"]]
+    assert [e[0] for e in embs] == [1.0, 2.0, 1.0, 3.0, 2.0, 1.0]
+    assert extra["num_api_inputs"] == 3 and extra["num_api_inputs_saved"] == 3
+    assert embs[0] == embs[2] and embs[0] is not embs[2]
+
+    client = FakeEmbeddingsClient()
+    progress = []
+    embs, extra = get_openai_embeddings_bulk(
+        txts,
+        model="m",
+        client=client,  # type: ignore[arg-type]
+        max_items_per_batch=2,
+        progress_callback=lambda done, total: progress.append(done),
+    )
+    assert sorted(sum(client.calls, [])) == ["a", "bb", "ccc"]
+    assert [e[0] for e in embs] == [1.0, 2.0, 1.0, 3.0, 2.0, 1.0]
+    assert extra["num_api_inputs_saved"] == 3 and extra["num_batches"] == 2
+    assert progress[-1] == 6
+
+
+def test_mmr_rerank_prefers_diverse_results():
+    import numpy as np
+    from gjdutils.embeddings_openai import EmbeddingIndex, mmr_rerank
+
+    q = np.array([1.0, 0.0, 0.0], dtype=np.float32)
+    X = np.array(
+        [
+            [1.0, 0.1, 0.0],  # 0: most relevant
+            [1.0, 0.11, 0.0],  # 1: near-duplicate of 0
+            [0.7, 0.0, 0.7],  # 2: relevant, but different
+            [0.0, 1.0, 0.0],  # 3: irrelevant
+        ],
+        dtype=np.float32,
+    )
+    (selected, _), extra = mmr_rerank(q, X, k=2, lambda_mult=1.0)
+    assert selected == [0, 1]
+    (selected, _), extra = mmr_rerank(q, X, k=2, lambda_mult=0.5)
+    assert selected == [0, 2]
+    assert len(extra["relevance"]) == 2
+
+    index = EmbeddingIndex()
+    index.add(["a", "b", "c", "d"], X)
+    (selected, _), _ = mmr_rerank(q, index, k=2, candidates=["b", "c", "d"])
+    assert selected == ["b", "c"]
+
+
+def test_find_similar_pairs_and_clusters():
+    import numpy as np
+    from gjdutils.embeddings_openai import cluster_near_duplicates, find_similar_pairs
+
+    rng = np.random.default_rng(6)
+    X = rng.standard_normal((40, 32)).astype(np.float32)
+    X[10] = X[3] + 0.01
+    X[25] = X[3] + 0.02
+    X[33] = X[7] * 2  # same direction, so cosine 1.0
+
+    # brute force, for comparison
+    U = X / np.linalg.norm(X, axis=1, keepdims=True)
+    S = U @ U.T
+    expected = {(a, b) for a in range(40) for b in range(a + 1, 40) if S[a, b] >= 0.95}
+
+    for block_size, n_jobs in [(7, 1), (40, 1), (9, 2)]:
+        (i, j, scores), extra = find_similar_pairs(X, threshold=0.95, block_size=block_size, n_jobs=n_jobs)
+        assert set(zip(i.tolist(), j.tolist())) == expected
+        assert np.all(scores >= 0.95)
+
+    clusters, extra = cluster_near_duplicates(X, threshold=0.95, block_size=8)
+    assert clusters == [[3, 10, 25], [7, 33]]
+    assert extra["num_clusters"] == 2
+
+
+def test_pure_python_fallback_matches_numpy():
+    import numpy as np
+    from gjdutils.embeddings_openai import PurePythonEmbeddings, _compare_embedding_query_py
+
+    rng = np.random.default_rng(7)
+    X = rng.standard_normal((30, 8)).astype(np.float32)
+    q = rng.standard_normal(8).astype(np.float32).tolist()
+    dataset = PurePythonEmbeddings(X.tolist())
+
+    for metric in ["cosine", "dot", "euclidean"]:
+        expected, _ = compare_embedding_query(q, X, metric=metric)
+        scores, _ = _compare_embedding_query_py(q, X.tolist(), metric=metric, top_k=None, verbose=0)
+        assert np.allclose(scores, expected, atol=1e-4)
+        (idxs, top), extra = compare_embedding_query(q, dataset, metric=metric, top_k=3)
+        assert idxs == sorted(range(30), key=lambda i: -expected[i])[:3]
+        assert extra["num_dataset"] == 30
+
+    # plain lists are scored as they are, at full (float64) precision
+    scores, _ = _compare_embedding_query_py([0.1, 0.2], [[0.3, 0.7]], metric="dot", top_k=None, verbose=0)
+    assert scores == [0.1 * 0.3 + 0.2 * 0.7]
+
+
+def test_embeddings_extra_level():
+    client = FakeEmbeddingsClient()
+    _, extra = get_openai_embeddings(["a"], model="m", client=client)  # type: ignore[arg-type]
+    assert extra["response"] is None and "elapsed_s" in extra
+    _, extra = get_openai_embeddings(["a"], model="m", client=client, extra_level="raw")  # type: ignore[arg-type]
+    assert extra["response"].data[0].embedding[0] == 1.0
+    with pytest.raises(ValueError):
+        get_openai_embeddings(["a"], model="m", client=client, extra_level="everything")  # type: ignore[arg-type]
@@ -0,0 +1,101 @@
+import os
+from pathlib import Path
+
+from PIL import Image
+import pytest
+
+from gjdutils import image_utils
+from gjdutils.caching import SqliteCache
+from gjdutils.image_utils import (
+    ImagePayloadCache,
+    contents_for_images,
+    get_image_cache,
+    image_to_base64,
+    image_to_base64_resized,
+    prepare_images,
+)
+
+
+def make_image(filen, size=(64, 48), color=(200, 30, 30)):
+    Image.new("RGB", size, color).save(filen, format="PNG")
+    return str(filen)
+
+
+@pytest.fixture
+def image_cache(monkeypatch):
+    """A fresh process-wide image cache, restored to the original afterwards."""
+    cache = ImagePayloadCache()
+    monkeypatch.setattr(image_utils, "_image_cache", cache)
+    return cache
+
+
+def test_image_cache_skips_repeat_work_and_notices_edits(tmp_path, image_cache):
+    cache = image_cache
+    img = make_image(tmp_path / "photo.png")
+    contents1, b64s1 = contents_for_images([img], resize_target_size_kb=100)
+    contents2, b64s2 = contents_for_images([img], resize_target_size_kb=100)
+    assert b64s1 == b64s2 and contents1 == contents2
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    # a different target size, or an edited file, is a different payload
+    image_to_base64(img, resize_target_size_kb=None)
+    assert cache.misses == 2
+    make_image(img, color=(0, 0, 255))
+    os.utime(img, ns=(0, 10**18))
+    assert image_to_base64(img, resize_target_size_kb=100) != b64s1[0]
+    assert cache.misses == 3
+
+
+def test_image_cache_disk_tier_persists(tmp_path):
+    img = make_image(tmp_path / "photo.png")
+    disk = SqliteCache(tmp_path / "images.sqlite")
+    first = ImagePayloadCache(disk=disk)
+    calls = []
+    compute = lambda: calls.append(1) or "abc="  # noqa: E731
+    assert first.get_or_compute(img, 100, "base64", compute) == "abc="
+
+    # e.g. a new process: empty memory tier, same disk
+    second = ImagePayloadCache(disk=disk)
+    assert second.get_or_compute(img, 100, "base64", compute) == "abc="
+    assert second.disk_hits == 1 and len(calls) == 1
+
+    tiny = ImagePayloadCache(max_memory_bytes=8)
+    for target_kb in (1, 2, 3):
+        tiny.get_or_compute(img, target_kb, "base64", lambda: "x" * 6)
+    assert len(tiny._memory) == 1
+
+
+def make_noisy_jpeg(filen, size=(800, 600)):
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    arr = (rng.random((size[1], size[0], 3)) * 255).astype("uint8")
+    Image.fromarray(arr).save(filen, format="JPEG", quality=90)
+    return str(filen)
+
+
+def test_resize_lands_just_under_target_in_few_encodes(tmp_path, monkeypatch):
+    img = make_noisy_jpeg(tmp_path / "noise.jpg")
+    n_encodes = []
+    encode = image_utils._encode_image
+    monkeypatch.setattr(
+        image_utils, "_encode_image", lambda *args: n_encodes.append(1) or encode(*args)
+    )
+    for target_kb in (30, 100):
+        n_encodes.clear()
+        resized = image_to_base64_resized(img, target_kb, tolerance=0.15)
+        assert target_kb * 1024 * 0.85 <= len(resized) <= target_kb * 1024
+        assert len(n_encodes) <= 5
+    # already small enough: returned as-is, without decoding
+    n_encodes.clear()
+    assert image_to_base64_resized(img, 10_000) == Path(img).read_bytes()
+    assert not n_encodes
+
+
+def test_prepare_images_matches_sequential_in_order(tmp_path, image_cache):
+    imgs = [make_image(tmp_path / f"{i}.png", size=(40 + i, 30), color=(i * 20, 0, 0)) for i in range(4)]
+    b64s = prepare_images(imgs, resize_target_size_kb=100, max_workers=2)
+    assert b64s == [image_to_base64(img, 100, use_cache=False) for img in imgs]
+    # now all cached
+    assert prepare_images(imgs, resize_target_size_kb=100) == b64s
+    assert get_image_cache() is image_cache and image_cache.hits == 4
@@ -0,0 +1,187 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from anthropic import Anthropic
+from openai import OpenAI
+import pytest
+
+from gjdutils.llm_batches import LLMBatchJob
+
+
+class FakeBatchServer:
+    """
+    Just enough of the OpenAI Batch and Anthropic Message Batches APIs, in memory.
+    Answers each prompt with its upper-cased text (or an error, for "boom"),
+    and each batch reports in-progress once before it's done.
+    """
+
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.requests: list[tuple[str, str]] = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, content_type="application/json"):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                server.requests.append(("POST", self.path))
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._send(server.post(self.path, data))
+
+            def do_GET(self):
+                server.requests.append(("GET", self.path))
+                body = server.get(self.path)
+                self._send(body, "application/binary" if isinstance(body, bytes) else "application/json")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def answer(prompt: str):
+        return None if "boom" in prompt else prompt.upper()
+
+    def post(self, path: str, data: bytes):
+        if path == "/v1/files":
+            # the jsonl is the last part of the multipart body
+            content = re.search(rb"\r\n\r\n(\{.*\})\s*\r\n--", data, re.S).group(1)  # type: ignore[union-attr]
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = content
+            return {"id": file_id, "object": "file", "bytes": len(content), "created_at": 0,
+                    "filename": "batch.jsonl", "purpose": "batch", "status": "processed"}
+        if path == "/v1/batches":
+            body = json.loads(data)
+            batch_id = f"batch_{len(self.batches)}"
+            lines = self.files[body["input_file_id"]].decode().splitlines()
+            self.batches[batch_id] = {"provider": "openai", "requests": [json.loads(x) for x in lines], "polls": 0,
+                                      "input_file_id": body["input_file_id"], "metadata": body.get("metadata"),
+                                      "created_at": int(time.time())}
+            return self.openai_batch(batch_id)
+        if path == "/v1/messages/batches":
+            batch_id = f"msgbatch_{len(self.batches)}"
+            self.batches[batch_id] = {"provider": "claude", "requests": json.loads(data)["requests"], "polls": 0}
+            return self.claude_batch(batch_id)
+        raise AssertionError(path)
+
+    def get(self, path: str):
+        if re.fullmatch(r"/v1/batches(\?.*)?", path):
+            data = [self.openai_batch(b) for b in reversed(self.batches) if self.batches[b]["provider"] == "openai"]
+            return {"object": "list", "data": data, "has_more": False}
+        if m := re.fullmatch(r"/v1/batches/(\w+)", path):
+            self.batches[m[1]]["polls"] += 1
+            return self.openai_batch(m[1])
+        if m := re.fullmatch(r"/v1/files/(\w+-\w+)/content", path):
+            return self.files[m[1]]
+        if m := re.fullmatch(r"/v1/messages/batches/(\w+)", path):
+            self.batches[m[1]]["polls"] += 1
+            return self.claude_batch(m[1])
+        if m := re.fullmatch(r"/v1/messages/batches/(\w+)/results", path):
+            lines = []
+            for r in self.batches[m[1]]["requests"]:
+                reply = self.answer(r["params"]["messages"][0]["content"])
+                if reply is None:
+                    result = {"type": "errored", "error": {"type": "error", "error": {"type": "invalid_request_error", "message": "boom"}}}
+                else:
+                    result = {"type": "succeeded", "message": {
+                        "id": "msg_1", "type": "message", "role": "assistant", "model": r["params"]["model"],
+                        "content": [{"type": "text", "text": reply}], "stop_reason": "end_turn",
+                        "usage": {"input_tokens": 3, "output_tokens": 2}}}
+                lines.append(json.dumps({"custom_id": r["custom_id"], "result": result}))
+            return ("\n".join(lines) + "\n").encode()
+        raise AssertionError(path)
+
+    def openai_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        done = batch["polls"] >= 2
+        if done and "output_file_id" not in batch:
+            lines = []
+            for r in batch["requests"]:
+                reply = self.answer(r["body"]["messages"][0]["content"])
+                if reply is None:
+                    response = {"status_code": 400, "body": {"error": {"message": "boom"}}}
+                else:
+                    response = {"status_code": 200, "body": {
+                        "choices": [{"message": {"role": "assistant", "content": reply}}],
+                        "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}}}
+                lines.append(json.dumps({"custom_id": r["custom_id"], "response": response, "error": None}))
+            batch["output_file_id"] = f"file-out{len(self.files)}"
+            self.files[batch["output_file_id"]] = ("\n".join(reversed(lines)) + "\n").encode()
+        return {"id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions",
+                "input_file_id": batch["input_file_id"], "completion_window": "24h", "created_at": batch["created_at"],
+                "metadata": batch["metadata"],
+                "status": "completed" if done else "in_progress",
+                "output_file_id": batch.get("output_file_id"), "error_file_id": None}
+
+    def claude_batch(self, batch_id: str):
+        done = self.batches[batch_id]["polls"] >= 2
+        return {"id": batch_id, "type": "message_batch", "created_at": "2024-01-01T00:00:00Z",
+                "expires_at": "2024-01-02T00:00:00Z", "archived_at": None, "cancel_initiated_at": None,
+                "ended_at": "2024-01-01T01:00:00Z" if done else None,
+                "processing_status": "ended" if done else "in_progress",
+                "request_counts": {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+                "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results" if done else None}
+
+
+@pytest.fixture
+def server():
+    server = FakeBatchServer()
+    yield server
+    server.httpd.shutdown()
+
+
+@pytest.mark.parametrize("provider", ["openai", "claude"])
+def test_batch_job_submits_polls_and_maps_results_back(server, tmp_path, provider):
+    if provider == "openai":
+        client = OpenAI(api_key="sk-test", base_url=server.url + "/v1")
+    else:
+        client = Anthropic(api_key="sk-test", base_url=server.url)
+    prompts = ["alpha", "beta", "boom", "gamma"]
+    state_filen = tmp_path / "job.json"
+
+    job = LLMBatchJob.submit(prompts, state_filen, provider=provider, client=client)  # type: ignore[arg-type]
+    assert json.loads(state_filen.read_text())["batch_id"] == job.batch_id
+    n_requests = len(server.requests)
+
+    # e.g. after a crash, submitting the same prompts resumes the same batch
+    job = LLMBatchJob.submit(prompts, state_filen, provider=provider, client=client)  # type: ignore[arg-type]
+    assert len(server.requests) == n_requests and len(server.batches) == 1
+    with pytest.raises(ValueError):
+        LLMBatchJob.submit(prompts[:2], state_filen, provider=provider, client=client)  # type: ignore[arg-type]
+
+    outs, extra = LLMBatchJob.load(state_filen, client=client).wait(poll_interval_s=0)
+    assert outs == ["ALPHA", "BETA", None, "GAMMA"]
+    assert extra["num_errors"] == 1 and "boom" in extra["errors"][2]
+    assert sum(extra["usage"].values()) > 0
+
+    # results are kept locally, so they don't need fetching again
+    n_requests = len(server.requests)
+    assert LLMBatchJob.load(state_filen, client=client).results()[0] == outs
+    assert len(server.requests) == n_requests
+
+
+def test_openai_batch_found_again_after_crash_before_save(server, tmp_path):
+    client = OpenAI(api_key="sk-test", base_url=server.url + "/v1")
+    prompts = ["alpha", "beta"]
+    state_filen = tmp_path / "job.json"
+    job = LLMBatchJob.submit(prompts, state_filen, provider="openai", client=client)  # type: ignore[arg-type]
+
+    # as if the process died after `batches.create` but before saving its id
+    state = json.loads(state_filen.read_text())
+    state.update({"batch_id": None, "status": "preparing"})
+    state_filen.write_text(json.dumps(state))
+
+    resumed = LLMBatchJob.submit(prompts, state_filen, provider="openai", client=client)  # type: ignore[arg-type]
+    assert resumed.batch_id == job.batch_id and len(server.batches) == 1
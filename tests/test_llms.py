@@ -0,0 +1,647 @@
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from anthropic.types import (
+    Message,
+    MessageDeltaUsage,
+    RawContentBlockDeltaEvent,
+    RawMessageDeltaEvent,
+    RawMessageStartEvent,
+    TextBlock,
+    TextDelta,
+    Usage,
+)
+from anthropic.types.raw_message_delta_event import Delta as MessageDelta
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import (
+    Choice as ChunkChoice,
+    ChoiceDelta,
+    ChoiceDeltaToolCall,
+    ChoiceDeltaToolCallFunction,
+)
+from openai.types.completion_usage import CompletionUsage
+import pytest
+
+from gjdutils import ratelimit
+from gjdutils.caching import SqliteCache
+from gjdutils.llm_utils import (
+    LatencyTracker,
+    agenerate_with_fallback,
+    batch_generate,
+    generate_with_fallback,
+)
+from gjdutils.llms_claude import acall_claude_gpt, call_claude_gpt, stream_claude_gpt
+from gjdutils.llms_common import (
+    PROMPT_CACHE_BREAKPOINT,
+    AsyncSingleFlight,
+    SingleFlight,
+    llm_cache_key,
+)
+from gjdutils.llms_openai import acall_openai_gpt, call_openai_gpt, stream_openai_gpt
+from gjdutils.ratelimit import TokenBucket
+
+
+def make_chat_completion(content: str, model: str = "gpt-4o") -> ChatCompletion:
+    return ChatCompletion(
+        id="chatcmpl-1",
+        choices=[
+            Choice(
+                index=0,
+                finish_reason="stop",
+                message=ChatCompletionMessage(role="assistant", content=content),
+            )
+        ],
+        created=0,
+        model=model,
+        object="chat.completion",
+        usage=CompletionUsage(prompt_tokens=5, completion_tokens=2, total_tokens=7),
+    )
+
+
+def make_claude_message(text: str, model: str = "claude-sonnet-4-0") -> Message:
+    return Message(
+        id="msg_1",
+        content=[TextBlock(type="text", text=text)],
+        model=model,
+        role="assistant",
+        stop_reason="end_turn",
+        type="message",
+        usage=Usage(input_tokens=5, output_tokens=2),
+    )
+
+
+class FakeOpenAIClient:
+    """Stands in for `OpenAI()`, answering every chat completion with REPLY."""
+
+    def __init__(self, reply: str = "Paris"):
+        self.reply = reply
+        self.calls: list[dict] = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        return make_chat_completion(self.reply, model=kwargs["model"])
+
+
+class FakeAnthropicClient:
+    """Stands in for `Anthropic()`, answering every message with REPLY."""
+
+    def __init__(self, reply: str = "Paris"):
+        self.reply = reply
+        self.calls: list[dict] = []
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        return make_claude_message(self.reply, model=kwargs["model"])
+
+
+def test_extra_level_controls_response_payload():
+    client = FakeOpenAIClient()
+    msg, _, extra = call_openai_gpt("Capital of France?", client=client)  # type: ignore[arg-type]
+    assert msg == "Paris"
+    assert extra["response"] is None and "contents" not in extra
+    assert extra["usage"]["total_tokens"] == 7 and extra["elapsed_s"] >= 0
+
+    _, _, extra = call_openai_gpt("Capital of France?", client=client, extra_level="raw")  # type: ignore[arg-type]
+    assert isinstance(extra["response"], ChatCompletion)
+    _, _, extra = call_openai_gpt("Capital of France?", client=client, extra_level="full")  # type: ignore[arg-type]
+    assert extra["response"]["choices"][0]["message"]["content"] == "Paris"
+    assert "contents" in extra
+
+    claude = FakeAnthropicClient()
+    msg, extra = call_claude_gpt("Capital of France?", client=claude)  # type: ignore[arg-type]
+    assert msg == "Paris"
+    assert extra["response"] is None and extra["usage"]["output_tokens"] == 2
+    _, extra = call_claude_gpt("Capital of France?", client=claude, extra_level="full")  # type: ignore[arg-type]
+    assert extra["response"]["content"][0]["text"] == "Paris"
+
+
+def test_response_cache_skips_repeat_calls(tmp_path):
+    cache = SqliteCache(tmp_path / "llm.sqlite")
+    client = FakeOpenAIClient()
+    msg, _, extra = call_openai_gpt("Capital of France?", client=client, cache=cache)  # type: ignore[arg-type]
+    assert msg == "Paris" and extra["cache_hit"] is False
+    msg, _, extra = call_openai_gpt("Capital of France?", client=client, cache=cache)  # type: ignore[arg-type]
+    assert msg == "Paris" and extra["cache_hit"] is True
+    assert len(client.calls) == 1
+
+    # anything that could change the response changes the key
+    call_openai_gpt("Capital of France?", client=client, cache=cache, temperature=0.5)  # type: ignore[arg-type]
+    call_openai_gpt("Capital of Spain?", client=client, cache=cache)  # type: ignore[arg-type]
+    assert len(client.calls) == 3
+
+    client.reply = "Paris, France"
+    msg, _, _ = call_openai_gpt("Capital of France?", client=client, cache=cache, cache_bypass=True)  # type: ignore[arg-type]
+    assert msg == "Paris, France" and len(client.calls) == 4
+    msg, _, _ = call_openai_gpt("Capital of France?", client=client, cache=cache)  # type: ignore[arg-type]
+    assert msg == "Paris, France" and len(client.calls) == 4
+
+    claude = FakeAnthropicClient()
+    call_claude_gpt("Capital of France?", client=claude, cache=cache)  # type: ignore[arg-type]
+    msg, extra = call_claude_gpt("Capital of France?", client=claude, cache=cache)  # type: ignore[arg-type]
+    assert msg == "Paris" and extra["cache_hit"] is True
+    assert len(claude.calls) == 1
+
+    # extra_level only changes the diagnostics, so it shares the cached response
+    _, _, extra = call_openai_gpt("Capital of France?", client=client, cache=cache, extra_level="full")  # type: ignore[arg-type]
+    assert extra["cache_hit"] is True and len(client.calls) == 4
+
+
+def test_response_cache_skips_unparseable_json(tmp_path):
+    cache = SqliteCache(tmp_path / "llm.sqlite")
+    claude = FakeAnthropicClient(reply="not json")
+    msg, _ = call_claude_gpt("JSON please", client=claude, cache=cache, response_json=True)  # type: ignore[arg-type]
+    assert msg["error"] == "Failed to parse API response"
+    claude.reply = '{"ok": true}'
+    msg, extra = call_claude_gpt("JSON please", client=claude, cache=cache, response_json=True)  # type: ignore[arg-type]
+    assert msg == {"ok": True} and extra["cache_hit"] is False
+    assert len(claude.calls) == 2
+
+
+def test_response_cache_key_tracks_image_contents(tmp_path):
+    img = tmp_path / "img.png"
+    img.write_bytes(b"one")
+    key1 = llm_cache_key("openai", "gpt-4o", "Describe", image_filens=[str(img)])
+    img.write_bytes(b"two")
+    key2 = llm_cache_key("openai", "gpt-4o", "Describe", image_filens=[str(img)])
+    assert key1 != key2
+    assert llm_cache_key("openai", "gpt-4o", "Describe", seed=1) == llm_cache_key(
+        "openai", "gpt-4o", "Describe", seed=1
+    )
+
+
+class EchoOpenAIClient(FakeOpenAIClient):
+    """Replies with the prompt itself (so ordering is checkable), failing on "boom"."""
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        prompt = kwargs["messages"][0]["content"][-1]["text"]
+        if "boom" in prompt:
+            raise ValueError("bad prompt")
+        time.sleep(0.01 * (hash(prompt) % 3))  # finish out of order
+        return make_chat_completion(prompt.upper(), model=kwargs["model"])
+
+
+def test_batch_generate_keeps_order_and_collects_errors():
+    client = EchoOpenAIClient()
+    words = ["a", "b", "boom", "c", "d", "e"]
+    progress = []
+    outs, extra = batch_generate(
+        [("say {{ w }}", {"w": w}) for w in words],
+        client=client,  # type: ignore[arg-type]
+        model_type="openai",
+        max_concurrency=3,
+        requests_per_minute=6000,
+        tokens_per_minute=1_000_000,
+        progress_callback=lambda done, total: progress.append((done, total)),
+    )
+    assert outs == ["SAY A", "SAY B", None, "SAY C", "SAY D", "SAY E"]
+    assert isinstance(extra["errors"][2], ValueError) and extra["num_errors"] == 1
+    assert extra["extras"][0]["usage"]["total_tokens"] == 7
+    assert progress[-1] == (6, 6) and len(client.calls) == 6
+
+
+class RateLimitedOnceOpenAIClient(FakeOpenAIClient):
+    """Fails the first request with a 429, then succeeds."""
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        if len(self.calls) == 1:
+            raise type("RateLimitError", (Exception,), {"status_code": 429})()
+        return make_chat_completion(self.reply, model=kwargs["model"])
+
+
+def test_batch_generate_retries_go_through_rate_limiters(monkeypatch):
+    acquired = []
+    monkeypatch.setattr(TokenBucket, "acquire", lambda self, n=1: acquired.append(n) or 0.0)
+    monkeypatch.setattr(ratelimit.time, "sleep", lambda s: None)
+    client = RateLimitedOnceOpenAIClient()
+    outs, extra = batch_generate(
+        [("say hi", {})],
+        client=client,  # type: ignore[arg-type]
+        model_type="openai",
+        requests_per_minute=60,
+        tokens_per_minute=1000,
+    )
+    assert outs == ["Paris"] and extra["num_retries"] == 1
+    # a request and a token acquisition for each of the two attempts
+    assert len(acquired) == 4
+
+
+def test_token_bucket_limits_rate(monkeypatch):
+    now = [0.0]
+
+    def fake_sleep(s):
+        now[0] += s
+
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(ratelimit.time, "sleep", fake_sleep)
+    bucket = TokenBucket(per_minute=60, burst=2)  # 1 per second
+    assert bucket.acquire() == 0 and bucket.acquire() == 0
+    assert bucket.acquire() == 1.0
+    assert bucket.acquire(5) == 2.0  # clamped to the burst size
+
+
+class FakeAsyncOpenAIClient(FakeOpenAIClient):
+    def __init__(self, reply: str = "Paris"):
+        super().__init__(reply)
+        self.in_flight = self.max_in_flight = 0
+
+    async def _create(self, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return super()._create(**kwargs)
+
+
+class FakeAsyncAnthropicClient(FakeAnthropicClient):
+    async def _create(self, **kwargs):
+        await asyncio.sleep(0)
+        return super()._create(**kwargs)
+
+
+def test_async_calls_share_one_event_loop(tmp_path):
+    client = FakeAsyncOpenAIClient()
+    claude = FakeAsyncAnthropicClient(reply='```json\n{"capital": "Paris"}\n```')
+    cache = SqliteCache(tmp_path / "llm.sqlite")
+    # the cache is only ever touched off the event loop's thread
+    cache_threads = set()
+    for name in ("get", "set"):
+        method = getattr(cache, name)
+        setattr(cache, name, lambda *a, _m=method: cache_threads.add(threading.get_ident()) or _m(*a))
+
+    async def main():
+        results = await asyncio.gather(
+            *[acall_openai_gpt(f"Question {i}", client=client) for i in range(20)]  # type: ignore[arg-type]
+        )
+        msg, extra = await acall_claude_gpt("Capital?", client=claude, response_json=True, cache=cache)  # type: ignore[arg-type]
+        _, cached_extra = await acall_claude_gpt("Capital?", client=claude, response_json=True, cache=cache)  # type: ignore[arg-type]
+        return results, msg, cached_extra
+
+    results, msg, cached_extra = asyncio.run(main())
+    assert [r[0] for r in results] == ["Paris"] * 20
+    assert client.max_in_flight > 1
+    assert msg == {"capital": "Paris"} and cached_extra["cache_hit"] is True
+    assert len(claude.calls) == 1
+    assert cache_threads and threading.get_ident() not in cache_threads
+
+
+def make_chunk(content=None, tool_call=None, finish_reason=None, usage=None) -> ChatCompletionChunk:
+    choices = []
+    if content is not None or tool_call is not None or finish_reason is not None:
+        delta = ChoiceDelta(content=content, tool_calls=[tool_call] if tool_call else None)
+        choices = [ChunkChoice(index=0, delta=delta, finish_reason=finish_reason)]
+    return ChatCompletionChunk(
+        id="chatcmpl-1", choices=choices, created=0, model="gpt-4o",
+        object="chat.completion.chunk", usage=usage,
+    )
+
+
+class FakeStreamingOpenAIClient(FakeOpenAIClient):
+    def __init__(self, chunks: list[ChatCompletionChunk]):
+        super().__init__()
+        self.chunks = chunks
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        assert kwargs["stream"] is True
+        return iter(self.chunks)
+
+
+def test_stream_openai_yields_deltas_then_full_result():
+    usage = CompletionUsage(prompt_tokens=5, completion_tokens=3, total_tokens=8)
+    client = FakeStreamingOpenAIClient(
+        [make_chunk('{"capital": '), make_chunk('"Paris"}', finish_reason="stop"), make_chunk(usage=usage)]
+    )
+    stream = stream_openai_gpt("Capital?", client=client, response_json=True)  # type: ignore[arg-type]
+    assert list(stream) == ['{"capital": ', '"Paris"}']
+    msg, tool_calls, extra = stream.result  # type: ignore[misc]
+    assert msg == {"capital": "Paris"} and tool_calls is None
+    assert extra["usage"]["total_tokens"] == 8
+    assert 0 <= extra["time_to_first_token_s"] <= extra["elapsed_s"]
+
+    fn = ChoiceDeltaToolCallFunction
+    client = FakeStreamingOpenAIClient(
+        [
+            make_chunk(tool_call=ChoiceDeltaToolCall(index=0, id="call_1", function=fn(name="get_weather", arguments='{"loc'))),
+            make_chunk(tool_call=ChoiceDeltaToolCall(index=0, function=fn(arguments='ation": "Paris"}')), finish_reason="tool_calls"),
+        ]
+    )
+    _, tool_calls, _ = stream_openai_gpt(
+        "Weather?", client=client, tools=[{"type": "function"}]  # type: ignore[arg-type]
+    ).get_result()
+    assert tool_calls[0].function.name == "get_weather"
+    assert json.loads(tool_calls[0].function.arguments) == {"location": "Paris"}
+
+
+class ClosableChunks:
+    """Stands in for the SDK's `Stream`, recording whether it was closed."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        assert not self.closed, "read from a closed stream"
+        return next(self._chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_closes_sdk_stream_when_abandoned():
+    chunks = ClosableChunks([make_chunk("Once"), make_chunk(" upon"), make_chunk(" a time")])
+    client = FakeStreamingOpenAIClient([])
+    client.chat.completions.create = lambda **kwargs: chunks
+    stream = stream_openai_gpt("Tell me a story", client=client)  # type: ignore[arg-type]
+    for delta in stream:
+        break
+    assert chunks.closed and stream.result is None
+    # the partial reply is neither returned as the result nor cached
+    with pytest.raises(RuntimeError):
+        stream.get_result()
+    with pytest.raises(RuntimeError):
+        list(stream)
+
+    chunks = ClosableChunks([make_chunk("Once")])
+    client.chat.completions.create = lambda **kwargs: chunks
+    with stream_openai_gpt("Tell me a story", client=client) as stream:  # type: ignore[arg-type]
+        pass
+    assert chunks.closed
+
+
+def test_abandoned_stream_isnt_cached(tmp_path):
+    cache = SqliteCache(tmp_path / "llm.sqlite")
+    client = FakeStreamingOpenAIClient([make_chunk("Once"), make_chunk(" upon a time", finish_reason="stop")])
+    stream = stream_openai_gpt("Tell me a story", client=client, cache=cache)  # type: ignore[arg-type]
+    for delta in stream:
+        break
+    with pytest.raises(RuntimeError):
+        stream.get_result()
+    msg, _, extra = stream_openai_gpt("Tell me a story", client=client, cache=cache).get_result()  # type: ignore[arg-type]
+    assert msg == "Once upon a time" and extra["cache_hit"] is False
+
+
+def test_stream_claude_yields_deltas_then_full_result():
+    events = [
+        RawMessageStartEvent(type="message_start", message=make_claude_message("")),
+        RawContentBlockDeltaEvent(type="content_block_delta", index=0, delta=TextDelta(type="text_delta", text="Par")),
+        RawContentBlockDeltaEvent(type="content_block_delta", index=0, delta=TextDelta(type="text_delta", text="is")),
+        RawMessageDeltaEvent(
+            type="message_delta",
+            delta=MessageDelta(stop_reason="end_turn"),
+            usage=MessageDeltaUsage(output_tokens=9),
+        ),
+    ]
+    claude = FakeAnthropicClient()
+    claude.messages = SimpleNamespace(create=lambda **kwargs: iter(events))
+    stream = stream_claude_gpt("Capital?", client=claude, extra_level="full")  # type: ignore[arg-type]
+    assert list(stream) == ["Par", "is"]
+    msg, extra = stream.result  # type: ignore[misc]
+    assert msg == "Paris" and extra["usage"]["output_tokens"] == 9
+    assert extra["response"]["content"][0]["text"] == "Paris"
+    assert extra["time_to_first_token_s"] is not None
+
+
+def test_prompt_cache_breakpoint_marks_static_prefix():
+    claude = FakeAnthropicClient()
+    prompt = f"Long instructions and examples{PROMPT_CACHE_BREAKPOINT}Input: cat"
+    _, extra = call_claude_gpt(prompt, client=claude)  # type: ignore[arg-type]
+    contents = claude.calls[0]["messages"][0]["content"]
+    assert contents[0] == {
+        "type": "text",
+        "text": "Long instructions and examples",
+        "cache_control": {"type": "ephemeral"},
+    }
+    assert contents[-1] == {"type": "text", "text": "Input: cat"}
+    assert extra["prompt_cache_read_tokens"] == 0
+
+    # nothing after the breakpoint means no (empty, and so invalid) suffix block
+    call_claude_gpt(f"Long instructions{PROMPT_CACHE_BREAKPOINT}", client=claude)  # type: ignore[arg-type]
+    assert len(claude.calls[-1]["messages"][0]["content"]) == 1
+
+    claude.messages = SimpleNamespace(
+        create=lambda **kwargs: make_claude_message("Paris").model_copy(
+            update={"usage": Usage(input_tokens=5, output_tokens=2, cache_read_input_tokens=1500)}
+        )
+    )
+    _, extra = call_claude_gpt(prompt, client=claude)  # type: ignore[arg-type]
+    assert extra["prompt_cache_read_tokens"] == 1500
+
+    client = FakeOpenAIClient()
+    call_openai_gpt(prompt, client=client)  # type: ignore[arg-type]
+    assert client.calls[0]["messages"][0]["content"][-1]["text"] == "Long instructions and examplesInput: cat"
+
+
+class SlowOpenAIClient(FakeOpenAIClient):
+    def _create(self, **kwargs):
+        time.sleep(0.1)
+        return super()._create(**kwargs)
+
+
+def test_coalesce_shares_one_call_between_concurrent_identical_requests():
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = SlowOpenAIClient()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [
+            pool.submit(call_openai_gpt, "Summarise page", client=client, coalesce=True)  # type: ignore[arg-type]
+            for _ in range(4)
+        ]
+        results = [f.result() for f in futures]
+    assert len(client.calls) == 1
+    assert all(msg == "Paris" for msg, _, _ in results)
+    assert sorted(extra["coalesced"] for _, _, extra in results) == [False, True, True, True]
+    # a different prompt isn't coalesced
+    call_openai_gpt("Other page", client=client, coalesce=True)  # type: ignore[arg-type]
+    assert len(client.calls) == 2
+    # nor are calls through different clients (e.g. different accounts)
+    clients = [SlowOpenAIClient(), SlowOpenAIClient()]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for c in clients:
+            pool.submit(call_openai_gpt, "Summarise page", client=c, coalesce=True)  # type: ignore[arg-type]
+    assert [len(c.calls) for c in clients] == [1, 1]
+
+    claude = FakeAsyncAnthropicClient()
+
+    async def main():
+        return await asyncio.gather(
+            *[acall_claude_gpt("Summarise page", client=claude, coalesce=True) for _ in range(3)]  # type: ignore[arg-type]
+        )
+
+    results = asyncio.run(main())
+    assert len(claude.calls) == 1 and [msg for msg, _ in results] == ["Paris"] * 3
+
+
+def test_async_single_flight_survives_leader_cancellation():
+    flight = AsyncSingleFlight()
+    n_calls = []
+
+    async def slow():
+        n_calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def main():
+        leader = asyncio.create_task(flight.do("k", slow))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do("k", slow)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.gather(*followers), leader
+
+    results, leader = asyncio.run(main())
+    assert leader.cancelled()
+    # one follower took over as leader, and the other shared its result
+    assert sorted(results) == [(42, False), (42, True)] and len(n_calls) == 2
+
+
+def test_single_flight_shares_errors():
+    from concurrent.futures import ThreadPoolExecutor
+
+    flight = SingleFlight()
+    n_calls = []
+
+    def fail():
+        n_calls.append(1)
+        time.sleep(0.1)
+        raise ValueError("down")
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(flight.do, "k", fail) for _ in range(3)]
+    assert all(isinstance(f.exception(), ValueError) for f in futures)
+    assert len(n_calls) == 1
+    assert flight.do("k", lambda: 42) == (42, False)  # nothing is remembered
+
+
+class DelayedAsyncOpenAIClient(FakeOpenAIClient):
+    """Async fake that takes DELAY_S to answer (or raises ERROR), noting cancellation."""
+
+    def __init__(self, reply: str = "Paris", delay_s: float = 0.0, error: Exception | None = None):
+        super().__init__(reply)
+        self.delay_s, self.error, self.cancelled = delay_s, error, False
+
+    async def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        try:
+            await asyncio.sleep(self.delay_s)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return make_chat_completion(self.reply, model=kwargs["model"])
+
+
+class DelayedAsyncAnthropicClient(FakeAnthropicClient):
+    def __init__(self, reply: str = "Paris", delay_s: float = 0.0):
+        super().__init__(reply)
+        self.delay_s = delay_s
+
+    async def _create(self, **kwargs):
+        await asyncio.sleep(self.delay_s)
+        return super()._create(**kwargs)
+
+
+ROUTES = [("openai", "gpt-4o"), ("claude", None)]
+
+
+def test_hedge_fires_when_primary_is_slow_and_cancels_loser():
+    slow = DelayedAsyncOpenAIClient(reply="slow", delay_s=5)
+    fast = DelayedAsyncAnthropicClient(reply="fast", delay_s=0.01)
+    t0 = time.perf_counter()
+    out, extra = generate_with_fallback(
+        "Capital of {{ country }}?", {"country": "France"}, False, ROUTES,
+        hedge_after_s=0.05, clients={"openai": slow, "claude": fast},
+    )
+    assert time.perf_counter() - t0 < 2
+    assert out == "fast" and extra["route"] == "claude:default" and extra["hedged"] is True
+    assert slow.cancelled
+
+    # the cancelled loser's time so far is recorded, as a lower bound
+    tracker = LatencyTracker(min_samples=1)
+    slow = DelayedAsyncOpenAIClient(reply="slow", delay_s=5)
+    generate_with_fallback(
+        "Hi", {}, False, ROUTES, hedge_after_s=0.05,
+        clients={"openai": slow, "claude": fast}, latency_tracker=tracker,
+    )
+    assert tracker.percentile("openai:gpt-4o") >= 0.05  # type: ignore[operator]
+
+    # from async code, the loser has finished cancelling by the time it returns
+    slow = DelayedAsyncOpenAIClient(reply="slow", delay_s=5)
+
+    async def main():
+        await agenerate_with_fallback(
+            "Hi", {}, False, ROUTES, hedge_after_s=0.05, clients={"openai": slow, "claude": fast}
+        )
+        return slow.cancelled, len(asyncio.all_tasks())
+
+    assert asyncio.run(main()) == (True, 1)
+
+    # fast enough: no hedge
+    quick = DelayedAsyncOpenAIClient(reply="quick")
+    out, extra = generate_with_fallback(
+        "Hi", {}, False, ROUTES, hedge_after_s=1, clients={"openai": quick, "claude": fast}
+    )
+    assert out == "quick" and extra["route_index"] == 0 and extra["hedged"] is False
+
+
+def test_fallback_on_errors_in_order():
+    broken = DelayedAsyncOpenAIClient(error=ValueError("500"))
+    claude = DelayedAsyncAnthropicClient(reply="backup")
+    tracker = LatencyTracker(min_samples=1)
+    out, extra = generate_with_fallback(
+        "Hi", {}, False, ROUTES, clients={"openai": broken, "claude": claude},
+        latency_tracker=tracker,
+    )
+    assert out == "backup" and extra["route"] == "claude:default"
+    assert [route for route, _ in extra["errors"]] == ["openai:gpt-4o"]
+    assert tracker.percentile("claude:default") is not None
+    assert tracker.percentile("openai:gpt-4o") is None
+
+    with pytest.raises(ValueError):
+        generate_with_fallback("Hi", {}, False, [("openai", "gpt-4o")], clients={"openai": broken})
+
+    # a reply that doesn't parse as JSON falls back too (even under python -O)
+    unparseable = DelayedAsyncAnthropicClient(reply="not json")
+    out, extra = generate_with_fallback(
+        "Hi", {}, True, ROUTES[::-1],
+        clients={"claude": unparseable, "openai": DelayedAsyncOpenAIClient(reply='{"a": 1}')},
+    )
+    assert out == {"a": 1} and extra["route"] == "openai:gpt-4o"
+
+    # ...but valid JSON that happens to have an "error" key doesn't
+    out, extra = generate_with_fallback(
+        "Hi", {}, True, ROUTES,
+        clients={"openai": DelayedAsyncOpenAIClient(reply='{"error": null, "value": 1}'),
+                 "claude": DelayedAsyncAnthropicClient(reply='{"a": 1}')},
+    )
+    assert out == {"error": None, "value": 1} and extra["route"] == "openai:gpt-4o"
+
+
+def test_fallback_doesnt_record_cache_hit_latencies(tmp_path):
+    cache = SqliteCache(tmp_path / "llm.sqlite")
+    tracker = LatencyTracker(min_samples=1)
+    clients = {"openai": DelayedAsyncOpenAIClient(), "claude": DelayedAsyncAnthropicClient()}
+    for _ in range(3):
+        generate_with_fallback(
+            "Hi", {}, False, ROUTES, clients=clients, latency_tracker=tracker, cache=cache
+        )
+    assert len(tracker._latencies["openai:gpt-4o"]) == 1
+
+
+def test_latency_tracker_p95():
+    tracker = LatencyTracker(window=100, min_samples=10)
+    for s in range(1, 101):
+        tracker.record("openai:gpt-4o", s / 100)
+    assert tracker.percentile("openai:gpt-4o", 0.95) == 0.95
+    assert tracker.percentile("claude:default") is None